@@ -0,0 +1,69 @@
+"""Cost of Product.allocate with many batches.
+
+Compares the batch index with sorting every batch on each allocation (the
+previous implementation), for products with 10, 1k and 100k batches::
+
+    python -m benchmarks.allocate --batches 10 1000 100000 --lines 1000
+
+Runs on the domain model only, no services are needed.
+"""
+import argparse
+import json
+import random
+import time
+from datetime import date, timedelta
+
+from allocation.domain.model import Batch, OrderLine, Product
+
+SKU = "BENCH-SKU"
+
+
+def make_product(n_batches: int, seed: int = 0) -> Product:
+    rnd = random.Random(seed)
+    today = date.today()
+    batches = [
+        Batch(
+            f"batch-{i}",
+            SKU,
+            rnd.randint(1, 20),
+            eta=None if rnd.random() < 0.1 else today + timedelta(rnd.randint(1, 365)),
+        )
+        for i in range(n_batches)
+    ]
+    return Product(SKU, batches)
+
+
+def allocate_sorted(product: Product, line: OrderLine) -> str | None:
+    batch = next((b for b in sorted(product.batches) if b.can_allocate(line)), None)
+    if batch is None:
+        return None
+    batch.allocate(line)
+    return batch.reference
+
+
+def measure(n_batches: int, n_lines: int, allocate) -> float:
+    product = make_product(n_batches)
+    product.batch_index  # built once per loaded product, not per line
+    rnd = random.Random(1)
+    lines = [OrderLine(f"order-{i}", SKU, rnd.randint(1, 10)) for i in range(n_lines)]
+    started = time.perf_counter()
+    for line in lines:
+        allocate(product, line)
+    return (time.perf_counter() - started) / n_lines
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batches", type=int, nargs="+", default=[10, 1000, 100_000])
+    parser.add_argument("--lines", type=int, default=1000)
+    args = parser.parse_args()
+
+    for n_batches in args.batches:
+        for name, allocate in (("index", Product.allocate), ("sorted", allocate_sorted)):
+            per_line = measure(n_batches, args.lines, allocate)
+            result = {"impl": name, "batches": n_batches, "us_per_line": per_line * 1e6}
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""Reproducible data for the benchmarks: the same seed gives the same data."""
+import random
+from datetime import date, timedelta
+from typing import Any
+
+from allocation.domain.model import Batch, OrderLine, Product
+
+SKU = "BENCH-SKU"
+EPOCH = date(2024, 1, 1)  # not today: the etas must not change between runs
+
+
+def batches(n_batches: int, seed: int = 0, sku: str = SKU) -> list[Batch]:
+    rnd = random.Random(seed)
+    return [
+        Batch(
+            f"batch-{i}",
+            sku,
+            rnd.randint(1, 20),
+            eta=None if rnd.random() < 0.1 else EPOCH + timedelta(rnd.randint(1, 365)),
+        )
+        for i in range(n_batches)
+    ]
+
+
+def product(n_batches: int, seed: int = 0, sku: str = SKU) -> Product:
+    return Product(sku, batches(n_batches, seed, sku))
+
+
+def order_lines(n_lines: int, seed: int = 1, sku: str = SKU) -> list[OrderLine]:
+    rnd = random.Random(seed)
+    return [OrderLine(f"order-{i}", sku, rnd.randint(1, 10)) for i in range(n_lines)]
+
+
+def product_json(
+    n_batches: int, lines_per_batch: int, seed: int = 0, sku: str = SKU
+) -> dict[str, Any]:
+    """A product as EdgeDB returns it in JSON, with its batches and lines."""
+    rnd = random.Random(seed)
+    result = []
+    for b in range(n_batches):
+        lines = [
+            {"orderid": f"order-{b}-{i}", "sku": sku, "qty": rnd.randint(1, 3)}
+            for i in range(lines_per_batch)
+        ]
+        purchased = 4 * lines_per_batch
+        eta = EPOCH + timedelta(rnd.randint(1, 365))
+        result.append(
+            {
+                "reference": f"batch-{b}",
+                "sku": sku,
+                "eta": None if rnd.random() < 0.1 else eta.isoformat(),
+                "purchased_quantity": purchased,
+                "available_quantity": purchased - sum(line["qty"] for line in lines),
+                "allocations": lines,
+            }
+        )
+    return {"sku": sku, "version_number": n_batches, "batches": result}
@@ -0,0 +1,49 @@
+"""Cost of Product.change_batch_quantity deallocating many lines.
+
+Shrinks a batch to nothing, which deallocates every one of its lines, with
+the allocated quantity counter and with summing the allocations on every
+check of the available quantity (the previous implementation)::
+
+    python -m benchmarks.deallocate --lines 10000
+
+Runs on the domain model only, no services are needed.
+"""
+import argparse
+import json
+import time
+
+from allocation.domain.model import Batch, OrderLine, Product
+
+SKU = "BENCH-SKU"
+
+
+class SummingBatch(Batch):
+    @property
+    def allocated_quantity(self) -> int:
+        return sum(line.qty for line in self.allocations)
+
+
+def measure(batch_class: type[Batch], n_lines: int) -> float:
+    batch = batch_class("batch", SKU, n_lines, eta=None)
+    product = Product(SKU, [batch])
+    for i in range(n_lines):
+        product.allocate(OrderLine(f"order-{i}", SKU, 1))
+    started = time.perf_counter()
+    product.change_batch_quantity("batch", 0)
+    elapsed = time.perf_counter() - started
+    assert len(product.events) == 2 * n_lines
+    return elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=10_000)
+    args = parser.parse_args()
+
+    for name, batch_class in (("counter", Batch), ("sum", SummingBatch)):
+        seconds = measure(batch_class, args.lines)
+        print(json.dumps({"impl": name, "lines": args.lines, "seconds": seconds}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Latency histograms kept the way HdrHistogram keeps them.
+
+Values are recorded in microseconds into log-linear buckets: each power of
+two is split into 2**SIGNIFICANT_BITS sub-buckets, so that a value is known
+to within 1/2**(SIGNIFICANT_BITS - 1) of itself however large it is, and
+recording costs the same whatever the range. Percentiles are read back as
+the highest value of their bucket, as HdrHistogram reports them, and the
+distribution is written in its .hgrm format, which its plotters read.
+"""
+from __future__ import annotations
+
+import math
+from collections import Counter
+
+SIGNIFICANT_BITS = 8
+
+
+def bucket(value: int) -> int:
+    """The highest value recorded in the same bucket as value."""
+    shift = max(0, value.bit_length() - SIGNIFICANT_BITS)
+    return (((value >> shift) + 1) << shift) - 1 if shift else value
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.counts: Counter[int] = Counter()
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, seconds: float) -> None:
+        value = max(0, round(seconds * 1e6))
+        self.counts[bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def merge(self, other: Histogram) -> None:
+        self.counts.update(other.counts)
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def value_at(self, percentile: float) -> int:
+        """The value that percentile percent of the recorded ones do not exceed."""
+        if not self.count:
+            return 0
+        rank = max(1, math.ceil(percentile / 100 * self.count))
+        seen = 0
+        for value in sorted(self.counts):
+            seen += self.counts[value]
+            if seen >= rank:
+                return min(value, self.max)
+        return self.max
+
+    def percentiles(self, ticks_per_half: int = 5) -> list[tuple[float, int, int]]:
+        """(percentile, value, values at or below it) from 0 to 100 percent,
+        closer together near 100: each half of the distance left to 100
+        percent is split into ticks_per_half steps."""
+        result = []
+        percentile = 0.0
+        while 100 - percentile >= 100 / max(self.count, 1):
+            result.append(self.at(percentile))
+            if result[-1][2] == self.count:
+                break
+            halvings = int(math.log2(100 / (100 - percentile)))
+            percentile += 100 / (ticks_per_half * 2 ** (halvings + 1))
+        result.append(self.at(100.0))
+        return result
+
+    def at(self, percentile: float) -> tuple[float, int, int]:
+        value = self.value_at(percentile)
+        below = sum(count for v, count in self.counts.items() if v <= bucket(value))
+        return percentile, value, below
+
+    def hgrm(self) -> str:
+        """The distribution in HdrHistogram's .hgrm format, values in ms."""
+        header = ("Value", "Percentile", "TotalCount", "1/(1-Percentile)")
+        lines = ["{:>12} {:>14} {:>10} {:>14}".format(*header), ""]
+        for percentile, value, below in self.percentiles():
+            fraction = percentile / 100
+            inverse = f"{1 / (1 - fraction):14.2f}" if fraction < 1 else ""
+            lines.append(f"{value / 1000:12.3f} {fraction:14.12f} {below:10d} {inverse}")
+        variance = 0.0
+        if self.count:
+            variance = (
+                sum(count * (v - self.mean) ** 2 for v, count in self.counts.items())
+                / self.count
+            )
+        lines += [
+            f"#[Mean    = {self.mean / 1000:12.3f}, "
+            f"StdDeviation   = {math.sqrt(variance) / 1000:12.3f}]",
+            f"#[Max     = {self.max / 1000:12.3f}, Total count    = {self.count:12d}]",
+            f"#[Buckets = {len(self.counts):12d}, "
+            f"SubBuckets     = {2 ** SIGNIFICANT_BITS:12d}]",
+        ]
+        return "\n".join(line.rstrip() for line in lines) + "\n"
+
+    def summary(self) -> dict[str, float | int]:
+        return {
+            "count": self.count,
+            "mean_ms": round(self.mean / 1000, 3),
+            **{
+                f"p{str(p).replace('.', '')}_ms": round(self.value_at(p) / 1000, 3)
+                for p in (50, 90, 99, 99.9)
+            },
+            "max_ms": round(self.max / 1000, 3),
+        }
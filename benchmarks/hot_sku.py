@@ -0,0 +1,157 @@
+"""Allocations per second on one hot SKU, with and without group commit.
+
+--callers concurrent callers send --lines Allocate commands for one SKU
+through the messagebus. Without group commit every command loads the
+product and commits it alone, and all but one of the concurrent ones lose
+the version race and retry. With it, the commands that arrive while a
+transaction of the SKU runs are committed together.
+
+By default the store is simulated in memory: a load takes --load-ms, a
+commit --commit-ms, and a commit fails if the product changed since it was
+loaded, as EdgeDB's serializable transactions do. --edgedb runs against the
+database from docker-compose instead::
+
+    python -m benchmarks.hot_sku --callers 100 --lines 5000
+    python -m benchmarks.hot_sku --edgedb --callers 100 --lines 2000
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+from collections import defaultdict
+from unittest import mock
+
+from allocation import bootstrap
+from allocation.app.settings import settings
+from allocation.domain import commands
+from allocation.domain.model import Product
+from allocation.repositories import cache, repository
+from allocation.services import retry, unit_of_work
+
+SKU = "BENCH-HOT-SKU"
+
+
+class SimulatedRepository(repository.AbstractRepository):
+    def __init__(self, store: dict[str, Product], load_ms: float) -> None:
+        super().__init__()
+        self.store = store
+        self.load_ms = load_ms
+        self.loaded: dict[str, int] = {}
+
+    async def _get(self, sku, allocations=True):
+        await asyncio.sleep(self.load_ms / 1000)
+        product = self.store.get(sku)
+        if product is None:
+            return None
+        self.loaded[sku] = product.version_number
+        return cache.capacity_copy(product)
+
+    async def _get_by_batchref(self, batchref, allocations=True, batch_lines=False):
+        raise NotImplementedError
+
+    async def allocated_batches(self, sku, orderids):
+        return {}  # every order of a run is new
+
+    async def _add(self, product):
+        pass
+
+
+class SimulatedUnitOfWork(unit_of_work.AbstractUnitOfWork):
+    def __init__(self, store, load_ms, commit_ms):
+        self.store = store
+        self.load_ms = load_ms
+        self.commit_ms = commit_ms
+        self.products = SimulatedRepository(store, load_ms)
+
+    async def __aenter__(self):
+        self.products = SimulatedRepository(self.store, self.load_ms)
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def commit(self):
+        await asyncio.sleep(self.commit_ms / 1000)
+        for product in self.products.seen:
+            stored = self.store.get(product.sku)
+            if stored and stored.version_number != self.products.loaded[product.sku]:
+                raise repository.SynchronousUpdateError("concurrent update")
+        for product in self.products.seen:
+            self.store[product.sku] = product
+
+
+class SimulatedUnitOfWorkFactory(unit_of_work.AbstractUnitOfWorkFactory):
+    def __init__(self, load_ms: float, commit_ms: float) -> None:
+        self.store: dict[str, Product] = {}
+        self.load_ms = load_ms
+        self.commit_ms = commit_ms
+
+    def __call__(self):
+        return SimulatedUnitOfWork(self.store, self.load_ms, self.commit_ms)
+
+
+async def measure(uow_factory, group_commit: bool, callers: int, lines: int) -> dict:
+    settings.allocate_group_commit = group_commit
+    bus = bootstrap.Bootstrap(
+        uow_factory=uow_factory,
+        notifications=mock.AsyncMock(),
+        publish=mock.AsyncMock(),
+        allocations_cache=mock.AsyncMock(),
+    ).messagebus
+    bus.event_handlers = defaultdict(list)  # the commands' transactions only
+    prefix = f"{SKU}-{'group' if group_commit else 'single'}-{time.time_ns()}"
+    await bus.handle(commands.CreateBatch(f"{prefix}-batch", SKU, lines * 10, None))
+    retry.stats.__init__()
+    failed = 0
+
+    async def caller(offset: int) -> None:
+        nonlocal failed
+        for i in range(offset, lines, callers):
+            try:
+                await bus.handle(commands.Allocate(f"{prefix}-order-{i}", SKU, 1))
+            except repository.SynchronousUpdateError:
+                failed += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(caller(offset) for offset in range(callers)))
+    elapsed = time.perf_counter() - started
+    return {
+        "group_commit": group_commit,
+        "callers": callers,
+        "lines": lines,
+        "allocations_per_second": round((lines - failed) / elapsed),
+        "conflicts": retry.stats.conflicts,
+        "failed": failed,
+    }
+
+
+async def main(
+    callers: int, lines: int, edgedb: bool, load_ms: float, commit_ms: float
+) -> list[dict]:
+    if edgedb:
+        uow_factory = bootstrap.get_uow_factory(
+            bootstrap.get_pull_connection_edgedb(test_db=True)
+        )
+    else:
+        uow_factory = SimulatedUnitOfWorkFactory(load_ms, commit_ms)
+    logging.disable(logging.ERROR)  # the commands that give up on their conflicts
+    results = []
+    try:
+        for group_commit in (False, True):
+            result = await measure(uow_factory, group_commit, callers, lines)
+            print(json.dumps(result))
+            results.append(result)
+    finally:
+        await uow_factory.aclose()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--callers", type=int, default=100)
+    parser.add_argument("--lines", type=int, default=5000)
+    parser.add_argument("--edgedb", action="store_true")
+    parser.add_argument("--load-ms", type=float, default=1.0)
+    parser.add_argument("--commit-ms", type=float, default=2.0)
+    args = parser.parse_args()
+    asyncio.run(main(args.callers, args.lines, args.edgedb, args.load_ms, args.commit_ms))
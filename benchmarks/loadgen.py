@@ -0,0 +1,267 @@
+"""HTTP load on /allocate, /add_batch and /allocations/{orderid}.
+
+A scenario mixes the three requests the way some traffic does:
+
+- hot-sku: allocations over --skus SKUs, a few of them taking most of the
+  orders (a Zipf distribution of exponent --skew), and some reads;
+- bulk: batches created as fast as they come, and some allocations;
+- read-heavy: allocated orders polled for their batch, a few allocated
+  in the meantime.
+
+Requests go through the helpers of tests/e2e/api_client to the API at
+API_HOST:API_PORT, or with --in-process to the app in this process, its
+products kept in memory and Redis and SMTP replaced by local stand-ins, so
+that no services are needed. With --rate, requests are sent at that rate
+and their latency counts from when they were due, so that a stalled server
+is not hidden by clients that stopped sending; without it --concurrency
+clients send them back to back.
+
+A histogram of each request is written to --output in HdrHistogram's .hgrm
+format, with summary.json; the summary is also printed::
+
+    python -m benchmarks.loadgen --in-process --scenario hot-sku --duration 10
+    python -m benchmarks.loadgen --scenario read-heavy --rate 500 --output load
+"""
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import random
+import time
+import uuid
+from dataclasses import dataclass, replace
+from datetime import date, timedelta
+from http import HTTPStatus
+from typing import AsyncIterator
+
+import httpx
+import redis.asyncio as redis
+
+from allocation import bootstrap
+from allocation.adapters import notifications, redis_eventpublisher
+from allocation.app import main
+from allocation.app.settings import settings
+from benchmarks.histogram import Histogram
+from benchmarks.redis_standin import RedisStandIn
+from tests.e2e import api_client
+from tests.smtp_standin import SMTPStandIn
+
+REQUESTS = ("add_batch", "allocate", "allocations")
+
+
+@dataclass(frozen=True)
+class Scenario:
+    mix: dict[str, float]  # request -> share of the requests
+    skus: int = 100
+    skew: float = 0.0  # 0 - every SKU as likely
+    batches_per_sku: int = 2
+    batch_quantity: int = 10_000
+    orders: int = 0  # allocated before the run, for the reads to poll
+
+
+SCENARIOS = {
+    "hot-sku": Scenario(
+        {"allocate": 0.9, "allocations": 0.1}, skus=100, skew=1.2, orders=100
+    ),
+    "bulk": Scenario({"add_batch": 0.8, "allocate": 0.2}, skus=1000, batches_per_sku=1),
+    "read-heavy": Scenario(
+        {"allocations": 0.9, "allocate": 0.1}, skus=100, skew=0.5, orders=1000
+    ),
+}
+
+
+class RequestFailed(Exception):
+    pass
+
+
+class Load:
+    """Sends the requests of a scenario and records how long each took."""
+
+    def __init__(self, client: httpx.AsyncClient, scenario: Scenario, seed: int) -> None:
+        self.client = client
+        self.scenario = scenario
+        self.rnd = random.Random(seed)
+        # unique per run, so that runs against the same API do not collide
+        self.prefix = f"load-{uuid.uuid4().hex[:8]}"
+        self.skus = [f"{self.prefix}-sku-{i}" for i in range(scenario.skus)]
+        self.weights = [1 / (rank + 1) ** scenario.skew for rank in range(scenario.skus)]
+        self.numbers = itertools.count()
+        self.orders: list[str] = []
+        self.histograms = {name: Histogram() for name in REQUESTS}
+        self.errors = {name: 0 for name in REQUESTS}
+
+    def sku(self) -> str:
+        return self.rnd.choices(self.skus, self.weights)[0]
+
+    async def add_batch(self, sku: str | None = None) -> None:
+        eta = None
+        if self.rnd.random() > 0.1:
+            eta = (date.today() + timedelta(self.rnd.randint(1, 90))).isoformat()
+        await api_client.post_to_add_batch(
+            self.client,
+            f"{self.prefix}-batch-{next(self.numbers)}",
+            sku or self.sku(),
+            self.scenario.batch_quantity,
+            eta,
+        )
+
+    async def allocate(self) -> None:
+        orderid = f"{self.prefix}-order-{next(self.numbers)}"
+        r = await api_client.post_to_allocate(
+            self.client, orderid, self.sku(), self.rnd.randint(1, 3), expect_success=False
+        )
+        if r.status_code != HTTPStatus.ACCEPTED:
+            raise RequestFailed(r.status_code)
+        self.orders.append(orderid)
+
+    async def allocations(self) -> None:
+        if not self.orders:
+            raise RequestFailed("no order allocated yet")
+        r = await api_client.get_allocation(self.client, self.rnd.choice(self.orders))
+        if r.status_code != HTTPStatus.OK:
+            raise RequestFailed(r.status_code)
+
+    async def setup(self) -> None:
+        for sku in self.skus:
+            for _ in range(self.scenario.batches_per_sku):
+                await self.add_batch(sku)
+        for _ in range(self.scenario.orders):
+            await self.allocate()
+
+    async def send(self, name: str, due: float) -> None:
+        try:
+            await getattr(self, name)()
+        # the helpers of api_client assert the status of what they send
+        except (RequestFailed, AssertionError, httpx.HTTPError):
+            self.errors[name] += 1
+            return
+        self.histograms[name].record(time.perf_counter() - due)
+
+    async def run(self, duration: float, concurrency: int, rate: float | None) -> float:
+        names, shares = zip(*self.scenario.mix.items())
+        slots = itertools.count()
+        started = time.perf_counter()
+        deadline = started + duration
+
+        async def client() -> None:
+            while True:
+                now = time.perf_counter()
+                due = started + next(slots) / rate if rate else now
+                if due >= deadline:
+                    return
+                if due > now:
+                    await asyncio.sleep(due - now)
+                await self.send(self.rnd.choices(names, shares)[0], due)
+
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        return time.perf_counter() - started
+
+    def report(self, elapsed: float) -> dict:
+        requests = {}
+        for name in REQUESTS:
+            histogram = self.histograms[name]
+            if not histogram.count and not self.errors[name]:
+                continue
+            requests[name] = {
+                "per_second": round(histogram.count / elapsed, 1),
+                "errors": self.errors[name],
+                **histogram.summary(),
+            }
+        everything = Histogram()
+        for histogram in self.histograms.values():
+            everything.merge(histogram)
+        return {
+            "seconds": round(elapsed, 3),
+            "per_second": round(everything.count / elapsed, 1),
+            "errors": sum(self.errors.values()),
+            "requests": requests,
+        }
+
+
+@contextlib.asynccontextmanager
+async def in_process_client(connections: int) -> AsyncIterator[httpx.AsyncClient]:
+    """A client of the app in this process, with its products in memory."""
+    settings.repository_backend = "memory"
+    settings.sharding = "off"
+    async with RedisStandIn() as redis_server, SMTPStandIn() as smtp_server:
+        redis_client = redis.from_url(redis_server.url)
+        publisher = redis_eventpublisher.BufferedPublisher(redis_client)
+        bootstrap.bootstrap = bootstrap.Bootstrap(
+            notifications=notifications.EmailNotifications(
+                smtp_server.host, smtp_server.port
+            ),
+            publish=publisher.publish,
+        )
+        app = main.make_app()
+        await bootstrap.aenter_lifespan(app)
+        try:
+            async with httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=app),
+                base_url=api_client.API_URL,
+                limits=httpx.Limits(max_connections=connections),
+            ) as client:
+                yield client
+        finally:
+            await bootstrap.aexit_lifespan(app)
+            await publisher.aclose()
+            await redis_client.aclose()
+
+
+@contextlib.asynccontextmanager
+async def api_client_of(connections: int) -> AsyncIterator[httpx.AsyncClient]:
+    async with httpx.AsyncClient(
+        base_url=api_client.API_URL,
+        limits=httpx.Limits(max_connections=connections),
+        timeout=30.0,
+    ) as client:
+        yield client
+
+
+def write(output: str, load: Load, report: dict) -> None:
+    os.makedirs(output, exist_ok=True)
+    for name, histogram in load.histograms.items():
+        if histogram.count:
+            with open(os.path.join(output, f"{name}.hgrm"), "w", encoding="utf-8") as f:
+                f.write(histogram.hgrm())
+    with open(os.path.join(output, "summary.json"), "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+
+async def run(args: argparse.Namespace) -> dict:
+    scenario = SCENARIOS[args.scenario]
+    if args.skus is not None:
+        scenario = replace(scenario, skus=args.skus)
+    if args.skew is not None:
+        scenario = replace(scenario, skew=args.skew)
+    target = in_process_client if args.in_process else api_client_of
+    async with target(args.concurrency) as client:
+        load = Load(client, scenario, args.seed)
+        await load.setup()
+        elapsed = await load.run(args.duration, args.concurrency, args.rate)
+    report = {
+        "scenario": args.scenario,
+        "target": "in-process" if args.in_process else api_client.API_URL,
+        "concurrency": args.concurrency,
+        "rate": args.rate,
+        **load.report(elapsed),
+    }
+    print(json.dumps(report))
+    if args.output:
+        write(args.output, load, report)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", choices=SCENARIOS, default="hot-sku")
+    parser.add_argument("--in-process", action="store_true")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--rate", type=float, help="requests per second")
+    parser.add_argument("--skus", type=int)
+    parser.add_argument("--skew", type=float)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="directory for the histograms and summary")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,93 @@
+"""Memory per OrderLine and allocate throughput of a product with many lines.
+
+Loads a product holding --lines order lines spread over --batches batches,
+the way the repository hydrates it, then allocates --allocations more. Does
+it with the slotted OrderLine and with the Pydantic one of
+benchmarks/pyd_model.py (the previous implementation)::
+
+    python -m benchmarks.order_lines --lines 1000000 --batches 1000
+
+Runs on the domain model only, no services are needed.
+"""
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+from typing import Callable
+
+from allocation.domain.model import Batch, OrderLine, Product
+from benchmarks import pyd_model
+
+SKU = "BENCH-SKU"
+
+MakeLine = Callable[[str, str, int], OrderLine]
+
+
+def pydantic_line(orderid: str, sku: str, qty: int) -> OrderLine:
+    # the domain only reads a line's fields and hashes it
+    return pyd_model.OrderLine(orderid=orderid, sku=sku, qty=qty)  # type: ignore
+
+
+def bytes_per_line(n_lines: int, make_line: MakeLine) -> float:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    lines = [make_line(f"order-{i}", SKU, 1) for i in range(n_lines)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # the orderid strings and the list are counted too, as they are when loaded
+    assert len(lines) == n_lines
+    return (after - before) / n_lines
+
+
+def load_product(n_lines: int, n_batches: int, make_line: MakeLine) -> Product:
+    per_batch = n_lines // n_batches
+    return Product(
+        SKU,
+        [
+            Batch(
+                f"batch-{b}",
+                SKU,
+                2 * per_batch,
+                eta=None,
+                allocations=[
+                    make_line(f"order-{b}-{i}", SKU, 1) for i in range(per_batch)
+                ],
+            )
+            for b in range(n_batches)
+        ],
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=1_000_000)
+    parser.add_argument("--batches", type=int, default=1000)
+    parser.add_argument("--allocations", type=int, default=100_000)
+    args = parser.parse_args()
+
+    for name, make_line in (("slots", OrderLine), ("pydantic", pydantic_line)):
+        result = {
+            "impl": name,
+            "lines": args.lines,
+            "bytes_per_line": bytes_per_line(args.lines, make_line),
+        }
+
+        started = time.perf_counter()
+        product = load_product(args.lines, args.batches, make_line)
+        result["load_seconds"] = time.perf_counter() - started
+
+        lines = [make_line(f"new-{i}", SKU, 1) for i in range(args.allocations)]
+        started = time.perf_counter()
+        for line in lines:
+            product.allocate(line)
+        result["allocations_per_second"] = args.allocations / (
+            time.perf_counter() - started
+        )
+        print(json.dumps(result))
+        del product, lines
+
+
+if __name__ == "__main__":
+    main()
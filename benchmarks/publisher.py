@@ -0,0 +1,79 @@
+"""Events per second of the direct and the buffered Redis publishers.
+
+--publishers tasks publish --events Allocated events between them, as the
+handlers of concurrent commands do, to a local Redis stand-in that speaks
+RESP over TCP (benchmarks/redis_standin.py), so that round trips are paid
+as with Redis on the same host::
+
+    python -m benchmarks.publisher --events 50000 --publishers 64
+"""
+import argparse
+import asyncio
+import json
+import time
+from dataclasses import asdict
+
+import redis.asyncio as redis
+
+from allocation.adapters import redis_eventpublisher
+from allocation.domain import events
+from benchmarks.redis_standin import RedisStandIn
+
+
+async def publish_all(publish, events_count: int, publishers: int) -> None:
+    async def publisher(offset: int) -> None:
+        for i in range(offset, events_count, publishers):
+            await publish("line_allocated", events.Allocated(f"o{i}", "LAMP", 1, "b1"))
+
+    await asyncio.gather(*(publisher(offset) for offset in range(publishers)))
+
+
+async def measure(mode: str, events_count: int, publishers: int, batch_size: int):
+    async with RedisStandIn() as server:
+        client = redis.from_url(server.url)
+        buffered = redis_eventpublisher.BufferedPublisher(client, batch_size=batch_size)
+        if mode == "buffered":
+            publish = buffered.publish
+        else:
+
+            async def publish(channel, event):
+                await client.publish(channel, json.dumps(asdict(event)))
+
+        started = time.perf_counter()
+        await publish_all(publish, events_count, publishers)
+        await buffered.aclose()
+        elapsed = time.perf_counter() - started
+        await client.aclose()
+    assert server.commands["PUBLISH"] == events_count
+    result = {
+        "mode": mode,
+        "events": events_count,
+        "publishers": publishers,
+        "events_per_second": round(events_count / elapsed),
+    }
+    if mode == "buffered":
+        stats = buffered.stats
+        result["batch_size"] = batch_size
+        result["flushes"] = stats.flushes
+        result["mean_flush_size"] = round(stats.published / stats.flushes, 1)
+        result["mean_flush_ms"] = round(stats.flush_seconds / stats.flushes * 1000, 3)
+        result["max_flush_ms"] = round(stats.max_flush_seconds * 1000, 3)
+    return result
+
+
+async def main(events_count: int, publishers: int, batch_size: int) -> list[dict]:
+    results = []
+    for mode in ("direct", "buffered"):
+        result = await measure(mode, events_count, publishers, batch_size)
+        print(json.dumps(result))
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=50_000)
+    parser.add_argument("--publishers", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+    asyncio.run(main(args.events, args.publishers, args.batch_size))
@@ -0,0 +1,38 @@
+"""Pydantic models of a product, the way the domain model was before it was
+slotted: benchmarks/order_lines.py compares their order lines with the
+domain's, and benchmarks/suite.py times hydrating EdgeDB's JSON into them.
+
+They are read from domain objects too, with ``model_validate``.
+"""
+from __future__ import annotations
+
+from datetime import date
+
+from pydantic import BaseModel, ConfigDict, Field
+
+
+class OrderLine(BaseModel):
+    orderid: str
+    sku: str
+    qty: int
+
+    model_config = ConfigDict(from_attributes=True, frozen=True)
+
+
+class Batch(BaseModel):
+    reference: str
+    sku: str
+    eta: date | None
+    purchased_quantity: int
+    available_quantity: int
+    allocations: list[OrderLine] = Field(default_factory=list)
+
+    model_config = ConfigDict(from_attributes=True)
+
+
+class Product(BaseModel):
+    sku: str
+    version_number: int
+    batches: list[Batch] = Field(default_factory=list)
+
+    model_config = ConfigDict(from_attributes=True)
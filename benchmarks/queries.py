@@ -0,0 +1,183 @@
+"""Latency of the hot lookup paths on a large database.
+
+Seeds --batches batches (10 per product) holding --lines order lines, with
+one AllocationsView row per line, then times every access path that the
+service filters on. Run it once on a database migrated to 00002 and once
+after 00003 to compare without and with the indexes; each result is labelled
+with the last applied migration::
+
+    python -m benchmarks.queries --seed --batches 100000 --lines 1000000
+    python -m benchmarks.queries          # again, on the seeded data
+
+Needs the EdgeDB from docker-compose (settings are read as by the app).
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+
+import edgedb
+
+from allocation.app.settings import settings
+
+PREFIX = "bench-queries"
+BATCHES_PER_PRODUCT = 10
+CHUNK = 5000
+
+SEED_PRODUCTS = """
+    FOR obj IN json_array_unpack(<json>$data) UNION (
+        INSERT Product { sku := <str>obj, version_number := 1 }
+    )
+"""
+SEED_BATCHES = """
+    FOR obj IN json_array_unpack(<json>$data) UNION (
+        INSERT Batch {
+            reference := <str>obj['reference'],
+            sku := <str>obj['sku'],
+            purchased_quantity := 10000,
+            product := (SELECT Product FILTER .sku = <str>obj['sku']),
+        }
+    )
+"""
+SEED_LINES = """
+    FOR obj IN json_array_unpack(<json>$data) UNION (
+        INSERT OrderLine {
+            orderid := <str>obj['orderid'],
+            sku := <str>obj['sku'],
+            qty := 1,
+            allocated_in := (SELECT Batch FILTER .reference = <str>obj['batchref']),
+        }
+    )
+"""
+SEED_VIEW = """
+    FOR obj IN json_array_unpack(<json>$data) UNION (
+        INSERT AllocationsView {
+            orderid := <str>obj['orderid'],
+            sku := <str>obj['sku'],
+            batchref := <str>obj['batchref'],
+        }
+    )
+"""
+
+# access path -> (query, the arguments it is run with)
+PATHS = {
+    "view by orderid": (
+        "SELECT AllocationsView {sku, batchref} FILTER .orderid = <str>$orderid",
+        ("orderid",),
+    ),
+    "view by orderid and sku": (
+        """SELECT count(AllocationsView FILTER .orderid = <str>$orderid
+                AND .sku = <str>$sku)""",
+        ("orderid", "sku"),
+    ),
+    # the save of a product deletes deallocated order lines by these filters
+    "order line by orderid": (
+        """SELECT count(OrderLine FILTER .orderid = <str>$orderid
+                AND .sku = <str>$sku AND .allocated_in.reference = <str>$batchref)""",
+        ("orderid", "sku", "batchref"),
+    ),
+    "product by sku": (
+        "SELECT Product { version_number } FILTER .sku = <str>$sku",
+        ("sku",),
+    ),
+    "product by batch reference": (
+        """SELECT Product { version_number }
+            FILTER .batches.reference ?= <optional str>$batchref LIMIT 1""",
+        ("batchref",),
+    ),
+}
+
+
+def sku(i: int) -> str:
+    return f"{PREFIX}-sku-{i}"
+
+
+def batchref(i: int) -> str:
+    return f"{PREFIX}-batch-{i}"
+
+
+def orderid(i: int) -> str:
+    return f"{PREFIX}-order-{i}"
+
+
+async def insert(client, query: str, rows: list) -> None:
+    for start in range(0, len(rows), CHUNK):
+        await client.execute(query, data=json.dumps(rows[start : start + CHUNK]))
+
+
+async def seed(client, batches: int, lines: int) -> None:
+    products = batches // BATCHES_PER_PRODUCT
+    await insert(client, SEED_PRODUCTS, [sku(p) for p in range(products)])
+    await insert(
+        client,
+        SEED_BATCHES,
+        [
+            {"reference": batchref(b), "sku": sku(b // BATCHES_PER_PRODUCT)}
+            for b in range(batches)
+        ],
+    )
+    for start in range(0, lines, CHUNK):
+        rows = [line(i, batches) for i in range(start, min(start + CHUNK, lines))]
+        await client.execute(SEED_LINES, data=json.dumps(rows))
+        await client.execute(SEED_VIEW, data=json.dumps(rows))
+
+
+def line(i: int, batches: int) -> dict[str, str]:
+    b = i % batches
+    return {
+        "orderid": orderid(i),
+        "sku": sku(b // BATCHES_PER_PRODUCT),
+        "batchref": batchref(b),
+    }
+
+
+async def measure(client, path: str, batches: int, lines: int, samples: int) -> dict:
+    query, params = PATHS[path]
+    rnd = random.Random(path)
+    latencies = []
+    for _ in range(samples):
+        values = line(rnd.randrange(lines), batches)
+        started = time.perf_counter()
+        await client.query(query, **{name: values[name] for name in params})
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    return {
+        "path": path,
+        "ms_median": round(statistics.median(latencies) * 1000, 3),
+        "ms_p99": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 3),
+    }
+
+
+async def main(batches: int, lines: int, samples: int, seed_data: bool) -> list[dict]:
+    client = edgedb.create_async_client(
+        settings.get_edgedb_dsn(test_db=True), tls_security="insecure"
+    )
+    results = []
+    try:
+        if seed_data:
+            await seed(client, batches, lines)
+        migration = await client.query_single(
+            """SELECT (
+                SELECT schema::Migration FILTER NOT EXISTS .<parents[is schema::Migration]
+            ).name"""
+        )
+        for path in PATHS:
+            result = await measure(client, path, batches, lines, samples)
+            result["migration"] = migration
+            print(json.dumps(result))
+            results.append(result)
+    finally:
+        await client.aclose()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batches", type=int, default=100_000)
+    parser.add_argument("--lines", type=int, default=1_000_000)
+    parser.add_argument("--samples", type=int, default=200)
+    parser.add_argument("--seed", action="store_true", help="insert the data first")
+    args = parser.parse_args()
+    asyncio.run(main(args.batches, args.lines, args.samples, args.seed))
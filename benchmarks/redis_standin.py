@@ -0,0 +1,59 @@
+"""A local stand-in for Redis, enough for PUBLISH.
+
+Speaks RESP over TCP like the real server, so clients pay for the same
+round trips, and answers PUBLISH with no subscribers and everything else
+with OK. It keeps a count of the commands it got::
+
+    async with RedisStandIn() as server:
+        client = redis.from_url(server.url)
+"""
+import asyncio
+
+
+class RedisStandIn:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        self.host = host
+        self.port = port
+        self.commands: dict[str, int] = {}
+        self.server: asyncio.Server | None = None
+
+    @property
+    def url(self) -> str:
+        return f"redis://{self.host}:{self.port}"
+
+    async def __aenter__(self) -> "RedisStandIn":
+        self.server = await asyncio.start_server(self.serve, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        assert self.server is not None
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                command = await read_command(reader)
+                if command is None:
+                    break
+                name = command[0].upper().decode()
+                self.commands[name] = self.commands.get(name, 0) + 1
+                writer.write(b":0\r\n" if name == "PUBLISH" else b"+OK\r\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def read_command(reader: asyncio.StreamReader) -> list[bytes] | None:
+    header = await reader.readline()
+    if not header:
+        return None
+    assert header[:1] == b"*", header
+    arguments = []
+    for _ in range(int(header[1:])):
+        length = int((await reader.readline())[1:])
+        arguments.append((await reader.readexactly(length + 2))[:-2])
+    return arguments
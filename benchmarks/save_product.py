@@ -0,0 +1,168 @@
+"""Round trips and latency of EdgeDBRepository.add.
+
+Compares the single-statement save with the previous one query per batch
+save (a version SELECT, the product upsert, then one query per batch) for
+products with 1, 100 and 10k batches::
+
+    python -m benchmarks.save_product --batches 1 100 10000
+
+Needs the EdgeDB from docker-compose (settings are read as by the app).
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import uuid
+
+import edgedb
+
+from allocation.domain.model import Batch, OrderLine, Product
+from allocation.app.settings import settings
+from allocation.repositories import repository, tracking
+
+
+class CountingClient:
+    """Counts the queries, i.e. the round trips, sent through a client."""
+
+    def __init__(self, client: edgedb.AsyncIOClient) -> None:
+        self.client = client
+        self.round_trips = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not (name.startswith("query") or name == "execute"):
+            return attr
+
+        async def counted(*args, **kwargs):
+            self.round_trips += 1
+            return await attr(*args, **kwargs)
+
+        return counted
+
+
+class PerBatchEdgeDBRepository(repository.EdgeDBRepository):
+    """The save before it became one statement: 2 + N round trips."""
+
+    async def _add(self, product: Product) -> None:
+        changes = tracking.diff(self.snapshots.get(product.sku), product)
+        added: dict[str, list] = {}
+        for ref, line in changes.added:
+            added.setdefault(ref, []).append(line)
+        await self.client.query_single(
+            "SELECT Product { version_number } FILTER .sku = <str>$sku",
+            sku=product.sku,
+        )
+        await self.client.query(
+            """INSERT Product {
+                sku := <str>$sku, version_number := <int16>$version_number
+            }
+            UNLESS CONFLICT ON .sku ELSE (
+                UPDATE Product SET { version_number := <int16>$version_number }
+            )""",
+            sku=product.sku,
+            version_number=product.version_number,
+        )
+        for batch in product.batches:
+            lines = [(batch.reference, line) for line in added.get(batch.reference, [])]
+            await self.client.query(
+                """WITH
+                obj := <json>$data,
+                batch := (INSERT Batch {
+                    reference := <str>obj['reference'],
+                    sku := <str>obj['sku'],
+                    purchased_quantity := <int16>obj['purchased_quantity'],
+                }
+                UNLESS CONFLICT ON .reference ELSE (
+                    UPDATE Batch SET {
+                        purchased_quantity := <int16>obj['purchased_quantity'],
+                    }
+                )),
+                FOR line IN json_array_unpack(obj['allocations']) UNION (
+                    INSERT OrderLine {
+                        orderid := <str>line['orderid'],
+                        sku := <str>line['sku'],
+                        qty := <int16>line['qty'],
+                        allocated_in := batch,
+                    }
+                )""",
+                data=json.dumps(
+                    {
+                        "reference": batch.reference,
+                        "sku": batch.sku,
+                        "purchased_quantity": batch.purchased_quantity,
+                        "allocations": repository.order_lines(lines),
+                    }
+                ),
+            )
+        self.seen.add(product)
+        self.snapshots[product.sku] = tracking.ProductSnapshot.of(product)
+
+
+def make_product(batches: int) -> Product:
+    sku = f"bench-save-{uuid.uuid4().hex[:8]}"
+    return Product(
+        sku=sku,
+        version_number=1,
+        batches=[
+            Batch(f"{sku}-{i}", sku, 1000, eta=None)
+            for i in range(batches)
+        ],
+    )
+
+
+async def measure(client, repository_class, batches: int, allocations: int) -> dict:
+    counting = CountingClient(client)
+    repo = repository_class(counting)
+
+    product = make_product(batches)
+    started = time.perf_counter()
+    await repo.add(product)
+    create_latency = time.perf_counter() - started
+    create_round_trips = counting.round_trips
+
+    latencies, round_trips = [], []
+    for i in range(allocations):
+        product.allocate(OrderLine(orderid=f"order-{i}", sku=product.sku, qty=1))
+        counting.round_trips = 0
+        started = time.perf_counter()
+        await repo.add(product)
+        latencies.append(time.perf_counter() - started)
+        round_trips.append(counting.round_trips)
+
+    return {
+        "repository": repository_class.__name__,
+        "batches": batches,
+        "create_round_trips": create_round_trips,
+        "create_ms": round(create_latency * 1000, 2),
+        "allocate_round_trips": statistics.mean(round_trips),
+        "allocate_ms_p50": round(statistics.median(latencies) * 1000, 2),
+        "allocate_ms_max": round(max(latencies) * 1000, 2),
+    }
+
+
+async def main(batch_counts: list[int], allocations: int) -> list[dict]:
+    client = edgedb.create_async_client(
+        settings.get_edgedb_dsn(test_db=True), tls_security="insecure"
+    )
+    results = []
+    try:
+        for batches in batch_counts:
+            for repository_class in (
+                PerBatchEdgeDBRepository,
+                repository.EdgeDBRepository,
+            ):
+                result = await measure(client, repository_class, batches, allocations)
+                print(json.dumps(result))
+                results.append(result)
+    finally:
+        await client.aclose()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batches", type=int, nargs="+", default=[1, 100, 10_000])
+    parser.add_argument("--allocations", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.batches, args.allocations))
@@ -0,0 +1,231 @@
+"""The domain and service-layer benchmarks, compared with a baseline.
+
+Runs every case on the data of benchmarks/data.py --repeat times, keeps the
+mean of the runs left once the fastest and slowest fifth are dropped, writes
+the results as JSON and compares them with a baseline. A case slower than
+the baseline by more than its tolerance is a regression: they are listed and
+the exit status is 1::
+
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --baseline benchmarks/baseline.json
+    python -m benchmarks.suite --save-baseline benchmarks/baseline.json
+
+Timings depend on the machine, which is saved with the results: comparing
+with a baseline saved on another machine is refused, with exit status 2.
+Each case tolerates what its trimmed mean was seen to vary between runs on
+a shared machine; --tolerance sets one for all of them.
+Runs on the domain model and in memory, no services are needed.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from collections import defaultdict
+from typing import Callable
+from unittest import mock
+
+from allocation import bootstrap
+from allocation.app.settings import settings
+from allocation.domain import commands
+from allocation.domain.model import OrderLine, Product
+from allocation.services import unit_of_work
+from benchmarks import data, pyd_model
+
+
+def allocate(n_batches: int, n_lines: int = 5000) -> float:
+    product = data.product(n_batches)
+    product.batch_index  # built once per loaded product, not per line
+    lines = data.order_lines(n_lines)
+    started = time.perf_counter()
+    for line in lines:
+        product.allocate(line)
+    return (time.perf_counter() - started) / n_lines
+
+
+def change_batch_quantity(n_lines: int) -> float:
+    product = Product(data.SKU, data.batches(1))
+    batch = product.batches[0]
+    batch.purchased_quantity = n_lines
+    for i in range(n_lines):
+        product.allocate(OrderLine(f"order-{i}", data.SKU, 1))
+    started = time.perf_counter()
+    product.change_batch_quantity(batch.reference, 0)
+    elapsed = time.perf_counter() - started
+    assert len(product.events) == 2 * n_lines
+    return elapsed
+
+
+def messagebus_handle(n_commands: int) -> float:
+    uow_factory = unit_of_work.InMemoryUnitOfWorkFactory()
+    bus = bootstrap.Bootstrap(
+        uow_factory=uow_factory,
+        notifications=mock.AsyncMock(),
+        publish=mock.AsyncMock(),
+        allocations_cache=mock.AsyncMock(),
+    ).messagebus
+    # the events' handlers talk to EdgeDB and Redis: the commands' path only
+    bus.event_handlers = defaultdict(list)
+    skus = [f"{data.SKU}-{i}" for i in range(10)]
+
+    async def run() -> float:
+        for sku in skus:
+            await bus.handle(commands.CreateBatch(f"batch-{sku}", sku, n_commands, None))
+        started = time.perf_counter()
+        for i in range(n_commands):
+            await bus.handle(commands.Allocate(f"order-{i}", skus[i % len(skus)], 1))
+        return time.perf_counter() - started
+
+    return asyncio.run(run()) / n_commands
+
+
+def hydrate(n_batches: int, lines_per_batch: int) -> float:
+    obj = data.product_json(n_batches, lines_per_batch)
+    started = time.perf_counter()
+    product = pyd_model.Product.model_validate(obj)
+    elapsed = time.perf_counter() - started
+    assert len(product.batches) == n_batches
+    return elapsed
+
+
+# name -> (a function timing one run in seconds, the unit of the results,
+# the slowdown tolerated before it is a regression)
+CASES: dict[str, tuple[Callable[[], float], str, float]] = {
+    "allocate/batches=10": (lambda: allocate(10), "us_per_line", 0.5),
+    "allocate/batches=1000": (lambda: allocate(1000), "us_per_line", 0.3),
+    "allocate/batches=10000": (lambda: allocate(10_000), "us_per_line", 0.3),
+    "allocate/batches=100000": (lambda: allocate(100_000), "us_per_line", 0.4),
+    "change_batch_quantity/lines=10000": (
+        lambda: change_batch_quantity(10_000),
+        "us_total",
+        0.6,
+    ),
+    "change_batch_quantity/lines=100000": (
+        lambda: change_batch_quantity(100_000),
+        "us_total",
+        0.2,
+    ),
+    "messagebus_handle/allocate": (
+        lambda: messagebus_handle(2000),
+        "us_per_command",
+        0.2,
+    ),
+    "pyd_model_hydration/batches=1000,lines=10": (
+        lambda: hydrate(1000, 10),
+        "us_total",
+        0.2,
+    ),
+    "pyd_model_hydration/batches=1000,lines=100": (
+        lambda: hydrate(1000, 100),
+        "us_total",
+        0.3,
+    ),
+}
+
+
+def machine() -> dict[str, str | int | None]:
+    """What the timings depend on: the Python and the processor."""
+    cpu = platform.processor()
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as f:
+            models = [line for line in f if line.startswith("model name")]
+        if models:
+            cpu = models[0].split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return {
+        "python": f"{platform.python_implementation()} {platform.python_version()}",
+        "arch": platform.machine(),
+        "cpu": cpu,
+        "cpus": os.cpu_count(),
+    }
+
+
+def trimmed_mean(timings: list[float]) -> float:
+    """The mean without the fastest and the slowest fifth of the timings."""
+    cut = len(timings) // 5
+    timings = sorted(timings)
+    return statistics.mean(timings[cut : len(timings) - cut])
+
+
+def run(names: list[str], repeat: int) -> dict:
+    results = {}
+    for name in names:
+        case, unit, tolerance = CASES[name]
+        timings = []
+        for _ in range(repeat):
+            gc.collect()
+            gc.disable()  # a collection in the middle of a run is noise
+            try:
+                timings.append(case())
+            finally:
+                gc.enable()
+        results[name] = {
+            "value": round(trimmed_mean(timings) * 1e6, 3),
+            "unit": unit,
+            "tolerance": tolerance,
+        }
+        print(json.dumps({"case": name, **results[name]}))
+    return {"machine": machine(), "repeat": repeat, "results": results}
+
+
+def regressions(
+    results: dict, baseline: dict, tolerance: float | None = None
+) -> list[str]:
+    """The cases slower than in the baseline by more than their tolerance, or
+    than tolerance if one is given."""
+    found = []
+    for name, result in results["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        limit = result["tolerance"] if tolerance is None else tolerance
+        if result["value"] > base["value"] * (1 + limit):
+            found.append(
+                f"{name}: {result['value']} {result['unit']}, "
+                f"baseline {base['value']} (+{result['value'] / base['value'] - 1:.0%})"
+            )
+    return found
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cases", nargs="+", choices=CASES, default=list(CASES))
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--output", help="write the results here")
+    parser.add_argument("--baseline", help="compare with the results saved here")
+    parser.add_argument("--tolerance", type=float, help="instead of each case's own")
+    parser.add_argument("--save-baseline", help="write the results as a baseline")
+    args = parser.parse_args(argv)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("machine") != machine():
+            print(
+                f"The baseline was saved on {baseline.get('machine')}, "
+                f"not on this machine: {machine()}",
+                file=sys.stderr,
+            )
+            return 2
+    results = run(args.cases, args.repeat)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2)
+                f.write("\n")
+    if not args.baseline:
+        return 0
+    found = regressions(results, baseline, args.tolerance)
+    for regression in found:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    return 1 if found else 0
+
+
+if __name__ == "__main__":
+    settings.allocate_group_commit = False  # one command at a time anyway
+    sys.exit(main())
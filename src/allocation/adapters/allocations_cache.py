@@ -0,0 +1,166 @@
+# pylint: disable=too-few-public-methods
+import abc
+import json
+import logging
+import time
+from collections import OrderedDict
+
+import redis.asyncio as redis
+from redis.exceptions import RedisError
+
+from allocation.app.settings import settings
+
+logger = logging.getLogger(__name__)
+
+Allocations = list[dict[str, str]]
+
+
+class AbstractAllocationsCache(abc.ABC):
+    """The allocations view of an order, as read from EdgeDB, by orderid.
+
+    A reader takes the generation of the order before it queries the view
+    and sets the view with it: every invalidate moves the generation on, so
+    a view read before an allocation changed is not cached after it.
+    """
+
+    @abc.abstractmethod
+    async def get(self, orderid: str) -> Allocations | None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def generation(self, orderid: str) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def set(self, orderid: str, allocations: Allocations, generation: int) -> None:
+        """Cache the view, unless the order was invalidated since generation."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def invalidate(self, orderid: str) -> None:
+        raise NotImplementedError
+
+
+class InMemoryAllocationsCache(AbstractAllocationsCache):
+    """Stands in for Redis in tests, and for a single process without Redis.
+
+    Entries expire after a ttl like those of Redis, and the least recently
+    used are evicted beyond max_entries. Generations come from one counter,
+    so that forgetting the ones of old orders cannot repeat a generation:
+    a forgotten order is at the highest generation forgotten.
+    """
+
+    def __init__(self, ttl: float = 300, max_entries: int = 10_000) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.allocations: OrderedDict[str, tuple[float, Allocations]] = OrderedDict()
+        self.generations: OrderedDict[str, int] = OrderedDict()
+        self.invalidations = 0
+        self.forgotten = 0
+
+    async def get(self, orderid: str) -> Allocations | None:
+        entry = self.allocations.get(orderid)
+        if entry is None:
+            return None
+        expires, allocations = entry
+        if expires <= time.monotonic():
+            del self.allocations[orderid]
+            return None
+        self.allocations.move_to_end(orderid)
+        return allocations
+
+    async def generation(self, orderid: str) -> int:
+        return self.generations.get(orderid, self.forgotten)
+
+    async def set(self, orderid: str, allocations: Allocations, generation: int) -> None:
+        if await self.generation(orderid) != generation:
+            return
+        self.allocations[orderid] = (time.monotonic() + self.ttl, allocations)
+        self.allocations.move_to_end(orderid)
+        while len(self.allocations) > self.max_entries:
+            self.allocations.popitem(last=False)
+
+    async def invalidate(self, orderid: str) -> None:
+        self.allocations.pop(orderid, None)
+        self.invalidations += 1
+        self.generations[orderid] = self.invalidations
+        self.generations.move_to_end(orderid)
+        while len(self.generations) > self.max_entries:
+            _, self.forgotten = self.generations.popitem(last=False)
+
+
+# sets the view only while the generation of the order is the one read before
+# the view was queried
+SET_IF_GENERATION = """
+if (redis.call('GET', KEYS[2]) or '0') == ARGV[1] then
+    return redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+end
+return false
+"""
+
+
+class RedisAllocationsCache(AbstractAllocationsCache):
+    """Shared by every process of the service.
+
+    Entries expire after a ttl, and so do the generations of the orders not
+    invalidated for as long. When Redis is down, the view is read from EdgeDB.
+    """
+
+    def __init__(self, client: redis.Redis, ttl: int = 300) -> None:
+        self.client = client
+        self.ttl = ttl
+        self.set_if_generation = client.register_script(SET_IF_GENERATION)
+
+    @staticmethod
+    def key(orderid: str) -> str:
+        return f"allocations:{orderid}"
+
+    @staticmethod
+    def generation_key(orderid: str) -> str:
+        return f"allocations-generation:{orderid}"
+
+    async def get(self, orderid: str) -> Allocations | None:
+        try:
+            cached = await self.client.get(self.key(orderid))
+        except RedisError:
+            logger.warning("allocations cache unavailable", exc_info=True)
+            return None
+        return None if cached is None else json.loads(cached)
+
+    async def generation(self, orderid: str) -> int:
+        try:
+            generation = await self.client.get(self.generation_key(orderid))
+        except RedisError:
+            logger.warning("allocations cache unavailable", exc_info=True)
+            return -1  # matches no generation, the view is not cached
+        return int(generation or 0)
+
+    async def set(self, orderid: str, allocations: Allocations, generation: int) -> None:
+        try:
+            await self.set_if_generation(
+                keys=[self.key(orderid), self.generation_key(orderid)],
+                args=[generation, json.dumps(allocations), self.ttl],
+            )
+        except RedisError:
+            logger.warning("allocations cache unavailable", exc_info=True)
+
+    async def invalidate(self, orderid: str) -> None:
+        try:
+            pipeline = self.client.pipeline(transaction=True)
+            pipeline.incr(self.generation_key(orderid))
+            # outlives the readers of the order, however slow
+            pipeline.expire(self.generation_key(orderid), 2 * self.ttl)
+            pipeline.delete(self.key(orderid))
+            await pipeline.execute()
+        except RedisError:
+            logger.warning("allocations cache unavailable", exc_info=True)
+
+
+def from_settings() -> AbstractAllocationsCache:
+    if settings.allocations_cache == "memory":
+        return InMemoryAllocationsCache(
+            settings.allocations_cache_ttl, settings.allocations_cache_size
+        )
+    return RedisAllocationsCache(
+        redis.from_url(settings.get_redis_url()), ttl=settings.allocations_cache_ttl
+    )
@@ -0,0 +1,251 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import socket
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable
+
+import redis.asyncio as redis
+from redis.exceptions import RedisError, ResponseError
+
+from allocation import metrics
+
+logger = logging.getLogger(__name__)
+
+Fields = dict[bytes, bytes]
+Message = tuple[bytes, Fields]
+Job = Callable[[], Awaitable[object]]
+
+
+@dataclass
+class StreamStats:
+    read: int = 0
+    handled: int = 0
+    failed: int = 0
+    reclaimed: int = 0
+    dead_lettered: int = 0
+
+
+stats = StreamStats()
+
+metrics.export_stats(
+    "allocation_command_stream",
+    lambda: [stats],
+    counters={
+        "read": "Entries read from the command stream.",
+        "handled": "Entries of the command stream handled and acknowledged.",
+        "failed": "Entries of the command stream whose handler failed.",
+        "reclaimed": "Entries claimed from consumers that stalled.",
+        "dead_lettered": "Entries moved to the dead-letter stream.",
+    },
+)
+backlog = metrics.Gauge(
+    "allocation_command_stream_backlog",
+    "Entries of the command stream not yet delivered (lag) or not yet acknowledged "
+    "(pending), and the consumers of the group.",
+    labels=("kind",),
+)
+
+
+def default_consumer_name() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+async def add_command(
+    client: redis.Redis, stream: str, data: dict[str, Any], maxlen: int | None = None
+) -> bytes:
+    """Append a command to the stream, as external systems do."""
+    return await client.xadd(
+        stream, {"data": json.dumps(data)}, maxlen=maxlen, approximate=True
+    )
+
+
+async def group_info(client: redis.Redis, stream: str, group: str) -> dict[str, int]:
+    """How far the group is behind: entries not read yet and not acknowledged."""
+    try:
+        groups = await client.xinfo_groups(stream)
+    except ResponseError:  # no stream yet
+        groups = []
+    for info in groups:
+        if info["name"] in (group, group.encode()):
+            return {
+                "consumers": info["consumers"],
+                "pending": info["pending"],
+                "lag": info.get("lag") or 0,
+            }
+    return {"consumers": 0, "pending": 0, "lag": 0}
+
+
+class CommandStreamConsumer:
+    """One consumer of a group reading commands from a Redis stream.
+
+    Consumers of the same group share the entries of the stream. An entry is
+    acknowledged once handled; one that is not, because its handler failed or
+    its consumer died, stays pending and is claimed again after claim_idle_ms
+    by any consumer of the group. An entry delivered max_deliveries times is
+    moved to the "<stream>:dead" stream and acknowledged.
+
+    With submit, as of a worker pool, the entries of a batch are handled on
+    its workers, those with the same value of the partition_key field of
+    their data in order, and the batch is acknowledged when all of them are
+    done. An entry whose data has no such field is dead-lettered at once.
+    """
+
+    def __init__(
+        self,
+        client: redis.Redis,
+        stream: str,
+        group: str,
+        handle: Callable[[Fields], Awaitable[Any]],
+        consumer: str | None = None,
+        batch_size: int = 100,
+        block_ms: int = 1000,
+        claim_idle_ms: int = 60_000,
+        max_deliveries: int = 5,
+        submit: Callable[[str, Job], Awaitable[asyncio.Future]] | None = None,
+        partition_key: str | None = None,
+    ) -> None:
+        self.client = client
+        self.stream = stream
+        self.group = group
+        self.handle = handle
+        self.consumer = consumer or default_consumer_name()
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.max_deliveries = max_deliveries
+        self.submit = submit
+        self.partition_key = partition_key
+
+    async def ensure_group(self) -> None:
+        try:
+            await self.client.xgroup_create(
+                self.stream, self.group, id="0", mkstream=True
+            )
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def read_batch(self) -> list[Message]:
+        """New entries for this consumer, waiting up to block_ms for them."""
+        response = await self.client.xreadgroup(
+            self.group,
+            self.consumer,
+            {self.stream: ">"},
+            count=self.batch_size,
+            block=self.block_ms,
+        )
+        messages = [message for _, entries in response for message in entries]
+        stats.read += len(messages)
+        return messages
+
+    async def reclaim(self) -> list[Message]:
+        """Claim the entries left pending by others for longer than claim_idle_ms."""
+        claimed: list[Message] = []
+        start = "0-0"
+        while True:
+            start, messages, *_ = await self.client.xautoclaim(
+                self.stream,
+                self.group,
+                self.consumer,
+                min_idle_time=self.claim_idle_ms,
+                start_id=start,
+                count=self.batch_size,
+            )
+            # entries deleted from the stream come back as None
+            claimed.extend(message for message in messages if message[1] is not None)
+            if start in (b"0-0", "0-0"):
+                break
+        stats.reclaimed += len(claimed)
+        return await self.dead_letter(claimed)
+
+    async def dead_letter(self, claimed: list[Message]) -> list[Message]:
+        """Move the entries delivered too many times away, return the others."""
+        if not claimed:
+            return claimed
+        # one entry at a time: a range could hold other pending entries too
+        pipeline = self.client.pipeline(transaction=False)
+        for message_id, _ in claimed:
+            pipeline.xpending_range(
+                self.stream, self.group, min=message_id, max=message_id, count=1
+            )
+        deliveries = {
+            entry["message_id"]: entry["times_delivered"]
+            for pending in await pipeline.execute()
+            for entry in pending
+        }
+        dead = [m for m in claimed if deliveries.get(m[0], 0) > self.max_deliveries]
+        if dead:
+            logger.error(f"Giving up on {len(dead)} entries of {self.stream}")
+            await self.bury(dead)
+        return [message for message in claimed if message not in dead]
+
+    async def bury(self, messages: list[Message]) -> None:
+        """Move the entries to the dead stream and acknowledge them."""
+        pipeline = self.client.pipeline(transaction=True)
+        for _, fields in messages:
+            pipeline.xadd(f"{self.stream}:dead", fields)
+        pipeline.xack(self.stream, self.group, *(message[0] for message in messages))
+        await pipeline.execute()
+        stats.dead_lettered += len(messages)
+
+    def key_of(self, message: Message) -> str | None:
+        """The partition of the entry, None if its data cannot tell."""
+        try:
+            return str(json.loads(message[1][b"data"])[self.partition_key])
+        except (KeyError, TypeError, ValueError):
+            logger.error(f"Malformed {self.stream} entry {message[0].decode()}")
+            return None
+
+    async def process(self, messages: list[Message]) -> int:
+        """Handle the entries, acknowledge the handled ones together."""
+        if self.submit is not None and self.partition_key is not None:
+            keys = [self.key_of(message) for message in messages]
+            malformed = [m for m, key in zip(messages, keys) if key is None]
+            if malformed:
+                await self.bury(malformed)
+            keyed = [(m, key) for m, key in zip(messages, keys) if key is not None]
+            messages = [message for message, _ in keyed]
+            done = [
+                await self.submit(key, functools.partial(self.handle, message[1]))
+                for message, key in keyed
+            ]
+            succeeded = await asyncio.gather(*done)
+        else:
+            succeeded = [await self.handle_one(*message) for message in messages]
+        handled = [message[0] for message, ok in zip(messages, succeeded) if ok]
+        stats.failed += len(messages) - len(handled)
+        if handled:
+            await self.client.xack(self.stream, self.group, *handled)
+            stats.handled += len(handled)
+        return len(handled)
+
+    async def handle_one(self, message_id: bytes, fields: Fields) -> bool:
+        try:
+            await self.handle(fields)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception(
+                f"Exception handling {self.stream} entry {message_id.decode()}"
+            )
+            return False
+        return True
+
+    async def run(self, claim_interval: float = 10.0) -> None:
+        await self.ensure_group()
+        loop = asyncio.get_running_loop()
+        next_claim = loop.time()
+        while True:
+            try:
+                if loop.time() >= next_claim:
+                    next_claim = loop.time() + claim_interval
+                    await self.process(await self.reclaim())
+                    info = await group_info(self.client, self.stream, self.group)
+                    logger.info(f"{self.stream} group {self.group}: {info}")
+                    for kind, value in info.items():
+                        backlog.set(value, kind)
+                await self.process(await self.read_batch())
+            except RedisError:
+                logger.exception("Reading the command stream failed, retrying")
+                await asyncio.sleep(1)
@@ -1,29 +1,119 @@
 # pylint: disable=too-few-public-methods
 import abc
+import asyncio
+import logging
+from collections import Counter
 
 import aiosmtplib
 
+from allocation import metrics
 from allocation.app.settings import settings
 
+logger = logging.getLogger(__name__)
+
+send_seconds = metrics.Histogram(
+    "allocation_notification_send_seconds",
+    "Time to hand a notification or a digest to the SMTP server, "
+    "waiting for the connection and connecting included.",
+)
+
 
 class AbstractNotifications(abc.ABC):
     @abc.abstractmethod
     async def send(self, destination, message):
         raise NotImplementedError
 
+    async def aclose(self):
+        """Send what is held back and release the connections."""
+
 
 DEFAULT_HOST = settings.get_email_host_and_port()["host"]
 DEFAULT_PORT = settings.get_email_host_and_port()["port"]
+FROM_ADDR = "allocations@example.com"
 
 
 class EmailNotifications(AbstractNotifications):
+    """Sends every message over one SMTP connection, reconnecting once it drops."""
+
     def __init__(self, smtp_host=DEFAULT_HOST, port=DEFAULT_PORT):
         self.server = aiosmtplib.SMTP(smtp_host, port=port)
+        self.lock = asyncio.Lock()  # one transaction at a time on the connection
 
     async def send(self, destination, message):
         msg = f"Subject: allocation service notification\n{message}"
-        await self.server.sendmail(
-            from_addr="allocations@example.com",
-            to_addrs=[destination],
-            msg=msg,
-        )
+        await self.sendmail(destination, msg)
+
+    async def sendmail(self, destination, msg):
+        with send_seconds.time():
+            await self._sendmail(destination, msg)
+
+    async def _sendmail(self, destination, msg):
+        async with self.lock:
+            for attempt in (1, 2):
+                try:
+                    if not self.server.is_connected:
+                        await self.server.connect()
+                    await self.server.sendmail(FROM_ADDR, [destination], msg)
+                    return
+                except (aiosmtplib.SMTPServerDisconnected, ConnectionError):
+                    self.server.close()
+                    if attempt == 2:
+                        raise
+                    logger.warning("SMTP connection lost, reconnecting")
+
+    async def aclose(self):
+        async with self.lock:
+            if self.server.is_connected:
+                try:
+                    await self.server.quit()
+                except aiosmtplib.SMTPException:
+                    self.server.close()
+
+
+class DigestEmailNotifications(EmailNotifications):
+    """Holds messages back for a window and sends one digest per destination.
+
+    The same message, such as the out of stock notice of one SKU, is listed
+    once in a digest however many times it was sent during the window.
+    """
+
+    def __init__(self, smtp_host=DEFAULT_HOST, port=DEFAULT_PORT, window=60.0):
+        super().__init__(smtp_host, port)
+        self.window = window
+        self.pending: dict[str, Counter[str]] = {}
+        self.flusher: asyncio.Task | None = None
+
+    async def send(self, destination, message):
+        self.pending.setdefault(destination, Counter())[message] += 1
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(self.window)
+        await self.flush()
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        for destination, messages in pending.items():
+            lines = [
+                message if count == 1 else f"{message} ({count} times)"
+                for message, count in messages.items()
+            ]
+            msg = "Subject: allocation service notifications\n" + "\n".join(lines)
+            try:
+                await self.sendmail(destination, msg)
+            except (aiosmtplib.SMTPException, OSError):
+                logger.exception(f"Failed to send a digest to {destination}")
+
+    async def aclose(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+            await asyncio.gather(self.flusher, return_exceptions=True)
+        await self.flush()
+        await super().aclose()
+
+
+def from_settings() -> AbstractNotifications:
+    if settings.notifications == "digest":
+        return DigestEmailNotifications(window=settings.notification_window)
+    return EmailNotifications()
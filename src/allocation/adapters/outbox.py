@@ -0,0 +1,125 @@
+import asyncio
+import json
+import logging
+import time
+from dataclasses import asdict
+from datetime import timedelta
+from typing import Iterable
+
+import edgedb
+import redis.asyncio as redis
+from redis.exceptions import RedisError
+
+from allocation.domain import commands, events
+
+logger = logging.getLogger(__name__)
+
+# the events that leave the service, and the Redis channels they go to
+CHANNELS: dict[type[events.Event], str] = {
+    events.Allocated: "line_allocated",
+}
+
+UNSENT_MESSAGES = """
+    SELECT OutboxMessage { channel, payload }
+    FILTER NOT EXISTS .sent_at
+    ORDER BY .created_at
+    LIMIT <int64>$limit
+"""
+MARK_SENT = """
+    UPDATE OutboxMessage
+    FILTER .id IN array_unpack(<array<uuid>>$ids)
+    SET { sent_at := datetime_current() }
+"""
+PURGE_SENT = """
+    SELECT count((
+        DELETE (
+            SELECT OutboxMessage
+            FILTER .sent_at < datetime_current() - <duration>$retention
+            LIMIT <int64>$limit
+        )
+    ))
+"""
+
+
+def messages(
+    new_events: Iterable[events.Event | commands.Command],
+) -> list[dict[str, str]]:
+    """The outbox messages of the events that are published, as products
+    raise commands too."""
+    return [
+        {"channel": CHANNELS[type(event)], "payload": json.dumps(asdict(event))}
+        for event in new_events
+        if isinstance(event, events.Event) and type(event) in CHANNELS
+    ]
+
+
+class OutboxRelay:
+    """Publishes the outbox to Redis in batches, one pipeline per batch.
+
+    A batch is marked sent in the transaction it was read in, after Redis took
+    it: a message is published at least once, twice if that transaction fails.
+    Every purge_interval seconds, the messages sent more than retention
+    seconds ago are deleted.
+    """
+
+    def __init__(
+        self,
+        client: edgedb.AsyncIOClient,
+        redis_client: redis.Redis,
+        batch_size: int = 500,
+        poll_interval: float = 0.1,
+        retention: float = 3600.0,
+        purge_interval: float = 60.0,
+    ) -> None:
+        self.client = client
+        self.redis = redis_client
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.purge_interval = purge_interval
+        self.sent = 0
+        self.purged = 0
+
+    async def relay_batch(self) -> int:
+        """Publish the oldest unsent messages, return how many there were."""
+        async for tx in self.client.transaction():
+            async with tx:
+                batch = await tx.query(UNSENT_MESSAGES, limit=self.batch_size)
+                if batch:
+                    pipeline = self.redis.pipeline(transaction=False)
+                    for message in batch:
+                        pipeline.publish(message.channel, message.payload)
+                    await pipeline.execute()
+                    await tx.execute(MARK_SENT, ids=[message.id for message in batch])
+        self.sent += len(batch)
+        return len(batch)
+
+    async def purge_sent(self) -> int:
+        """Delete the messages sent before the retention, in batches so that
+        no transaction grows with the backlog; return how many there were."""
+        purged = 0
+        while True:
+            deleted = await self.client.query_single(
+                PURGE_SENT,
+                retention=timedelta(seconds=self.retention),
+                limit=self.batch_size,
+            )
+            purged += deleted
+            if deleted < self.batch_size:
+                break
+        self.purged += purged
+        return purged
+
+    async def run(self) -> None:
+        purged_at = time.monotonic()
+        while True:
+            try:
+                relayed = await self.relay_batch()
+                if time.monotonic() - purged_at >= self.purge_interval:
+                    purged_at = time.monotonic()
+                    await self.purge_sent()
+            except (edgedb.EdgeDBError, RedisError):
+                logger.exception("Outbox relay failed, retrying")
+                relayed = 0
+            if relayed < self.batch_size:
+                await asyncio.sleep(self.poll_interval)
@@ -1,9 +1,13 @@
+import asyncio
 import json
 import logging
-from dataclasses import asdict
+import time
+from dataclasses import asdict, dataclass
+from typing import Awaitable, Callable
 
 import redis.asyncio as redis
 
+from allocation import metrics
 from allocation.app.settings import settings
 from allocation.domain import events
 
@@ -11,7 +15,147 @@ logger = logging.getLogger(__name__)
 
 r = redis.from_url(settings.get_redis_url())
 
+publish_seconds = metrics.Histogram(
+    "allocation_redis_publish_seconds",
+    "Round trips publishing events to Redis: an event each when direct, "
+    "a pipelined batch each when buffered.",
+    ("mode",),
+)
+
 
 async def publish(channel, event: events.Event):
     logging.debug(f"publishing: channel={channel}, event={event}")
-    await r.publish(channel, json.dumps(asdict(event)))
+    with publish_seconds.time("direct"):
+        await r.publish(channel, json.dumps(asdict(event)))
+
+
+@dataclass
+class PublisherStats:
+    flushes: int = 0
+    published: int = 0
+    failed: int = 0
+    max_flush_size: int = 0
+    flush_seconds: float = 0.0
+    max_flush_seconds: float = 0.0
+    buffered: int = 0
+
+
+class BufferedPublisher:
+    """Publishes events in batches, one Redis pipeline per batch.
+
+    publish only buffers the event. A batch is flushed when it has batch_size
+    events or when its first event has waited for linger seconds. While
+    max_buffered events wait, publish waits for room: a slow Redis slows the
+    publishers down instead of filling the memory.
+    """
+
+    def __init__(
+        self,
+        client: redis.Redis,
+        batch_size: int = 100,
+        linger: float = 0.002,
+        max_buffered: int = 10_000,
+    ) -> None:
+        self.client = client
+        self.batch_size = batch_size
+        self.linger = linger
+        self.buffer: asyncio.Queue[tuple[str, events.Event]] = asyncio.Queue(max_buffered)
+        self.flusher: asyncio.Task | None = None
+        self.stats = PublisherStats()
+
+    async def publish(self, channel: str, event: events.Event) -> None:
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self.flush_forever())
+        await self.buffer.put((channel, event))
+
+    async def flush_forever(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.buffer.get()]
+            deadline = loop.time() + self.linger
+            while len(batch) < self.batch_size:
+                if not self.buffer.empty():
+                    batch.append(self.buffer.get_nowait())
+                    continue
+                try:
+                    item = await asyncio.wait_for(
+                        self.buffer.get(), timeout=deadline - loop.time()
+                    )
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+            try:
+                await self.flush(batch)
+            except Exception:  # pylint: disable=broad-except
+                # the flusher must outlive any batch, or aclose waits forever
+                logger.exception(f"Flushing {len(batch)} events failed")
+
+    async def flush(self, batch: list[tuple[str, events.Event]]) -> None:
+        started = time.perf_counter()
+        try:
+            pipeline = self.client.pipeline(transaction=False)
+            for channel, event in batch:
+                pipeline.publish(channel, json.dumps(asdict(event)))
+            with publish_seconds.time("buffered"):
+                await pipeline.execute()
+            self.stats.published += len(batch)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception(f"Failed to publish {len(batch)} events")
+            self.stats.failed += len(batch)
+        finally:
+            for _ in batch:
+                self.buffer.task_done()
+        elapsed = time.perf_counter() - started
+        self.stats.flushes += 1
+        self.stats.max_flush_size = max(self.stats.max_flush_size, len(batch))
+        self.stats.flush_seconds += elapsed
+        self.stats.max_flush_seconds = max(self.stats.max_flush_seconds, elapsed)
+        self.stats.buffered = self.buffer.qsize()
+
+    async def aclose(self, timeout: float = 5.0) -> None:
+        """Flush what is buffered and stop, dropping what is left after timeout
+        seconds."""
+        if self.flusher is None:
+            return
+        try:
+            await asyncio.wait_for(self.buffer.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(
+                f"Dropping {self.buffer.qsize()} events not published in {timeout}s"
+            )
+        self.flusher.cancel()
+        self.flusher = None
+
+
+buffered = BufferedPublisher(
+    r,
+    batch_size=settings.publisher_batch_size,
+    linger=settings.publisher_linger,
+    max_buffered=settings.publisher_max_buffered,
+)
+
+buffered_events = metrics.Gauge(
+    "allocation_publisher_buffered_events",
+    "Events waiting in the buffered publisher.",
+    collect=lambda: [((), buffered.buffer.qsize())],
+)
+metrics.export_stats(
+    "allocation_publisher",
+    lambda: [buffered.stats],
+    counters={
+        "flushes": "Flushes of the buffered publisher.",
+        "published": "Events the buffered publisher sent.",
+        "failed": "Events the buffered publisher could not send.",
+        "flush_seconds": "Seconds the buffered publisher spent flushing.",
+    },
+    gauges={
+        "max_flush_size": "Events in the largest flush so far.",
+        "max_flush_seconds": "Seconds the slowest flush so far took.",
+    },
+)
+
+
+def get_publish() -> Callable[[str, events.Event], Awaitable[None]]:
+    if settings.event_publisher == "buffered":
+        return buffered.publish
+    return publish
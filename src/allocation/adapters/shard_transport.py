@@ -0,0 +1,157 @@
+import abc
+import asyncio
+import json
+import logging
+import time
+import uuid
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+import redis.asyncio as redis
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+Message = dict[str, Any]
+Reply = Callable[[Message], Awaitable[None]]
+
+
+class ShardUnavailable(Exception):
+    pass
+
+
+class AbstractShardTransport(abc.ABC):
+    """Carries commands from the router to a shard worker, and the reply back."""
+
+    @abc.abstractmethod
+    async def request(self, worker: str, message: Message) -> Message:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def requests(self, worker: str) -> AsyncIterator[tuple[Message, Reply]]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def join(self, worker: str) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def leave(self, worker: str) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def members(self) -> set[str]:
+        raise NotImplementedError
+
+
+class LocalShardTransport(AbstractShardTransport):
+    """Workers in the same process, each with a bounded queue."""
+
+    def __init__(self, queue_size: int = 1000) -> None:
+        self.queue_size = queue_size
+        self.queues: dict[str, asyncio.Queue[tuple[Message, asyncio.Future]]] = {}
+
+    async def request(self, worker: str, message: Message) -> Message:
+        queue = self.queues.get(worker)
+        if queue is None:
+            raise ShardUnavailable(f"shard worker {worker} is not up")
+        done = asyncio.get_running_loop().create_future()
+        await queue.put((message, done))
+        return await done
+
+    async def requests(self, worker: str) -> AsyncIterator[tuple[Message, Reply]]:
+        queue = self.queues[worker]
+        while True:
+            message, done = await queue.get()
+
+            async def reply(result: Message, done: asyncio.Future = done) -> None:
+                if not done.done():
+                    done.set_result(result)
+
+            yield message, reply
+
+    async def join(self, worker: str) -> None:
+        self.queues.setdefault(worker, asyncio.Queue(self.queue_size))
+
+    async def leave(self, worker: str) -> None:
+        queue = self.queues.pop(worker, None)
+        while queue is not None and not queue.empty():
+            _, done = queue.get_nowait()
+            done.set_exception(ShardUnavailable(f"shard worker {worker} left"))
+
+    async def members(self) -> set[str]:
+        return set(self.queues)
+
+
+class RedisShardTransport(AbstractShardTransport):
+    """Workers in other processes, with an inbox list each in Redis.
+
+    Workers announce themselves with a heartbeat in a sorted set; one that
+    missed its heartbeats for heartbeat_ttl seconds is no longer a member.
+    Replies come back on a list of their own, one per request.
+    """
+
+    WORKERS = "shard:workers"
+
+    def __init__(
+        self,
+        client: redis.Redis,
+        heartbeat_ttl: float = 5.0,
+        request_timeout: float = 30.0,
+    ) -> None:
+        self.client = client
+        self.heartbeat_ttl = heartbeat_ttl
+        self.request_timeout = request_timeout
+        self.heartbeats: dict[str, asyncio.Task] = {}
+
+    @staticmethod
+    def inbox(worker: str) -> str:
+        return f"shard:inbox:{worker}"
+
+    async def request(self, worker: str, message: Message) -> Message:
+        reply_to = f"shard:reply:{uuid.uuid4().hex}"
+        await self.client.lpush(
+            self.inbox(worker), json.dumps({"reply_to": reply_to, "message": message})
+        )
+        response = await self.client.blpop([reply_to], timeout=self.request_timeout)
+        if response is None:
+            raise ShardUnavailable(f"shard worker {worker} did not reply")
+        return json.loads(response[1])
+
+    async def requests(self, worker: str) -> AsyncIterator[tuple[Message, Reply]]:
+        while True:
+            popped = await self.client.brpop([self.inbox(worker)], timeout=1)
+            if popped is None:
+                continue
+            request = json.loads(popped[1])
+
+            async def reply(result: Message, reply_to: str = request["reply_to"]) -> None:
+                pipeline = self.client.pipeline(transaction=True)
+                pipeline.lpush(reply_to, json.dumps(result))
+                pipeline.expire(reply_to, int(self.request_timeout) + 1)
+                await pipeline.execute()
+
+            yield request["message"], reply
+
+    async def heartbeat(self, worker: str) -> None:
+        while True:
+            try:
+                await self.client.zadd(self.WORKERS, {worker: time.time()})
+            except RedisError:
+                logger.warning(f"heartbeat of {worker} failed", exc_info=True)
+            await asyncio.sleep(self.heartbeat_ttl / 3)
+
+    async def join(self, worker: str) -> None:
+        await self.client.zadd(self.WORKERS, {worker: time.time()})
+        self.heartbeats[worker] = asyncio.create_task(self.heartbeat(worker))
+
+    async def leave(self, worker: str) -> None:
+        heartbeat = self.heartbeats.pop(worker, None)
+        if heartbeat is not None:
+            heartbeat.cancel()
+        await self.client.zrem(self.WORKERS, worker)
+
+    async def members(self) -> set[str]:
+        alive = await self.client.zrangebyscore(
+            self.WORKERS, time.time() - self.heartbeat_ttl, "+inf"
+        )
+        return {w.decode() if isinstance(w, bytes) else w for w in alive}
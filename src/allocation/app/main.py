@@ -1,12 +1,14 @@
 import functools
 from http import HTTPStatus
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 from starlette.middleware.cors import CORSMiddleware
 
-from allocation import bootstrap, views
+from allocation import bootstrap, metrics, views
+from allocation.adapters import shard_transport
 from allocation.domain import commands
-from allocation.services import handlers
+from allocation.services import handlers, sharding
 
 
 def make_app(test_db: bool = False):
@@ -24,28 +26,50 @@ def make_app(test_db: bool = False):
         allow_headers=["*"],
     )
 
+    async def shard_unavailable(request: Request, exc: Exception) -> JSONResponse:
+        return JSONResponse(
+            {"detail": str(exc)}, status_code=HTTPStatus.SERVICE_UNAVAILABLE
+        )
+
+    app.exception_handler(sharding.ShardError)(shard_unavailable)
+    app.exception_handler(shard_transport.ShardUnavailable)(shard_unavailable)
+
     @app.get("/health_check")
     async def health_check() -> dict[str, str]:
         return {"status": "Ok"}
 
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def metrics_endpoint() -> PlainTextResponse:
+        return PlainTextResponse(
+            metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4"
+        )
+
     @app.post("/add_batch", status_code=HTTPStatus.CREATED)
     async def add_batch(batch: commands.CreateBatch) -> dict[str, str]:
         # if batch.eta is not None:  # TODO: вынести в валидаторы
         #     batch.eta = datetime.datetime.fromisoformat(batch.eta).date()
-        await messagebus.handle(batch)
+        await bootstrap.bootstrap.handle(batch)
         return {"status": "Ok"}
 
     @app.post("/allocate", status_code=HTTPStatus.ACCEPTED)
     async def allocate_endpoint(line: commands.Allocate) -> dict[str, str]:
         try:
-            await messagebus.handle(line)
+            await bootstrap.bootstrap.handle(line)
         except handlers.InvalidSku as e:
             raise HTTPException(HTTPStatus.BAD_REQUEST, detail=e.args[0])
         return {"status": "Ok"}
 
+    @app.post("/allocate/bulk", status_code=HTTPStatus.OK)
+    async def allocate_bulk_endpoint(
+        cmd: commands.AllocateMany,
+    ) -> list[handlers.AllocationResult]:
+        return await bootstrap.bootstrap.handle(cmd)
+
     @app.get("/allocations/{orderid}", status_code=HTTPStatus.OK)
     async def allocations_view_endpoint(orderid: str):
-        result = await views.allocations(orderid, messagebus.uow)
+        result = await views.allocations(
+            orderid, messagebus.uow_factory(), bootstrap.bootstrap.allocations_cache
+        )
         if not result:
             raise HTTPException(HTTPStatus.NOT_FOUND, detail="not found")
         return result
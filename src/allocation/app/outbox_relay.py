@@ -0,0 +1,27 @@
+import asyncio
+import logging
+
+import redis.asyncio as redis
+
+from allocation.adapters import outbox
+from allocation.app.settings import settings
+from allocation.bootstrap import get_pull_connection_edgedb
+
+logger = logging.getLogger(__name__)
+
+
+async def relay_loop():
+    logger.info("Outbox relay starting")
+    relay = outbox.OutboxRelay(
+        get_pull_connection_edgedb(),
+        redis.from_url(settings.get_redis_url()),
+        batch_size=settings.outbox_batch_size,
+        poll_interval=settings.outbox_poll_interval,
+        retention=settings.outbox_retention,
+        purge_interval=settings.outbox_purge_interval,
+    )
+    await relay.run()
+
+
+if __name__ == "__main__":
+    asyncio.run(relay_loop())
@@ -1,31 +1,78 @@
 import asyncio
+import functools
 import json
 import logging
 
 import redis.asyncio as redis
 
+from allocation import metrics
+from allocation.adapters import command_stream
 from allocation.app.settings import settings
 from allocation.bootstrap import bootstrap
 from allocation.domain import commands
+from allocation.services.worker_pool import PartitionedWorkerPool
 
 logger = logging.getLogger(__name__)
 
 r = redis.from_url(settings.get_redis_url())
 
 
+def get_worker_pool() -> PartitionedWorkerPool:
+    return PartitionedWorkerPool(
+        workers=settings.consumer_workers,
+        queue_size=settings.consumer_partition_queue_size,
+    )
+
+
 async def consumer_loop():
+    if settings.metrics_port:
+        await metrics.serve("0.0.0.0", settings.metrics_port)
+    if settings.command_channel == "streams":
+        await stream_consumer_loop()
+        return
     logger.info("Redis pubsub starting")
     messagebus = bootstrap.messagebus
+    pool = get_worker_pool()
     pubsub = r.pubsub(ignore_subscribe_messages=True)
     await pubsub.subscribe("change_batch_quantity")
 
     async for m in pubsub.listen():
-        await handle_change_batch_quantity(m, messagebus)
+        try:
+            data = json.loads(m["data"])
+            batchref = str(data["batchref"])
+        except (KeyError, TypeError, ValueError):
+            logger.error(f"Skipping a malformed command {m['data']!r}")
+            continue
+        await pool.submit(
+            batchref,
+            functools.partial(handle_change_batch_quantity, data, messagebus),
+        )
+
+
+async def stream_consumer_loop():
+    messagebus = bootstrap.messagebus
+
+    async def handle(fields):
+        await handle_change_batch_quantity(json.loads(fields[b"data"]), messagebus)
+
+    consumer = command_stream.CommandStreamConsumer(
+        r,
+        "change_batch_quantity",
+        settings.command_stream_group,
+        handle,
+        batch_size=settings.command_stream_batch_size,
+        block_ms=settings.command_stream_block_ms,
+        claim_idle_ms=settings.command_claim_idle_ms,
+        max_deliveries=settings.command_max_deliveries,
+        submit=get_worker_pool().submit,
+        partition_key="batchref",
+    )
+    logger.info(f"Redis stream consumer {consumer.consumer} starting")
+    await consumer.run(claim_interval=settings.command_claim_interval)
 
 
-async def handle_change_batch_quantity(m, messagebus):
-    logging.debug(f"handling {m}")
-    data = json.loads(m["data"])
+async def handle_change_batch_quantity(data, messagebus):
+    logging.debug(f"handling {data}")
     cmd = commands.ChangeBatchQuantity(ref=data["batchref"], qty=data["qty"])
     await messagebus.handle(cmd)
 
@@ -1,5 +1,6 @@
 import os
 from functools import cache
+from typing import Literal
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -24,6 +25,111 @@ class Settings(BaseSettings):
     api_port: int
 
     email_host: str = "localhost"
+    # "email" - an email per notification, "digest" - the notifications of
+    # notification_window seconds in one email, each distinct one listed once
+    notifications: Literal["email", "digest"] = "email"
+    notification_window: float = 60.0
+
+    # where the products are kept: "edgedb", or "memory" - in this process
+    # only, saved to memory_snapshot_path (None - nowhere) every
+    # memory_snapshot_interval seconds and on shutdown, and loaded from it on
+    # startup; the read model is then kept in memory too and the events are
+    # published by the handlers, as there is no outbox
+    repository_backend: Literal["edgedb", "memory"] = "edgedb"
+    memory_snapshot_path: str | None = None
+    memory_snapshot_interval: float = 60.0
+
+    # size of the EdgeDB connection pool shared by all units of work;
+    # None lets the client pick it from the server's suggestion
+    edgedb_pool_size: int | None = None
+    # how many messages the messagebus handles at once (0 - no limit)
+    messagebus_max_concurrency: int = 64
+    # seconds an event handler may run before it is cancelled (0 - no limit)
+    event_handler_timeout: float = 30.0
+
+    # run the event handlers declared deferred after the command that raised
+    # their events has returned, on background_workers tasks; at most
+    # background_max_queued wait, the idempotent ones tried up to
+    # background_attempts times
+    deferred_handlers: bool = False
+    background_workers: int = 8
+    background_max_queued: int = 10_000
+    background_attempts: int = 3
+    background_retry_delay: float = 0.1
+
+    # optimistic concurrency: attempts per command and jittered backoff bounds
+    conflict_retry_attempts: int = 5
+    conflict_retry_base_delay: float = 0.005
+    conflict_retry_max_delay: float = 0.2
+
+    # concurrent Allocate commands of a SKU are committed together, at most
+    # allocate_max_group in one transaction
+    allocate_group_commit: bool = True
+    allocate_max_group: int = 1000
+
+    # where allocation and batch commands run: "off" - in the process that got
+    # them, "local" - on shard_workers workers in the same process, sharing
+    # its messagebus, "redis" - on the app/shard_worker.py processes, sent
+    # through Redis; each worker owns the SKUs that consistent hashing gives it
+    sharding: Literal["off", "local", "redis"] = "off"
+    shard_workers: int = 4
+    shard_vnodes: int = 64
+    shard_refresh_interval: float = 1.0
+    shard_heartbeat_ttl: float = 5.0
+    shard_request_timeout: float = 30.0
+
+    # how many SKUs of one bulk allocation are allocated at the same time
+    bulk_allocate_concurrency: int = 8
+
+    # products cached for allocation, by count and by estimated bytes (0 - off)
+    product_cache_size: int = 1024
+    product_cache_max_bytes: int = 64 * 2**20
+
+    # how events reach Redis: "outbox" - written with the product that raised
+    # them and sent by app/outbox_relay.py, "inline" - published by the handlers
+    event_publishing: Literal["outbox", "inline"] = "outbox"
+    outbox_batch_size: int = 500
+    outbox_poll_interval: float = 0.1
+    # seconds the sent messages are kept, and between the purges of older ones
+    outbox_retention: float = 3600.0
+    outbox_purge_interval: float = 60.0
+    # how the inline events are published: "direct" - one PUBLISH per event,
+    # "buffered" - in pipelined batches of up to publisher_batch_size events,
+    # sent after publisher_linger seconds at the latest; publishers wait while
+    # publisher_max_buffered events are not sent yet
+    event_publisher: Literal["direct", "buffered"] = "direct"
+    publisher_batch_size: int = 100
+    publisher_linger: float = 0.002
+    publisher_max_buffered: int = 10_000
+
+    # how external commands arrive: "pubsub" - on Redis channels, lost while no
+    # consumer listens, "streams" - on Redis streams, shared by the consumers
+    # of command_stream_group; entries left pending for command_claim_idle_ms
+    # are claimed by another consumer
+    command_channel: Literal["pubsub", "streams"] = "pubsub"
+    command_stream_group: str = "allocation"
+    command_stream_batch_size: int = 100
+    command_stream_block_ms: int = 1000
+    command_claim_idle_ms: int = 60_000
+    command_claim_interval: float = 10.0
+    command_max_deliveries: int = 5
+    command_stream_maxlen: int = 1_000_000
+
+    # workers handling external commands at the same time, the commands of
+    # one batch reference always on the same worker, and the commands each
+    # worker may have queued before the consumer stops reading
+    consumer_workers: int = 8
+    consumer_partition_queue_size: int = 100
+
+    # port of /metrics in the processes without the API, the command consumer
+    # and the shard workers (0 - not served)
+    metrics_port: int = 9100
+
+    # read-through cache of GET /allocations/{orderid}: "redis" or "memory",
+    # the memory one keeping up to allocations_cache_size orders
+    allocations_cache: Literal["redis", "memory"] = "redis"
+    allocations_cache_ttl: int = 300
+    allocations_cache_size: int = 10_000
 
     model_config = SettingsConfigDict(env_file=ENV_FILE, extra="ignore")
 
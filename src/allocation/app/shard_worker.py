@@ -0,0 +1,28 @@
+import asyncio
+import logging
+
+from allocation import metrics
+from allocation.adapters import command_stream
+from allocation.app.settings import settings
+from allocation.bootstrap import bootstrap, get_shard_transport
+from allocation.services.sharding import ShardWorker
+
+logger = logging.getLogger(__name__)
+
+
+async def worker_loop():
+    worker = ShardWorker(
+        command_stream.default_consumer_name(),
+        get_shard_transport(),
+        bootstrap.messagebus,
+    )
+    logger.info(f"Shard worker {worker.name} starting")
+    if settings.metrics_port:
+        await metrics.serve("0.0.0.0", settings.metrics_port)
+    async with bootstrap:
+        await worker.run()
+
+
+if __name__ == "__main__":
+    assert settings.sharding == "redis", "shard workers take their commands from Redis"
+    asyncio.run(worker_loop())
@@ -1,13 +1,19 @@
+import asyncio
+import functools
 import inspect
 from typing import Callable
 
 import edgedb
 from fastapi import FastAPI, Request
 
-from allocation.adapters import redis_eventpublisher
-from allocation.adapters.notifications import AbstractNotifications, EmailNotifications
+from allocation.adapters import allocations_cache as view_cache
+from allocation.adapters import notifications as notifications_adapter
+from allocation.adapters import redis_eventpublisher, shard_transport
 from allocation.app.settings import settings
-from allocation.services import handlers, messagebus, unit_of_work
+from allocation.repositories import cache, memory
+from allocation.services import handlers, messagebus, sharding, unit_of_work
+from allocation.services.background import BackgroundQueue
+from allocation.services.group_commit import GroupCommit
 
 
 async def get_messagebus(request: Request) -> messagebus.MessageBus:
@@ -16,14 +22,50 @@ async def get_messagebus(request: Request) -> messagebus.MessageBus:
 
 def get_pull_connection_edgedb(test_db: bool = False) -> edgedb.AsyncIOClient:
     return edgedb.create_async_client(
-        settings.get_edgedb_dsn(test_db=test_db), tls_security="insecure"
+        settings.get_edgedb_dsn(test_db=test_db),
+        tls_security="insecure",
+        max_concurrency=settings.edgedb_pool_size,
     )
 
 
-def get_uow(
-    async_client_db: edgedb.AsyncIOClient = get_pull_connection_edgedb(),
-) -> unit_of_work.EdgedbUnitOfWork:
-    return unit_of_work.EdgedbUnitOfWork(async_client_db)
+def get_uow_factory(
+    async_client_db: edgedb.AsyncIOClient | None = None,
+) -> unit_of_work.EdgedbUnitOfWorkFactory:
+    if async_client_db is None:
+        async_client_db = get_pull_connection_edgedb()
+    product_cache = cache.ProductCache(
+        max_entries=settings.product_cache_size,
+        max_bytes=settings.product_cache_max_bytes,
+    )
+    return unit_of_work.EdgedbUnitOfWorkFactory(async_client_db, product_cache)
+
+
+def get_memory_uow_factory() -> unit_of_work.InMemoryUnitOfWorkFactory:
+    return unit_of_work.InMemoryUnitOfWorkFactory(
+        memory.ProductStore(
+            snapshot_path=settings.memory_snapshot_path,
+            snapshot_interval=settings.memory_snapshot_interval,
+        )
+    )
+
+
+def get_background_queue() -> BackgroundQueue:
+    return BackgroundQueue(
+        workers=settings.background_workers,
+        max_queued=settings.background_max_queued,
+        attempts=settings.background_attempts,
+        retry_delay=settings.background_retry_delay,
+    )
+
+
+def get_shard_transport() -> shard_transport.AbstractShardTransport:
+    if settings.sharding == "local":
+        return shard_transport.LocalShardTransport()
+    return shard_transport.RedisShardTransport(
+        redis_eventpublisher.r,
+        heartbeat_ttl=settings.shard_heartbeat_ttl,
+        request_timeout=settings.shard_request_timeout,
+    )
 
 
 def inject_dependencies(handler, dependencies):
@@ -31,23 +73,66 @@ def inject_dependencies(handler, dependencies):
     deps = {
         name: dependency for name, dependency in dependencies.items() if name in params
     }
-    return lambda message: handler(message, **deps)
+
+    def injected(message, uow_factory):
+        if "uow_factory" in params:
+            return handler(message, uow_factory=uow_factory, **deps)
+        if "uow" in params:
+            return handler(message, uow=uow_factory(), **deps)
+        return handler(message, **deps)
+
+    return functools.update_wrapper(injected, handler)
 
 
 class Bootstrap:
     def __init__(
         self,
-        uow: unit_of_work.AbstractUnitOfWork = get_uow(),
-        notifications: AbstractNotifications = None,
-        publish: Callable = redis_eventpublisher.publish,
+        uow: unit_of_work.AbstractUnitOfWork | None = None,
+        notifications: notifications_adapter.AbstractNotifications | None = None,
+        publish: Callable | None = None,
+        uow_factory: unit_of_work.AbstractUnitOfWorkFactory | None = None,
+        allocations_cache: view_cache.AbstractAllocationsCache | None = None,
     ):
         if not notifications:
-            notifications = EmailNotifications()
-
-        dependencies = {"uow": uow, "notifications": notifications, "publish": publish}
+            notifications = notifications_adapter.from_settings()
+        self.notifications = notifications
+        if publish is None:
+            publish = redis_eventpublisher.get_publish()
+        if allocations_cache is None:
+            allocations_cache = view_cache.from_settings()
+        self.allocations_cache = allocations_cache
+        if uow_factory is None and uow is not None:
+            uow_factory = unit_of_work.SharedUnitOfWorkFactory(uow)
+        elif uow_factory is None and settings.repository_backend == "memory":
+            uow_factory = get_memory_uow_factory()
+        elif uow_factory is None:
+            uow_factory = get_uow_factory()
+
+        dependencies = {
+            "notifications": notifications,
+            "publish": publish,
+            "allocations_cache": allocations_cache,
+            "group_commit": (
+                GroupCommit(handlers.allocate_group, settings.allocate_max_group)
+                if settings.allocate_group_commit
+                else None
+            ),
+        }
+        # when the units of work write the outbox, the relay publishes the events
+        # instead of the handlers; the products kept in memory have neither
+        # outbox nor EdgeDB read model
+        skipped: tuple[messagebus.AsyncEventHandler, ...]
+        if isinstance(uow_factory, unit_of_work.InMemoryUnitOfWorkFactory):
+            skipped = handlers.READ_MODEL_HANDLERS
+        elif uow_factory.use_outbox:
+            skipped = handlers.PUBLISHERS
+        else:
+            skipped = ()
         injected_event_handlers = {
             event_type: [
-                inject_dependencies(handler, dependencies) for handler in event_handlers
+                inject_dependencies(handler, dependencies)
+                for handler in event_handlers
+                if handler not in skipped
             ]
             for event_type, event_handlers in handlers.EVENT_HANDLERS.items()
         }
@@ -56,16 +141,68 @@ class Bootstrap:
             for command_type, handler in handlers.COMMAND_HANDLERS.items()
         }
         self.messagebus = messagebus.MessageBus(
-            uow=uow,
+            uow_factory=uow_factory,
             event_handlers=injected_event_handlers,
             command_handlers=injected_command_handlers,
+            max_concurrency=settings.messagebus_max_concurrency,
+            background=get_background_queue() if settings.deferred_handlers else None,
         )
 
+        self.router: sharding.ShardRouter | None = None
+        self.shard_workers: list[sharding.ShardWorker] = []
+        self.shard_tasks: list[asyncio.Task] = []
+        if settings.sharding != "off":
+            transport = get_shard_transport()
+            self.router = sharding.ShardRouter(
+                transport,
+                self.messagebus,
+                vnodes=settings.shard_vnodes,
+                refresh_interval=settings.shard_refresh_interval,
+            )
+            if settings.sharding == "local":
+                self.shard_workers = [
+                    sharding.ShardWorker(f"worker-{i}", transport, self.messagebus)
+                    for i in range(settings.shard_workers)
+                ]
+
+    async def handle(self, message: messagebus.Message):
+        """Handle the message here, or on the worker owning its SKU."""
+        if self.router is not None:
+            return await self.router.handle(message)
+        return await self.messagebus.handle(message)
+
+    async def start_sharding(self) -> None:
+        self.shard_tasks = [
+            asyncio.create_task(worker.run()) for worker in self.shard_workers
+        ]
+        await asyncio.sleep(0)  # the local workers join
+        if self.router is not None:
+            await self.router.start()
+
+    async def stop_sharding(self) -> None:
+        if self.router is not None:
+            await self.router.aclose()
+        for task in self.shard_tasks:
+            task.cancel()
+        await asyncio.gather(*self.shard_tasks, return_exceptions=True)
+        self.shard_tasks = []
+
     async def __aenter__(self):
+        await self.messagebus.uow_factory.connect()
         return self.messagebus
 
     async def __aexit__(self, exc_type, exc, tb):
-        await self.messagebus.uow.async_client.aclose()
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        """Stop the shard workers, finish the deferred handlers, flush the
+        buffered events and the notifications, then close the connections."""
+        await self.stop_sharding()
+        if self.messagebus.background is not None:
+            await self.messagebus.background.aclose()
+        await redis_eventpublisher.buffered.aclose()
+        await self.notifications.aclose()
+        await self.messagebus.uow_factory.aclose()
 
 
 bootstrap = Bootstrap()
@@ -73,9 +210,10 @@ bootstrap = Bootstrap()
 
 async def aenter_lifespan(app: FastAPI):
     bus = app.state.bus = bootstrap.messagebus
-    await bus.uow.async_client.ensure_connected()
+    await bus.uow_factory.connect()
+    await bootstrap.start_sharding()
 
 
 async def aexit_lifespan(app: FastAPI):
-    bus, app.state.bus = app.state.bus, None
-    await bus.uow.async_client.aclose()
+    app.state.bus = None
+    await bootstrap.aclose()
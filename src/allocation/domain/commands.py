@@ -15,6 +15,11 @@ class Allocate(Command):
     qty: int
 
 
+@dataclass
+class AllocateMany(Command):
+    lines: list[Allocate]
+
+
 @dataclass
 class CreateBatch(Command):
     ref: str
@@ -1,13 +1,22 @@
 from __future__ import annotations
 
+import bisect
 from dataclasses import dataclass
 from datetime import date
-from typing import Optional, Set
+from typing import Iterable, Optional
 
 from . import commands, events
 
 
-@dataclass(unsafe_hash=True)
+class AllocationsNotLoaded(Exception):
+    pass
+
+
+class UnknownBatch(Exception):
+    pass
+
+
+@dataclass(unsafe_hash=True, slots=True)
 class OrderLine:
     orderid: str
     sku: str
@@ -15,12 +24,36 @@ class OrderLine:
 
 
 class Batch:
-    def __init__(self, ref: str, sku: str, qty: int, eta: Optional[date]):
+    __slots__ = (
+        "reference",
+        "sku",
+        "eta",
+        "purchased_quantity",
+        "allocations",
+        "allocations_loaded",
+        "_allocated_quantity",
+    )
+
+    def __init__(
+        self,
+        ref: str,
+        sku: str,
+        qty: int,
+        eta: Optional[date],
+        allocations: Iterable[OrderLine] = (),
+        allocated_quantity: int | None = None,
+    ):
         self.reference = ref
         self.sku = sku
         self.eta = eta
         self.purchased_quantity = qty
-        self.allocations = set()  # type: Set[OrderLine]
+        self.allocations: set[OrderLine] = set(allocations)
+        # a batch loaded just to allocate from knows how much of it is allocated,
+        # but not to which lines: its allocations are only the lines added since
+        self.allocations_loaded = allocated_quantity is None
+        if allocated_quantity is None:
+            allocated_quantity = sum(line.qty for line in self.allocations)
+        self._allocated_quantity = allocated_quantity
 
     def __repr__(self):
         return f"<Batch {self.reference}>"
@@ -41,18 +74,25 @@ class Batch:
         return self.eta > other.eta
 
     def allocate(self, line: OrderLine):
-        if self.can_allocate(line):
+        if self.can_allocate(line) and line not in self.allocations:
             self.allocations.add(line)
+            self._allocated_quantity += line.qty
 
     def deallocate_one(self, line: OrderLine | None = None):
+        if not self.allocations_loaded:
+            raise AllocationsNotLoaded(self.reference)
         if line and line in self.allocations:
             self.allocations.remove(line)
+            self._allocated_quantity -= line.qty
             return None
-        return self.allocations.pop()
+        line = self.allocations.pop()
+        self._allocated_quantity -= line.qty
+        return line
 
     @property
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self.allocations)
+        # kept by allocate and deallocate_one rather than summed on every access
+        return self._allocated_quantity
 
     @property
     def available_quantity(self) -> int:
@@ -62,40 +102,138 @@ class Batch:
         return self.sku == line.sku and self.available_quantity >= line.qty
 
 
+class BatchIndex:
+    """Batches in allocation order: warehouse stock first, then by ETA.
+
+    A max segment tree over their available quantities finds the first batch
+    with room for a line in O(log n). It has to be told about every change of
+    a batch's available quantity, which is why batches are only changed
+    through their Product.
+    """
+
+    def __init__(self, batches: Iterable[Batch] = ()) -> None:
+        self.sequence = 0
+        keyed = sorted((self.key(batch), batch) for batch in batches)
+        self.keys = [key for key, _ in keyed]
+        self.batches = [batch for _, batch in keyed]
+        self.rebuild()
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+    def key(self, batch: Batch) -> tuple:
+        # equal ETAs keep the order the batches were added in
+        self.sequence += 1
+        return (batch.eta is not None, batch.eta or date.min, self.sequence)
+
+    def rebuild(self) -> None:
+        self.positions = {b.reference: i for i, b in enumerate(self.batches)}
+        self.size = 1
+        while self.size < len(self.batches):
+            self.size *= 2
+        self.tree = [float("-inf")] * (2 * self.size)
+        for position, batch in enumerate(self.batches):
+            self.tree[self.size + position] = batch.available_quantity
+        for node in range(self.size - 1, 0, -1):
+            self.tree[node] = max(self.tree[2 * node], self.tree[2 * node + 1])
+
+    def get(self, ref: str) -> Batch:
+        return self.batches[self.positions[ref]]
+
+    def add(self, batch: Batch) -> None:
+        key = self.key(batch)
+        position = bisect.bisect(self.keys, key)
+        self.keys.insert(position, key)
+        self.batches.insert(position, batch)
+        if position == len(self.batches) - 1 and position < self.size:
+            # the usual case of a batch arriving later than all the others
+            self.positions[batch.reference] = position
+            self.update(batch)
+        else:
+            self.rebuild()
+
+    def update(self, batch: Batch) -> None:
+        node = self.size + self.positions[batch.reference]
+        self.tree[node] = batch.available_quantity
+        node //= 2
+        while node:
+            self.tree[node] = max(self.tree[2 * node], self.tree[2 * node + 1])
+            node //= 2
+
+    def first_fit(self, qty: int) -> Batch | None:
+        if not self.batches or self.tree[1] < qty:
+            return None
+        node = 1
+        while node < self.size:
+            node = 2 * node if self.tree[2 * node] >= qty else 2 * node + 1
+        return self.batches[node - self.size]
+
+
 class Product:
+    __slots__ = ("sku", "batches", "version_number", "events", "_batch_index")
+
     def __init__(self, sku: str, batches: list[Batch], version_number: int = 0):
         self.sku = sku
         self.batches = batches
         self.version_number = version_number
         self.events: list[events.Event | commands.Command] = []
+        self._batch_index: BatchIndex | None = None
+
+    def __repr__(self):
+        return f"<Product {self.sku}>"
+
+    def __eq__(self, other):
+        if not isinstance(other, Product):
+            return False
+        return other.sku == self.sku and other.batches == self.batches
+
+    def __hash__(self):
+        return hash(self.sku)
+
+    @property
+    def batch_index(self) -> BatchIndex:
+        index = self._batch_index
+        if index is None or len(index) != len(self.batches):
+            index = self._batch_index = BatchIndex(self.batches)
+        return index
 
     def allocate(self, line: OrderLine) -> str | None:
-        try:
-            batches = sorted(self.batches)
-            batch = next(b for b in batches if b.can_allocate(line))
-            batch.allocate(line)
-            self.version_number += 1
-            self.events.append(
-                events.Allocated(
-                    orderid=line.orderid,
-                    sku=line.sku,
-                    qty=line.qty,
-                    batchref=batch.reference,
-                )
-            )
-            return batch.reference
-        except StopIteration:
+        index = self.batch_index
+        batch = index.first_fit(line.qty)
+        if batch is not None and not batch.can_allocate(line):
+            # a line of another sku: fall back to checking batch by batch
+            batch = next((b for b in index.batches if b.can_allocate(line)), None)
+        if batch is None:
             self.events.append(events.OutOfStock(line.sku))
             return None
+        batch.allocate(line)
+        index.update(batch)
+        self.version_number += 1
+        self.events.append(
+            events.Allocated(
+                orderid=line.orderid,
+                sku=line.sku,
+                qty=line.qty,
+                batchref=batch.reference,
+            )
+        )
+        return batch.reference
 
     def add_batch(self, batch: Batch) -> str:
+        index = self.batch_index
         self.version_number += 1
         self.batches.append(batch)
+        index.add(batch)
         return batch.reference
 
     def change_batch_quantity(self, ref: str, qty: int):
-        batch = next(b for b in self.batches if b.reference == ref)
+        index = self.batch_index
+        if ref not in index.positions:
+            raise UnknownBatch(f"Unknown batch {ref} of {self.sku}")
+        batch = index.get(ref)
+        self.version_number += 1
         batch.purchased_quantity = qty
         while batch.available_quantity < 0:
             line = batch.deallocate_one()
             self.events.append(events.Deallocated(line.orderid, line.sku, line.qty))
+        index.update(batch)
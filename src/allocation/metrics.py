@@ -0,0 +1,218 @@
+"""Metrics of this process, in the Prometheus text format.
+
+Every module keeps its own metrics at module level, its stats among them,
+and they are all rendered together on /metrics. Recording is a dict lookup
+and a few additions, with a bisect for histograms: everything runs on the
+event loop, so there are no locks, and the label values are trusted. Gauges
+of queues that have a size of their own are read when they are scraped and
+cost nothing in between.
+"""
+from __future__ import annotations
+
+import asyncio
+import bisect
+import logging
+import time
+from typing import Any, Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+Labels = tuple[str, ...]
+
+# seconds, from a fast EdgeQL query to a slow handler
+BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def label_set(names: Labels, values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> None:
+        if metric.name in self.metrics:
+            raise ValueError(f"metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Labels = (),
+        registry: Registry = REGISTRY,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        registry.register(self)
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """A count that only grows, or read by collect when it is scraped."""
+
+    type = "counter"
+
+    def __init__(
+        self,
+        *args,
+        collect: Callable[[], Iterable[tuple[Labels, float]]] | None = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.values: dict[Labels, float] = {}
+        self.collect = collect
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        values: Iterable[tuple[Labels, float]] = self.values.items()
+        if self.collect is not None:
+            try:
+                values = list(self.collect())
+            except Exception:  # pylint: disable=broad-except
+                logger.exception(f"Collecting {self.name} failed")
+                return
+        for labels, value in values:
+            yield f"{self.name}{label_set(self.labels, labels)} {value}"
+
+
+class Gauge(Counter):
+    """A value set as it changes, or read by collect when it is scraped."""
+
+    type = "gauge"
+
+    def set(self, value: float, *labels: str) -> None:
+        self.values[labels] = value
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+
+def export_stats(
+    prefix: str,
+    stats: Callable[[], Iterable[Any]],
+    counters: dict[str, str],
+    gauges: dict[str, str] | None = None,
+    registry: Registry = REGISTRY,
+) -> None:
+    """Read fields of stats dataclasses when scraped, added up over the
+    instances: the counts as counters named <prefix>_<field>_total, the
+    levels as gauges named <prefix>_<field>."""
+
+    def collect(field: str) -> Callable[[], list[tuple[Labels, float]]]:
+        return lambda: [((), sum(getattr(instance, field) for instance in stats()))]
+
+    for field, documentation in counters.items():
+        Counter(
+            f"{prefix}_{field}_total",
+            documentation,
+            collect=collect(field),
+            registry=registry,
+        )
+    for field, documentation in (gauges or {}).items():
+        Gauge(
+            f"{prefix}_{field}", documentation, collect=collect(field), registry=registry
+        )
+
+
+class Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram: Histogram, labels: Labels) -> None:
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self) -> Timer:
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+class Histogram(Metric):
+    """Counts of observations by bucket, with their sum; the count of every
+    bucket includes the smaller ones only when rendered."""
+
+    type = "histogram"
+
+    def __init__(self, *args, buckets: tuple[float, ...] = BUCKETS, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.buckets = buckets
+        # labels -> [count of each bucket..., count above the last, sum]
+        self.values: dict[Labels, list[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def time(self, *labels: str) -> Timer:
+        """Observe how long the with block takes, also when it raises."""
+        return Timer(self, labels)
+
+    def samples(self) -> Iterable[str]:
+        bounds = [repr(bound) for bound in self.buckets] + ["+Inf"]
+        for labels, counts in self.values.items():
+            cumulative: float = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                le = label_set(self.labels, labels, f'le="{bound}"')
+                yield f"{self.name}_bucket{le} {cumulative}"
+            yield f"{self.name}_sum{label_set(self.labels, labels)} {counts[-1]}"
+            yield f"{self.name}_count{label_set(self.labels, labels)} {cumulative}"
+
+
+async def serve(host: str, port: int, registry: Registry = REGISTRY) -> asyncio.Server:
+    """Answer every HTTP request with the metrics, for the processes that
+    have no API of their own."""
+
+    async def respond(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while (await reader.readline()).strip():
+                pass  # the request line and headers, the answer is the same
+            body = registry.render().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                + f"Content-Length: {len(body)}\r\n".encode()
+                + b"Connection: close\r\n\r\n"
+                + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(respond, host, port)
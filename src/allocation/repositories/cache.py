@@ -0,0 +1,113 @@
+"""An in-process cache of the products loaded for allocation."""
+from __future__ import annotations
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from allocation import metrics
+from allocation.domain import model
+
+# rough sizes in bytes of a product and of each of its batches loaded without
+# order lines, strings included, as measured with tracemalloc
+PRODUCT_BYTES = 300
+BATCH_BYTES = 450
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    stale: int = 0  # cached, but the stored version_number had moved on
+    evictions: int = 0
+
+
+stats = CacheStats()
+
+metrics.export_stats(
+    "allocation_product_cache",
+    lambda: [stats],
+    counters={
+        "hits": "Lookups the product cache answered.",
+        "misses": "Lookups the product cache did not hold.",
+        "stale": "Cached products whose stored version had moved on.",
+        "evictions": "Products evicted from the product cache.",
+    },
+)
+
+
+def estimate_size(product: model.Product) -> int:
+    return PRODUCT_BYTES + BATCH_BYTES * len(product.batches)
+
+
+def capacity_copy(product: model.Product) -> model.Product:
+    """A copy of the product with its batches' allocated quantities only."""
+    return model.Product(
+        product.sku,
+        [
+            model.Batch(
+                batch.reference,
+                batch.sku,
+                batch.purchased_quantity,
+                batch.eta,
+                allocated_quantity=batch.allocated_quantity,
+            )
+            for batch in product.batches
+        ],
+        version_number=product.version_number,
+    )
+
+
+class ProductCache:
+    """Products by SKU, the least recently used are evicted first.
+
+    Only the allocated quantities of the batches are kept, and every get
+    returns a fresh copy, so that units of work can change what they get.
+    A cached product is only used while the stored version_number is still
+    the cached one.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[str, tuple[model.Product, int]] = OrderedDict()
+        self.size = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    async def get(
+        self,
+        sku: str,
+        stored_version: Callable[[], Awaitable[int | None]],
+    ) -> model.Product | None:
+        entry = self.entries.get(sku)
+        if entry is None:
+            stats.misses += 1
+            return None
+        product, _ = entry
+        if await stored_version() != product.version_number:
+            stats.stale += 1
+            self.invalidate(sku)
+            return None
+        stats.hits += 1
+        self.entries.move_to_end(sku)
+        return capacity_copy(product)
+
+    def put(self, product: model.Product) -> None:
+        self.invalidate(product.sku)
+        cached = capacity_copy(product)
+        size = estimate_size(cached)
+        if not self.max_entries or size > self.max_bytes:
+            return
+        self.entries[product.sku] = (cached, size)
+        self.size += size
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            stats.evictions += 1
+
+    def invalidate(self, sku: str) -> None:
+        entry = self.entries.pop(sku, None)
+        if entry is not None:
+            self.size -= entry[1]
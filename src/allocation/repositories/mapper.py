@@ -0,0 +1,41 @@
+"""Builds domain objects from EdgeDB query results."""
+from __future__ import annotations
+
+import edgedb
+
+from allocation.domain import model
+
+
+def order_line(obj: edgedb.Object) -> model.OrderLine:
+    return model.OrderLine(obj.orderid, obj.sku, obj.qty)
+
+
+def batch(obj: edgedb.Object, lines: bool = False) -> model.Batch:
+    """A batch with its order lines, or with their total only unless lines
+    says that those loaded with it are all of them."""
+    if hasattr(obj, "allocated_quantity") and not lines:
+        # loaded without its order lines, see EdgeDBRepository._get
+        return model.Batch(
+            obj.reference,
+            obj.sku,
+            obj.purchased_quantity,
+            obj.eta,
+            allocated_quantity=obj.allocated_quantity,
+        )
+    return model.Batch(
+        obj.reference,
+        obj.sku,
+        obj.purchased_quantity,
+        obj.eta,
+        allocations=[order_line(line) for line in getattr(obj, "allocations", ())],
+    )
+
+
+def product(obj: edgedb.Object, lines_of: str | None = None) -> model.Product:
+    """The product; lines_of - the batch loaded with its order lines, the
+    others having their total only."""
+    return model.Product(
+        obj.sku,
+        [batch(b, lines=b.reference == lines_of) for b in obj.batches],
+        version_number=obj.version_number,
+    )
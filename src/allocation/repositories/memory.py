@@ -0,0 +1,343 @@
+"""Products kept in the memory of this process, saved to disk now and then.
+
+The store holds the committed version of every product and never changes
+it: units of work change copies of what they read, and a commit replaces
+the products they saved with new ones, made of the batches left untouched
+and fresh copies of the changed ones. A commit checks the version of every
+product first, so it applies all of its products or none, and a unit of
+work that does not commit leaves the store as it was. Snapshots are written
+from another thread while commits go on, as what they read never changes.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import time
+import weakref
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import date
+from typing import Any
+
+from allocation import metrics
+from allocation.domain import model
+from allocation.repositories import cache, repository, tracking
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class StoreStats:
+    products: int = 0
+    commits: int = 0
+    conflicts: int = 0
+    snapshots: int = 0
+    snapshot_seconds: float = 0.0
+
+
+# the stores of this process, to collect their stats
+stores: weakref.WeakSet[ProductStore] = weakref.WeakSet()
+
+metrics.export_stats(
+    "allocation_memory_store",
+    lambda: [store.stats for store in stores],
+    counters={
+        "commits": "Commits to the in-memory product stores.",
+        "conflicts": "Commits to the in-memory product stores that lost a race.",
+        "snapshots": "Snapshots written of the in-memory product stores.",
+    },
+    gauges={
+        "products": "Products held in the in-memory product stores.",
+        "snapshot_seconds": "Seconds the last snapshot of the stores took.",
+    },
+)
+
+
+def batch_copy(batch: model.Batch) -> model.Batch:
+    """A copy of the batch with its order lines."""
+    return model.Batch(
+        batch.reference,
+        batch.sku,
+        batch.purchased_quantity,
+        batch.eta,
+        allocations=batch.allocations,
+    )
+
+
+def full_copy(product: model.Product) -> model.Product:
+    """A copy of the product with the order lines of its batches."""
+    return model.Product(
+        product.sku,
+        [batch_copy(batch) for batch in product.batches],
+        version_number=product.version_number,
+    )
+
+
+def merge(
+    stored: model.Product | None,
+    product: model.Product,
+    changes: tracking.ProductChanges,
+) -> model.Product:
+    """The stored product with the changes made to the product applied."""
+    added: defaultdict[str, set[model.OrderLine]] = defaultdict(set)
+    removed: defaultdict[str, set[model.OrderLine]] = defaultdict(set)
+    for ref, line in changes.added:
+        added[ref].add(line)
+    for ref, line in changes.removed:
+        removed[ref].add(line)
+    changed = {b.reference for b in changes.batches} | added.keys() | removed.keys()
+    stored_batches = (
+        {b.reference: b for b in stored.batches if b.reference in changed}
+        if stored is not None
+        else {}
+    )
+    new_batches = {}
+    for batch in product.batches:
+        if batch.reference not in changed:
+            continue
+        old = stored_batches.get(batch.reference)
+        gone, new = removed[batch.reference], added[batch.reference]
+        old_lines = old.allocations if old else set()
+        # the allocated quantity follows from the changes alone, rather than
+        # from summing every line of the batch again; only the lines that
+        # really leave or join the stored ones count, as a stale product may
+        # remove a line already gone or add one already there
+        allocated = (
+            (old.allocated_quantity if old else 0)
+            - sum(line.qty for line in (gone & old_lines) - new)
+            + sum(line.qty for line in new - old_lines)
+        )
+        new_batch = model.Batch(
+            batch.reference,
+            batch.sku,
+            batch.purchased_quantity,
+            batch.eta,
+            allocations=(old_lines - gone) | new,
+            allocated_quantity=allocated,
+        )
+        new_batch.allocations_loaded = True
+        new_batches[batch.reference] = new_batch
+    batches = [new_batches.pop(b.reference, b) for b in stored.batches] if stored else []
+    batches.extend(new_batches.values())
+    return model.Product(product.sku, batches, version_number=product.version_number)
+
+
+def product_json(product: model.Product) -> dict[str, Any]:
+    return {
+        "sku": product.sku,
+        "version_number": product.version_number,
+        "batches": [
+            {
+                "reference": batch.reference,
+                "sku": batch.sku,
+                "eta": batch.eta.isoformat() if batch.eta else None,
+                "purchased_quantity": batch.purchased_quantity,
+                "allocations": [
+                    [line.orderid, line.sku, line.qty] for line in batch.allocations
+                ],
+            }
+            for batch in product.batches
+        ],
+    }
+
+
+def product_from_json(obj: dict[str, Any]) -> model.Product:
+    return model.Product(
+        obj["sku"],
+        [
+            model.Batch(
+                batch["reference"],
+                batch["sku"],
+                batch["purchased_quantity"],
+                date.fromisoformat(batch["eta"]) if batch["eta"] else None,
+                allocations=[model.OrderLine(*line) for line in batch["allocations"]],
+            )
+            for batch in obj["batches"]
+        ],
+        version_number=obj["version_number"],
+    )
+
+
+def write_snapshot(path: str, products: list[model.Product]) -> None:
+    # written next to the last one and renamed over it, so that a crash
+    # while writing leaves the last snapshot whole
+    temporary = f"{path}.tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        json.dump([product_json(product) for product in products], f)
+    os.replace(temporary, path)
+
+
+def read_snapshot(path: str) -> list[model.Product]:
+    with open(path, encoding="utf-8") as f:
+        return [product_from_json(obj) for obj in json.load(f)]
+
+
+class ProductStore:
+    """The committed products, saved to snapshot_path every snapshot_interval
+    seconds if they changed (0 - on shutdown only) and loaded from it."""
+
+    def __init__(
+        self, snapshot_path: str | None = None, snapshot_interval: float = 60.0
+    ) -> None:
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.products: dict[str, model.Product] = {}
+        self.skus: dict[str, str] = {}  # batch reference -> sku
+        self.orders: dict[str, dict[str, str]] = {}  # orderid -> sku -> batchref
+        self.loaded = False
+        self.unsaved = 0  # commits since the last snapshot
+        self.snapshotter: asyncio.Task | None = None
+        self.stats: StoreStats = StoreStats()
+        stores.add(self)
+
+    def get(self, sku: str) -> model.Product | None:
+        return self.products.get(sku)
+
+    def sku_of(self, batchref: str) -> str | None:
+        return self.skus.get(batchref)
+
+    def allocations(self, orderid: str) -> list[dict[str, str]]:
+        return [
+            {"sku": sku, "batchref": batchref}
+            for sku, batchref in self.orders.get(orderid, {}).items()
+        ]
+
+    def commit(
+        self, saved: list[tuple[model.Product, tracking.ProductSnapshot | None]]
+    ) -> None:
+        """Store the products, each changed since its snapshot, or none of them."""
+        for product, snapshot in saved:
+            stored = self.products.get(product.sku)
+            stored_version = None if stored is None else stored.version_number
+            expected = None if snapshot is None else snapshot.version_number
+            if stored_version != expected:
+                self.stats.conflicts += 1
+                raise repository.SynchronousUpdateError(repository.CONFLICT)
+        for product, snapshot in saved:
+            changes = tracking.diff(snapshot, product)
+            self.products[product.sku] = merge(
+                self.products.get(product.sku), product, changes
+            )
+            self.index(product.sku, changes)
+        self.stats.products = len(self.products)
+        self.unsaved += 1
+        self.stats.commits += 1
+
+    def index(self, sku: str, changes: tracking.ProductChanges) -> None:
+        for batch in changes.batches:
+            self.skus[batch.reference] = sku
+        for ref, line in changes.removed:
+            order = self.orders.get(line.orderid, {})
+            if order.get(line.sku) == ref:
+                del order[line.sku]
+                if not order:
+                    del self.orders[line.orderid]
+        for ref, line in changes.added:
+            self.orders.setdefault(line.orderid, {})[line.sku] = ref
+
+    def load(self) -> None:
+        if self.loaded:
+            return
+        self.loaded = True
+        if self.snapshot_path is None or not os.path.exists(self.snapshot_path):
+            return
+        for product in read_snapshot(self.snapshot_path):
+            self.products[product.sku] = product
+            self.index(product.sku, tracking.diff(None, product))
+        self.stats.products = len(self.products)
+        logger.info(f"loaded {len(self.products)} products from {self.snapshot_path}")
+
+    async def save(self) -> None:
+        if self.snapshot_path is None or not self.unsaved:
+            return
+        self.unsaved = 0
+        started = time.perf_counter()
+        await asyncio.to_thread(
+            write_snapshot, self.snapshot_path, list(self.products.values())
+        )
+        self.stats.snapshots += 1
+        self.stats.snapshot_seconds = time.perf_counter() - started
+
+    async def save_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                await self.save()
+            except OSError:
+                logger.exception(f"Saving a snapshot to {self.snapshot_path} failed")
+                self.unsaved += 1  # saved again next time
+
+    def start(self) -> None:
+        if self.snapshotter is None and self.snapshot_path and self.snapshot_interval:
+            self.snapshotter = asyncio.create_task(self.save_forever())
+
+    async def aclose(self) -> None:
+        if self.snapshotter is not None:
+            self.snapshotter.cancel()
+            await asyncio.gather(self.snapshotter, return_exceptions=True)
+            self.snapshotter = None
+        await self.save()
+
+
+class InMemoryRepository(repository.AbstractRepository):
+    """Copies of the stored products; the saved ones are stored on commit."""
+
+    def __init__(self, store: ProductStore) -> None:
+        super().__init__()
+        self.store = store
+        self.snapshots: dict[str, tracking.ProductSnapshot] = {}
+        self.saved: dict[str, model.Product] = {}
+
+    async def _get(
+        self, sku: str, allocations: bool = True, lines_of: str | None = None
+    ) -> model.Product | None:
+        stored = self.store.get(sku)
+        if stored is None:
+            return None
+        product = full_copy(stored) if allocations else cache.capacity_copy(stored)
+        if not allocations and lines_of is not None:
+            product.batches = [
+                batch_copy(stored_batch) if stored_batch.reference == lines_of else batch
+                for stored_batch, batch in zip(stored.batches, product.batches)
+            ]
+        self.snapshots[sku] = tracking.ProductSnapshot.of(product)
+        return product
+
+    async def _get_by_batchref(
+        self, batchref: str, allocations: bool = True, batch_lines: bool = False
+    ) -> model.Product | None:
+        sku = self.store.sku_of(batchref)
+        if sku is None:
+            return None
+        return await self._get(sku, allocations, batchref if batch_lines else None)
+
+    async def allocated_batches(self, sku: str, orderids: list[str]) -> dict[str, str]:
+        orders = self.store.orders
+        return {
+            orderid: orders[orderid][sku]
+            for orderid in orderids
+            if sku in orders.get(orderid, {})
+        }
+
+    async def _add(self, product: model.Product) -> None:
+        self.saved[product.sku] = product
+
+    async def list(self) -> list[model.Batch]:
+        return [
+            batch
+            for product in self.store.products.values()
+            for batch in full_copy(product).batches
+        ]
+
+    def commit(self) -> None:
+        self.store.commit(
+            [(product, self.snapshots.get(sku)) for sku, product in self.saved.items()]
+        )
+        for sku, product in self.saved.items():
+            self.snapshots[sku] = tracking.ProductSnapshot.of(product)
+        self.saved.clear()
+
+    def rollback(self) -> None:
+        self.saved.clear()
@@ -1,10 +1,20 @@
 from __future__ import annotations
 
 import abc
+import json
 
 import edgedb
 
-import allocation.adapters.pyd_model as model
+from allocation import metrics
+from allocation.adapters import outbox
+from allocation.domain import model
+from allocation.repositories import cache, mapper, tracking
+
+query_seconds = metrics.Histogram(
+    "allocation_edgeql_query_seconds",
+    "EdgeQL queries sent, by query, and how long they took.",
+    ("query",),
+)
 
 
 class SynchronousUpdateError(Exception):
@@ -19,18 +29,49 @@ class AbstractRepository(abc.ABC):
         await self._add(product)
         self.seen.add(product)
 
-    async def get(self, sku: str) -> model.Product | None:
-        product = await self._get(sku=sku)
+    async def get(self, sku: str, allocations: bool = True) -> model.Product | None:
+        """Return the product, with its order lines unless allocations=False.
+
+        Without them each batch only knows its allocated quantity: enough to
+        allocate from it, not to deallocate.
+        """
+        product = await self._get(sku=sku, allocations=allocations)
         if product:
-            self.seen.add(product)
+            self._see(product)
         return product
 
-    async def get_by_batchref(self, batchref: str) -> model.Product | None:
-        product = await self._get_by_batchref(batchref=batchref)
+    async def get_by_batchref(
+        self, batchref: str, allocations: bool = True, batch_lines: bool = False
+    ) -> model.Product | None:
+        """Return the product of the batch; with allocations=False and
+        batch_lines=True the order lines of that one batch are loaded too,
+        enough to change its quantity."""
+        product = await self._get_by_batchref(
+            batchref=batchref, allocations=allocations, batch_lines=batch_lines
+        )
         if product:
-            self.seen.add(product)
+            self._see(product)
         return product
 
+    async def allocated_batches(self, sku: str, orderids: list[str]) -> dict[str, str]:
+        """The batch of each of the orders that already has a line of the sku
+        allocated, by orderid: a product loaded without its order lines cannot
+        tell a repeated allocation from a new one. Repositories with a cheaper
+        lookup than loading every order line override it."""
+        product = await self._get(sku=sku)
+        wanted = set(orderids)
+        return {
+            line.orderid: batch.reference
+            for batch in (product.batches if product else [])
+            for line in batch.allocations
+            if line.orderid in wanted
+        }
+
+    def _see(self, product: model.Product) -> None:
+        # a product loaded again replaces the earlier copy, whose events are stale
+        self.seen.discard(product)
+        self.seen.add(product)
+
     @abc.abstractmethod
     async def _add(self, product: model.Product) -> None:
         raise NotImplementedError
@@ -48,109 +89,256 @@ class AbstractRepository(abc.ABC):
 
 
 class EdgeDBRepository(AbstractRepository):
-    def __init__(self, async_client_db) -> None:
+    def __init__(
+        self,
+        async_client_db,
+        product_cache: cache.ProductCache | None = None,
+        use_outbox: bool = False,
+    ):
         super().__init__()
         self.client: edgedb.AsyncIOClient = async_client_db
+        self.cache = product_cache
+        # write the published events of a product to the outbox when saving it,
+        # remembering how many of its events are already there
+        self.use_outbox = use_outbox
+        self.outboxed: dict[str, int] = {}
+        # every product as it was read from (or last written to) the database:
+        # its version_number is the expected one for the compare-and-swap,
+        # its batches are what _add diffs against to write only the changes
+        self.snapshots: dict[str, tracking.ProductSnapshot] = {}
 
     async def _get(
         self,
         sku: str | None = None,
         batchref: str | None = None,
         allocations: bool = True,
+        batch_lines: bool = False,
     ) -> model.Product | None:
-        """Return Product by SKU."""
-        obj_ = await self.client.query_single(
-            f""" SELECT Product {{
-                  sku, version_number,
-                  batches: {{
-                      reference,
-                      sku,
-                      eta,
-                      purchased_quantity,
-                      {"allocations: { orderid, sku, qty }" if allocations else ""}
-                  }}
-                }}
-                FILTER .sku ?= <optional str>$sku
-                OR .batches.reference ?= <optional str>$reference
-                LIMIT 1
+        """Return Product by SKU, or by the reference of one of its batches."""
+        if self.cache is not None and sku is not None and not allocations:
+            product = await self.cache.get(sku, lambda: self._version_number(sku))
+            if product is not None:
+                self.snapshots[product.sku] = tracking.ProductSnapshot.of(product)
+                return product
+        query = "get_product" if allocations else "get_product_capacity"
+        batch_lines = batch_lines and not allocations and batchref is not None
+        if batch_lines:
+            query = "get_product_batch_lines"
+        with query_seconds.time(query):
+            obj_ = await self.client.query_single(
+                f""" SELECT Product {{
+                      sku, version_number,
+                      batches: {{
+                          reference,
+                          sku,
+                          eta,
+                          purchased_quantity,
+                          {allocations_shape(allocations, batch_lines)}
+                      }}
+                    }}
+                    FILTER .sku ?= <optional str>$sku
+                    OR .batches.reference ?= <optional str>$reference
+                    LIMIT 1
 
-            """,
-            sku=sku,
-            reference=batchref,
-        )
-        return model.Product.model_validate(obj_) if obj_ else None
+                """,
+                sku=sku,
+                reference=batchref,
+            )
+        if not obj_:
+            return None
+        product = mapper.product(obj_, lines_of=batchref if batch_lines else None)
+        self.snapshots[product.sku] = tracking.ProductSnapshot.of(product)
+        if self.cache is not None and not allocations:
+            self.cache.put(product)
+        return product
 
-    async def _get_by_batchref(self, batchref: str | None) -> model.Product | None:
-        return await self._get(batchref=batchref)
+    async def _version_number(self, sku: str) -> int | None:
+        with query_seconds.time("version_number"):
+            return await self.client.query_single(
+                "SELECT Product.version_number FILTER Product.sku = <str>$sku", sku=sku
+            )
 
-    async def _add(self, product: model.Product) -> None:
-        product_db = await self.client.query_single(
-            """SELECT Product { version_number } FILTER .sku=<str>$sku""", sku=product.sku
+    async def _get_by_batchref(
+        self, batchref: str | None, allocations: bool = True, batch_lines: bool = False
+    ) -> model.Product | None:
+        return await self._get(
+            batchref=batchref, allocations=allocations, batch_lines=batch_lines
         )
-        if product_db and product_db.version_number >= product.version_number:
-            raise SynchronousUpdateError(
-                "could not serialize access due to concurrent update"
+
+    async def allocated_batches(self, sku: str, orderids: list[str]) -> dict[str, str]:
+        with query_seconds.time("allocated_batches"):
+            objects = await self.client.query(
+                """ SELECT OrderLine { orderid, batchref := .allocated_in.reference }
+                    FILTER .sku = <str>$sku
+                        AND .orderid IN array_unpack(<array<str>>$orderids)
+                """,
+                sku=sku,
+                orderids=orderids,
             )
-        await self.add_product(product)
+        return {obj.orderid: obj.batchref for obj in objects}
+
+    async def _add(self, product: model.Product) -> None:
+        snapshot = self.snapshots.get(product.sku)
+        if self.cache is not None:
+            self.cache.invalidate(product.sku)
+        query = INSERT_NEW_PRODUCT if snapshot is None else UPDATE_STORED_PRODUCT
+        new_events = product.events[self.outboxed.get(product.sku, 0) :]
+        messages = outbox.messages(new_events) if self.use_outbox else []
+        try:
+            with query_seconds.time("save_product"):
+                await self.client.query_single(
+                    query, data=save_product_json(product, snapshot, messages)
+                )
+        except edgedb.errors.CardinalityViolationError as e:
+            if CONFLICT not in str(e):
+                raise
+            raise SynchronousUpdateError(CONFLICT) from e
+        except edgedb.errors.TransactionConflictError as e:
+            raise SynchronousUpdateError(CONFLICT) from e
         self.seen.add(product)
-        if hasattr(product, "batches"):
-            if product.batches is not None:
-                for batch in product.batches:
-                    await self.add_batch(batch)
-
-    async def add_product(self, product: model.Product):
-        data = product.model_dump_json(exclude={"batches"})
-        await self.client.query(
-            """WITH
-            obj := <json>$data,
-            INSERT Product {
-                sku := <str>obj['sku'],
-                version_number := <int16>obj['version_number'],
-            }
-            UNLESS CONFLICT ON .sku ELSE (
-                UPDATE Product SET {
-                sku := <str>obj['sku'],
-                version_number := <int16>obj['version_number'],
-                }
-            )
-            """,
-            data=data,
-        )
+        self.snapshots[product.sku] = tracking.ProductSnapshot.of(product)
+        self.outboxed[product.sku] = len(product.events)
 
-    async def add_batch(self, batch: model.Batch) -> None:
-        data = batch.model_dump_json()
-        await self.client.query(
-            """WITH
-            obj := <json>$data,
-            list_orders := <array<json>>obj['allocations'] ?? [<json>{}],
-            new_batch := (INSERT Batch {
+    async def list(self) -> list[model.Batch]:
+        with query_seconds.time("list_batches"):
+            objects = await self.client.query("""SELECT Batch {**}""")
+        return [mapper.batch(obj) for obj in objects]
+
+
+CONFLICT = "could not serialize access due to concurrent update"
+
+# Shapes of a batch's allocations: every order line, just their total, or
+# their total and the lines of the batch $reference only
+ALLOCATIONS = "allocations: { orderid, sku, qty }"
+ALLOCATED_QUANTITY = "allocated_quantity := sum(.allocations.qty)"
+BATCH_ALLOCATIONS = f"""{ALLOCATED_QUANTITY},
+    allocations: {{ orderid, sku, qty }}
+        FILTER .allocated_in.reference ?= <optional str>$reference
+"""
+
+
+def allocations_shape(allocations: bool, batch_lines: bool) -> str:
+    if allocations:
+        return ALLOCATIONS
+    return BATCH_ALLOCATIONS if batch_lines else ALLOCATED_QUANTITY
+
+
+# A new product is only inserted if nobody has inserted it in the meantime
+INSERT_PRODUCT = """
+    INSERT Product {
+        sku := <str>data['sku'],
+        version_number := <int16>data['version_number'],
+    }
+    UNLESS CONFLICT ON .sku
+"""
+
+# A stored product is only updated if its version is still the one we read
+UPDATE_PRODUCT = """
+    UPDATE Product
+    FILTER .sku = <str>data['sku']
+        AND .version_number = <int16>data['expected_version']
+    SET {
+        version_number := <int16>data['version_number'],
+    }
+"""
+
+# Saves the changes of a product in one round trip: the version compare-and-swap,
+# new or modified batches, the allocated and deallocated order lines, and the
+# outbox messages of its events.
+# If the compare-and-swap writes nothing, assert_exists fails the whole statement.
+SAVE_PRODUCT = """
+WITH
+    data := <json>$data,
+    saved_product := ({product}),
+    saved_batches := (
+        FOR obj IN json_array_unpack(data['batches']) UNION (
+            INSERT Batch {{
                 reference := <str>obj['reference'],
                 sku := <str>obj['sku'],
                 eta := <cal::local_date>obj['eta'],
                 purchased_quantity := <int16>obj['purchased_quantity'],
-            }
+                product := saved_product,
+            }}
             UNLESS CONFLICT ON .reference ELSE (
-                UPDATE Batch SET {
-                reference := <str>obj['reference'],
+                UPDATE Batch SET {{
+                    eta := <cal::local_date>obj['eta'],
+                    purchased_quantity := <int16>obj['purchased_quantity'],
+                }}
+            )
+        )
+    ),
+    removed_lines := (
+        FOR obj IN json_array_unpack(data['removed']) UNION (
+            DELETE OrderLine FILTER
+                .orderid = <str>obj['orderid']
+                AND .sku = <str>obj['sku']
+                AND .qty = <int16>obj['qty']
+                AND .allocated_in.reference = <str>obj['batchref']
+        )
+    ),
+    added_lines := (
+        FOR obj IN json_array_unpack(data['added']) UNION (
+            INSERT OrderLine {{
+                orderid := <str>obj['orderid'],
                 sku := <str>obj['sku'],
-                eta := <cal::local_date>obj['eta'],
-                purchased_quantity := <int16>obj['purchased_quantity'],
-                }
-            )),
-            for order_line in array_unpack(list_orders) union (
-                INSERT OrderLine {
-                    orderid := <str>order_line['orderid'],
-                    qty := <int16>order_line['qty'],
-                    sku := <str>order_line['sku'],
-                    allocated_in := new_batch
-                }
-            );
-            WITH obj := <json>$data,
-            SELECT Batch FILTER .reference = <str>obj['reference'];
-            """,
-            data=data,
+                qty := <int16>obj['qty'],
+                allocated_in := assert_single(
+                    (SELECT saved_batches FILTER .reference = <str>obj['batchref'])
+                    ?? (SELECT Batch FILTER .reference = <str>obj['batchref'])
+                ),
+            }}
+            UNLESS CONFLICT ON (.orderid, .sku)
         )
+    ),
+    outbox_messages := (
+        FOR obj IN json_array_unpack(data['outbox']) UNION (
+            INSERT OutboxMessage {{
+                channel := <str>obj['channel'],
+                payload := <str>obj['payload'],
+            }}
+        )
+    ),
+SELECT assert_exists(saved_product, message := "{conflict}") {{
+    version_number,
+    batches := count(saved_batches),
+    added := count(added_lines),
+    removed := count(removed_lines),
+    outbox := count(outbox_messages),
+}}
+"""
+INSERT_NEW_PRODUCT = SAVE_PRODUCT.format(product=INSERT_PRODUCT, conflict=CONFLICT)
+UPDATE_STORED_PRODUCT = SAVE_PRODUCT.format(product=UPDATE_PRODUCT, conflict=CONFLICT)
 
-    async def list(self) -> list[model.Batch]:
-        objects = await self.client.query("""SELECT Batch {**}""")
-        return [model.Batch.model_validate(obj) for obj in objects]
+
+def save_product_json(
+    product: model.Product,
+    snapshot: tracking.ProductSnapshot | None,
+    outbox_messages: list[dict[str, str]] | None = None,
+) -> str:
+    changes = tracking.diff(snapshot, product)
+    data = {
+        "sku": product.sku,
+        "version_number": product.version_number,
+        "batches": [
+            {
+                "reference": batch.reference,
+                "sku": batch.sku,
+                "eta": batch.eta.isoformat() if batch.eta else None,
+                "purchased_quantity": batch.purchased_quantity,
+            }
+            for batch in changes.batches
+        ],
+        "added": order_lines(changes.added),
+        "removed": order_lines(changes.removed),
+        "outbox": outbox_messages or [],
+    }
+    if snapshot is not None:
+        data["expected_version"] = snapshot.version_number
+    return json.dumps(data)
+
+
+def order_lines(lines: list[tuple[str, model.OrderLine]]) -> list[dict]:
+    return [
+        {"batchref": ref, "orderid": line.orderid, "sku": line.sku, "qty": line.qty}
+        for ref, line in lines
+    ]
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from datetime import date
+
+from allocation.domain import model
+
+
+@dataclass(frozen=True)
+class BatchSnapshot:
+    purchased_quantity: int
+    eta: date | None
+    allocations: frozenset[model.OrderLine]
+
+    @classmethod
+    def of(cls, batch: model.Batch) -> BatchSnapshot:
+        return cls(
+            purchased_quantity=batch.purchased_quantity,
+            eta=batch.eta,
+            allocations=frozenset(batch.allocations),
+        )
+
+
+@dataclass(frozen=True)
+class ProductSnapshot:
+    """The state of a product as it is stored in the database."""
+
+    version_number: int
+    batches: dict[str, BatchSnapshot]
+
+    @classmethod
+    def of(cls, product: model.Product) -> ProductSnapshot:
+        return cls(
+            version_number=product.version_number,
+            batches={b.reference: BatchSnapshot.of(b) for b in product.batches},
+        )
+
+
+@dataclass
+class ProductChanges:
+    """What has to be written to bring the stored product up to date."""
+
+    batches: list[model.Batch] = field(default_factory=list)
+    added: list[tuple[str, model.OrderLine]] = field(default_factory=list)
+    removed: list[tuple[str, model.OrderLine]] = field(default_factory=list)
+
+
+def diff(snapshot: ProductSnapshot | None, product: model.Product) -> ProductChanges:
+    """Compare a product with its snapshot; a missing snapshot means a new one."""
+    changes = ProductChanges()
+    for batch in product.batches:
+        allocations = batch.allocations
+        stored = snapshot.batches.get(batch.reference) if snapshot else None
+        if stored is None:
+            changes.batches.append(batch)
+            changes.added.extend((batch.reference, line) for line in allocations)
+            continue
+        if (
+            stored.purchased_quantity != batch.purchased_quantity
+            or stored.eta != batch.eta
+        ):
+            changes.batches.append(batch)
+        changes.added.extend(
+            (batch.reference, line) for line in allocations - stored.allocations
+        )
+        changes.removed.extend(
+            (batch.reference, line) for line in stored.allocations - allocations
+        )
+    return changes
@@ -0,0 +1,118 @@
+import asyncio
+import contextvars
+import logging
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from allocation import metrics
+
+logger = logging.getLogger(__name__)
+
+Job = Callable[[], Awaitable[object]]
+
+
+@dataclass
+class BackgroundStats:
+    queued: int = 0  # waiting or running now
+    done: int = 0
+    retries: int = 0
+    failed: int = 0  # given up on after the last attempt
+
+
+stats = BackgroundStats()
+
+metrics.export_stats(
+    "allocation_background_jobs",
+    lambda: [stats],
+    counters={
+        "done": "Background jobs that ran to the end.",
+        "retries": "Background jobs run again after they failed.",
+        "failed": "Background jobs given up on.",
+    },
+)
+
+# set in the worker tasks, and so in the tasks their jobs start
+in_job = contextvars.ContextVar("in_job", default=False)
+
+queued_jobs = metrics.Gauge(
+    "allocation_background_jobs",
+    "Deferred handlers waiting or running in the background queue.",
+    collect=lambda: [((), stats.queued)],
+)
+
+
+class BackgroundQueue:
+    """Runs jobs on worker tasks after their submitter has moved on.
+
+    At most max_queued jobs wait: submit waits for room beyond that, except
+    for the jobs submitted by a running job, which are queued at once - their
+    submitter holds a worker, so waiting could leave every worker waiting on
+    itself. aclose runs the jobs still queued before stopping the workers.
+
+    A job is run once; retry runs one again after retry_delay, doubled every
+    time, up to attempts times, for the jobs that may safely run twice.
+    """
+
+    def __init__(
+        self,
+        workers: int = 8,
+        max_queued: int = 10_000,
+        attempts: int = 3,
+        retry_delay: float = 0.1,
+    ) -> None:
+        self.workers = max(1, workers)
+        self.queue: asyncio.Queue[tuple[str, Job, bool]] = asyncio.Queue()
+        self.room = asyncio.Semaphore(max(1, max_queued))
+        self.attempts = max(1, attempts)
+        self.retry_delay = retry_delay
+        self.tasks: list[asyncio.Task] = []
+
+    async def submit(self, name: str, job: Job) -> None:
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+        takes_room = not in_job.get()
+        if takes_room:
+            await self.room.acquire()
+        stats.queued += 1
+        self.queue.put_nowait((name, job, takes_room))
+
+    async def work(self) -> None:
+        in_job.set(True)
+        while True:
+            name, job, takes_room = await self.queue.get()
+            try:
+                await job()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception(f"Giving up on {name}")
+                stats.failed += 1
+            else:
+                stats.done += 1
+            finally:
+                stats.queued -= 1
+                if takes_room:
+                    self.room.release()
+                self.queue.task_done()
+
+    async def retry(self, name: str, job: Job) -> None:
+        """Run the job until it succeeds, raise once it failed attempts times."""
+        for attempt in range(1, self.attempts + 1):
+            try:
+                await job()
+            except Exception:  # pylint: disable=broad-except
+                if attempt >= self.attempts:
+                    logger.error(f"{name} failed {attempt} times")
+                    raise
+                stats.retries += 1
+                delay = self.retry_delay * 2 ** (attempt - 1)
+                logger.warning(f"{name} failed, attempt {attempt} retries in {delay}s")
+                await asyncio.sleep(delay)
+            else:
+                return
+
+    async def aclose(self) -> None:
+        """Run the queued jobs and stop the workers."""
+        await self.queue.join()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+from allocation.domain import commands, events
+
+from . import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+Group = list[tuple[commands.Allocate, unit_of_work.AbstractUnitOfWork, asyncio.Future]]
+# the batch reference of a line and the events raised allocating it
+LineResult = tuple[str | None, list[events.Event | commands.Command]]
+AllocateGroup = Callable[
+    [str, list[commands.Allocate], unit_of_work.AbstractUnitOfWork],
+    Awaitable[list[LineResult]],
+]
+
+
+class LineFailed(Exception):
+    """The line at position failed the group, the error is its __cause__."""
+
+    def __init__(self, position: int) -> None:
+        super().__init__(f"line {position} of the group failed")
+        self.position = position
+
+
+class GroupCommit:
+    """Allocates the concurrent Allocate commands of a SKU in one transaction.
+
+    A single flight per SKU: the commands that arrive while a transaction of
+    their SKU is running wait for it, then all of them are applied to one
+    loaded product and committed together, at most max_group at a time.
+    Every caller gets the result of its own line, its events included, so
+    that each caller handles the events of its line even though the
+    transaction runs in the unit of work of the group's first command.
+
+    A group failed by one of its lines, as allocate_group tells with
+    LineFailed, is committed again without it. Any other error, such as an
+    unknown SKU or conflicts beyond the retries, is the same for every line:
+    all the callers of the group get it at once.
+    """
+
+    def __init__(self, allocate_group: AllocateGroup, max_group: int = 1000) -> None:
+        self.allocate_group = allocate_group
+        self.max_group = max_group
+        self.waiting: dict[str, Group] = {}
+        self.flights: dict[str, asyncio.Task] = {}
+
+    async def allocate(
+        self, cmd: commands.Allocate, uow: unit_of_work.AbstractUnitOfWork
+    ) -> LineResult:
+        done = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(cmd.sku, []).append((cmd, uow, done))
+        if cmd.sku not in self.flights:
+            self.flights[cmd.sku] = asyncio.create_task(self.fly(cmd.sku))
+        return await done
+
+    async def fly(self, sku: str) -> None:
+        try:
+            while group := self.waiting.get(sku):
+                self.waiting[sku] = group[self.max_group :]
+                await self.commit(sku, group[: self.max_group])
+        finally:
+            del self.flights[sku]
+            for _, _, done in self.waiting.pop(sku, []):
+                done.cancel()
+
+    async def commit(self, sku: str, group: Group) -> None:
+        while True:
+            # the lines of callers that are gone are not allocated
+            group = [entry for entry in group if not entry[2].done()]
+            if not group:
+                return
+            try:
+                results = await self.allocate_group(
+                    sku, [cmd for cmd, _, _ in group], group[0][1]
+                )
+            except asyncio.CancelledError:
+                for _, _, done in group:
+                    done.cancel()
+                raise
+            except LineFailed as e:
+                failed = group.pop(e.position)[2]
+                if not failed.done():
+                    failed.set_exception(e.__cause__ or e)
+                logger.warning(f"A line failed a group of {sku}, committing the others")
+                continue
+            except Exception as e:  # pylint: disable=broad-except
+                for _, _, done in group:
+                    if not done.done():
+                        done.set_exception(e)
+                return
+            for (_, _, done), result in zip(group, results):
+                if not done.done():
+                    done.set_result(result)
+            return
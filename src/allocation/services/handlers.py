@@ -1,10 +1,20 @@
-from dataclasses import asdict
+import asyncio
+import functools
+import logging
+from dataclasses import asdict, dataclass
 from typing import Any, Awaitable, Callable, Sized
 
 from allocation.adapters import notifications
-from allocation.adapters.pyd_model import Batch, OrderLine, Product
+from allocation.adapters.allocations_cache import AbstractAllocationsCache
+from allocation.app.settings import settings
 from allocation.domain import commands, events
-from allocation.services import unit_of_work
+from allocation.domain.model import Batch, OrderLine, Product
+from allocation.repositories import repository
+from allocation.services import retry, unit_of_work
+from allocation.services.group_commit import GroupCommit, LineFailed, LineResult
+from allocation.services.messagebus import handler_options
+
+logger = logging.getLogger(__name__)
 
 AsyncEventHandler = Callable[..., Awaitable[Any | None]]
 Message = commands.Command | events.Event
@@ -18,6 +28,17 @@ class OutOfStockInBatch(Exception):
     pass
 
 
+@dataclass
+class AllocationResult:
+    orderid: str
+    sku: str
+    batchref: str | None
+    # "allocated", "out_of_stock", "invalid_sku", "conflict" (still losing the
+    # optimistic concurrency race after the retries), "error" or "unavailable"
+    # (the shard worker owning the SKU could not be reached)
+    status: str
+
+
 async def allocate_in_current_batch(batch: Batch, orrderlines: set[dict]) -> None:
     to_allocate = [OrderLine(**orderline) for orderline in orrderlines]
     for orderline in to_allocate:
@@ -51,14 +72,19 @@ async def get_all(
 async def add_batch(
     cmd: commands.CreateBatch,
     uow: unit_of_work.AbstractUnitOfWork,
+) -> None:
+    await retry.on_conflict(functools.partial(_add_batch, cmd, uow))
+
+
+async def _add_batch(
+    cmd: commands.CreateBatch,
+    uow: unit_of_work.AbstractUnitOfWork,
 ) -> None:
     async with uow:
         product = await uow.products.get(cmd.sku)
         if not product:
             product = Product(sku=cmd.sku, version_number=0, batches=[])
-        product.add_batch(
-            Batch(reference=cmd.ref, sku=cmd.sku, purchased_quantity=cmd.qty, eta=cmd.eta)
-        )
+        product.add_batch(Batch(cmd.ref, cmd.sku, cmd.qty, cmd.eta))
         await uow.products.add(product)
         await uow.commit()
 
@@ -66,27 +92,142 @@ async def add_batch(
 async def allocate(
     cmd: commands.Allocate,
     uow: unit_of_work.AbstractUnitOfWork,
-) -> None:
-    line = OrderLine(orderid=cmd.orderid, sku=cmd.sku, qty=cmd.qty)
+    group_commit: GroupCommit | None = None,
+) -> str | None:
+    if group_commit is not None:
+        batchref, raised = await group_commit.allocate(cmd, uow)
+        uow.hand_over(raised)
+        return batchref
+    return await retry.on_conflict(functools.partial(_allocate, cmd, uow))
+
+
+async def _allocate(
+    cmd: commands.Allocate,
+    uow: unit_of_work.AbstractUnitOfWork,
+) -> str | None:
+    [(batchref, _)] = await _allocate_sku(cmd.sku, [cmd], uow)
+    return batchref
+
+
+async def allocate_many(
+    cmd: commands.AllocateMany,
+    uow_factory: Callable[[], unit_of_work.AbstractUnitOfWork],
+) -> list[AllocationResult]:
+    """Allocate the lines SKU by SKU: one product load and one commit per SKU."""
+    positions: dict[str, list[int]] = {}
+    for position, line in enumerate(cmd.lines):
+        positions.setdefault(line.sku, []).append(position)
+    results: list[AllocationResult | None] = [None] * len(cmd.lines)
+    limit = asyncio.Semaphore(settings.bulk_allocate_concurrency)
+
+    async def allocate_sku(sku: str, sku_positions: list[int]) -> None:
+        lines = [cmd.lines[position] for position in sku_positions]
+        async with limit:
+            try:
+                batchrefs = [
+                    batchref
+                    for batchref, _ in await retry.on_conflict(
+                        functools.partial(_allocate_sku, sku, lines, uow_factory())
+                    )
+                ]
+                statuses = ["allocated" if ref else "out_of_stock" for ref in batchrefs]
+            # the other SKUs may be committed already: fail only these lines
+            except InvalidSku:
+                batchrefs = [None] * len(lines)
+                statuses = ["invalid_sku"] * len(lines)
+            except repository.SynchronousUpdateError:
+                batchrefs = [None] * len(lines)
+                statuses = ["conflict"] * len(lines)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception(f"Exception allocating the lines of {sku}")
+                batchrefs = [None] * len(lines)
+                statuses = ["error"] * len(lines)
+        for position, line, batchref, status in zip(
+            sku_positions, lines, batchrefs, statuses
+        ):
+            results[position] = AllocationResult(line.orderid, sku, batchref, status)
+
+    await asyncio.gather(*(allocate_sku(sku, p) for sku, p in positions.items()))
+    return [result for result in results if result is not None]
+
+
+async def allocate_group(
+    sku: str,
+    lines: list[commands.Allocate],
+    uow: unit_of_work.AbstractUnitOfWork,
+) -> list[LineResult]:
+    """The transaction of a GroupCommit."""
+    return await retry.on_conflict(
+        functools.partial(_allocate_sku, sku, lines, uow, group=True)
+    )
+
+
+async def _allocate_sku(
+    sku: str,
+    lines: list[commands.Allocate],
+    uow: unit_of_work.AbstractUnitOfWork,
+    group: bool = False,
+) -> list[LineResult]:
+    """The batch reference of each line and the events raised allocating it.
+
+    For a group the events are taken off the product, to be handed to the
+    caller of each line, and an error allocating a line is a LineFailed.
+    """
     async with uow:
-        product = await uow.products.get(line.sku)
+        product = await uow.products.get(sku, allocations=False)
         if not product:
-            raise InvalidSku(f"Invalid sku {line.sku}")
-        product.allocate(line)
+            raise InvalidSku(f"Invalid sku {sku}")
+        # retried and redelivered commands allocate an order's line only once
+        allocated = await uow.products.allocated_batches(
+            sku, [line.orderid for line in lines]
+        )
+        results: list[LineResult] = []
+        for position, line in enumerate(lines):
+            raised = len(product.events)
+            batchref = allocated.get(line.orderid)
+            if batchref is None:
+                try:
+                    batchref = product.allocate(
+                        OrderLine(orderid=line.orderid, sku=sku, qty=line.qty)
+                    )
+                except Exception as e:
+                    if group:
+                        raise LineFailed(position) from e
+                    raise
+                if batchref is not None:
+                    allocated[line.orderid] = batchref
+            results.append((batchref, product.events[raised:]))
         await uow.products.add(product)
         await uow.commit()
+    if group:
+        product.events.clear()
+    return results
 
 
 async def change_batch_quantity(
     cmd: commands.ChangeBatchQuantity,
     uow: unit_of_work.AbstractUnitOfWork,
+):
+    await retry.on_conflict(functools.partial(_change_batch_quantity, cmd, uow))
+
+
+async def _change_batch_quantity(
+    cmd: commands.ChangeBatchQuantity,
+    uow: unit_of_work.AbstractUnitOfWork,
 ):
     async with uow:
-        product = await uow.products.get_by_batchref(batchref=cmd.ref)
+        # the lines of the batch, in case some have to be deallocated
+        product = await uow.products.get_by_batchref(
+            batchref=cmd.ref, allocations=False, batch_lines=True
+        )
+        if not product:
+            raise InvalidSku(f"Invalid sku of batch {cmd.ref}")
         product.change_batch_quantity(ref=cmd.ref, qty=cmd.qty)
+        await uow.products.add(product)
         await uow.commit()
 
 
+@handler_options(independent=True, deferred=True, idempotent=True)
 async def reallocate(
     event: events.Deallocated,
     uow: unit_of_work.AbstractUnitOfWork,
@@ -94,6 +235,7 @@ async def reallocate(
     await allocate(cmd=commands.Allocate(**asdict(event)), uow=uow)
 
 
+@handler_options(deferred=True)
 async def send_out_of_stock_notification(
     event: events.OutOfStock,
     notifications: notifications.AbstractNotifications,
@@ -104,6 +246,7 @@ async def send_out_of_stock_notification(
     )
 
 
+@handler_options(independent=True, deferred=True)
 async def publish_allocated_event(
     event: events.Allocated,
     publish: Callable[..., Awaitable[None]],
@@ -111,11 +254,15 @@ async def publish_allocated_event(
     await publish("line_allocated", event)
 
 
+@handler_options(independent=True, deferred=True)
 async def add_allocation_to_read_model(
     event: events.Allocated,
     uow: unit_of_work.EdgedbUnitOfWork,
+    allocations_cache: AbstractAllocationsCache,
 ):
-    async with uow:
+    # a single write needs no transaction, which would hold a second
+    # connection of the pool while it runs
+    with repository.query_seconds.time("add_allocation_view"):
         await uow.async_client.query(
             """ INSERT AllocationsView {
                     batchref := <str>$batchref,
@@ -126,14 +273,17 @@ async def add_allocation_to_read_model(
             orderid=event.orderid,
             sku=event.sku,
         )
-        await uow.commit()
+    await allocations_cache.invalidate(event.orderid)
 
 
+# neither deferred nor independent: the view of the line is removed before
+# reallocate runs, or a late removal would delete the view of the new line
 async def remove_allocation_from_read_model(
     event: events.Deallocated,
     uow: unit_of_work.EdgedbUnitOfWork,
+    allocations_cache: AbstractAllocationsCache,
 ):
-    async with uow:
+    with repository.query_seconds.time("remove_allocation_view"):
         await uow.async_client.query(
             """ DELETE AllocationsView
                 FILTER
@@ -142,7 +292,7 @@ async def remove_allocation_from_read_model(
             orderid=event.orderid,
             sku=event.sku,
         )
-        await uow.commit()
+    await allocations_cache.invalidate(event.orderid)
 
 
 EVENT_HANDLERS: dict[type[events.Event], list[AsyncEventHandler]] = {
@@ -154,8 +304,15 @@ EVENT_HANDLERS: dict[type[events.Event], list[AsyncEventHandler]] = {
     events.OutOfStock: [send_out_of_stock_notification],
 }
 
+# the handlers that publish events to Redis themselves, see adapters/outbox.py
+PUBLISHERS = (publish_allocated_event,)
+
+# the handlers that keep the read model of EdgeDB up to date
+READ_MODEL_HANDLERS = (add_allocation_to_read_model, remove_allocation_from_read_model)
+
 COMMAND_HANDLERS: dict[type[commands.Command], AsyncEventHandler] = {
     commands.Allocate: allocate,
+    commands.AllocateMany: allocate_many,
     commands.ChangeBatchQuantity: change_batch_quantity,
     commands.CreateBatch: add_batch,
 }
@@ -1,72 +1,231 @@
 import abc
+import asyncio
+import functools
 import logging
+import time
+from collections import deque
+from dataclasses import dataclass
 from typing import Any, Awaitable, Callable
 
+from allocation import metrics
+from allocation.app.settings import settings
 from allocation.domain import commands, events
 
 from . import unit_of_work
+from .background import BackgroundQueue
 
 logger = logging.getLogger(__name__)
 
 AsyncEventHandler = Callable[..., Awaitable[Any | None]]
 Message = commands.Command | events.Event
+MessageQueue = deque[Message]
+
+handler_seconds = metrics.Histogram(
+    "allocation_handler_seconds",
+    "Time spent in the messagebus handlers, failures included.",
+    ("kind", "message", "handler"),
+)
+handler_failures = metrics.Counter(
+    "allocation_handler_failures_total",
+    "Messagebus handlers that raised or timed out.",
+    ("kind", "message", "handler"),
+)
+bus_messages = metrics.Gauge(
+    "allocation_bus_messages",
+    "Messages handed to the messagebus, waiting for a slot or being handled.",
+    ("state",),
+)
+
+
+@dataclass(frozen=True)
+class HandlerOptions:
+    # may run at the same time as the other independent handlers of its event
+    independent: bool = False
+    # seconds before the handler is cancelled, None - settings.event_handler_timeout
+    timeout: float | None = None
+    # needs only the committed results of the message that raised the event:
+    # run in the background, after that message is handled, on a bus that has
+    # a BackgroundQueue
+    deferred: bool = False
+    # may run again after it failed: a deferred one is retried in the background
+    idempotent: bool = False
+
+
+DEFAULT_OPTIONS = HandlerOptions()
+
+
+def handler_options(**options) -> Callable[[AsyncEventHandler], AsyncEventHandler]:
+    """Set the HandlerOptions of an event handler."""
+
+    def decorate(handler: AsyncEventHandler) -> AsyncEventHandler:
+        handler.options = HandlerOptions(**options)  # type: ignore[attr-defined]
+        return handler
+
+    return decorate
+
+
+def options_of(handler: AsyncEventHandler) -> HandlerOptions:
+    return getattr(handler, "options", DEFAULT_OPTIONS)
 
 
 class AbstractMessageBus(abc.ABC):
     def __init__(
         self,
-        uow: unit_of_work.AbstractUnitOfWork,
+        uow_factory: unit_of_work.AbstractUnitOfWorkFactory,
         event_handlers: dict[type[events.Event], list[AsyncEventHandler]],
         command_handlers: dict[type[commands.Command], AsyncEventHandler],
+        max_concurrency: int | None = None,
+        background: BackgroundQueue | None = None,
     ) -> None:
-        self.uow = uow
+        self.uow_factory = uow_factory
         self.event_handlers = event_handlers
         self.command_handlers = command_handlers
+        self.concurrency = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+        self.background = background
 
     async def handle(self, message: Message):
-        self.queue = [message]
-        while self.queue:
-            message = self.queue.pop(0)
+        if self.concurrency is None:
+            return await self._handle(message)
+        bus_messages.inc("waiting")
+        try:
+            await self.concurrency.acquire()
+        finally:
+            bus_messages.dec("waiting")
+        try:
+            return await self._handle(message)
+        finally:
+            self.concurrency.release()
+
+    async def _handle(self, message: Message):
+        # every call has its own queue: concurrent calls must not share events
+        bus_messages.inc("handling")
+        try:
+            return await self.process(deque([message]))
+        finally:
+            bus_messages.dec("handling")
+
+    async def process(self, queue: MessageQueue):
+        result = None
+        while queue:
+            message = queue.popleft()
             match message:
                 case events.Event():
-                    await self.event_handler(message)
+                    await self.event_handler(message, queue)
                 case commands.Command():
-                    await self.command_handler(message)
+                    result = await self.command_handler(message, queue)
                 case _:
                     raise Exception(f"{message} was not an Event or Command")
+        return result
+
+    async def call_handler(
+        self, handler: AsyncEventHandler, message: Message, queue: MessageQueue
+    ):
+        """Run a handler and queue the events of every unit of work it used."""
+        issued: list[unit_of_work.AbstractUnitOfWork] = []
+
+        def uow_factory() -> unit_of_work.AbstractUnitOfWork:
+            uow = self.uow_factory()
+            issued.append(uow)
+            return uow
+
+        labels = (
+            "command" if isinstance(message, commands.Command) else "event",
+            type(message).__name__,
+            getattr(handler, "__name__", type(handler).__name__),
+        )
+        started = time.perf_counter()
+        try:
+            result = await handler(message, uow_factory)
+        except BaseException:
+            handler_failures.inc(*labels)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, *labels)
+        for uow in issued:
+            queue.extend([event async for event in uow.collect_new_events() if event])
+        return result
 
     @abc.abstractmethod
-    async def event_handler(self, event: events.Event):
+    async def event_handler(self, event: events.Event, queue: MessageQueue):
         pass
 
     @abc.abstractmethod
-    async def command_handler(self, command: commands.Command):
+    async def command_handler(self, command: commands.Command, queue: MessageQueue):
         pass
 
 
 class MessageBus(AbstractMessageBus):
-    async def event_handler(self, event: events.Event):
+    async def event_handler(self, event: events.Event, queue: MessageQueue):
+        """Run the handlers of an event in order, the independent ones among
+        them at the same time. A failing handler does not stop the others.
+        The deferred ones are left to the background queue."""
+        independent: list[AsyncEventHandler] = []
         for handler in self.event_handlers[type(event)]:
-            try:
-                logger.debug(f"handling event {event} with handler {handler}")
-                await handler(event)
-                events_list = [
-                    event async for event in self.uow.collect_new_events() if event
-                ]
-                self.queue.extend(events_list)
-            except Exception:
-                logger.exception(f"Exception handling event {event}")
+            if self.background is not None and options_of(handler).deferred:
+                await self.background.submit(
+                    self.job_name(handler, event),
+                    functools.partial(self.run_deferred, handler, event),
+                )
                 continue
+            if options_of(handler).independent:
+                independent.append(handler)
+                continue
+            await self.run_event_handlers(independent, event, queue)
+            independent = []
+            await self.run_event_handlers([handler], event, queue)
+        await self.run_event_handlers(independent, event, queue)
+
+    async def run_event_handlers(
+        self,
+        handlers: list[AsyncEventHandler],
+        event: events.Event,
+        queue: MessageQueue,
+    ):
+        if not handlers:
+            return
+        results = await asyncio.gather(
+            *(self.call_event_handler(handler, event, queue) for handler in handlers),
+            return_exceptions=True,
+        )
+        for handler, result in zip(handlers, results):
+            name = getattr(handler, "__name__", handler)
+            if isinstance(result, asyncio.TimeoutError):
+                logger.error(f"Timeout handling event {event} with handler {name}")
+            elif isinstance(result, BaseException):
+                logger.error(
+                    f"Exception handling event {event} with handler {name}",
+                    exc_info=result,
+                )
+
+    async def run_deferred(self, handler: AsyncEventHandler, event: events.Event):
+        """Run a deferred handler, retrying it if it is idempotent, and then
+        handle the events it raises, which are not retried with it."""
+        queue: MessageQueue = deque()
+        run = functools.partial(self.call_event_handler, handler, event, queue)
+        if self.background is not None and options_of(handler).idempotent:
+            await self.background.retry(self.job_name(handler, event), run)
+        else:
+            await run()
+        await self.process(queue)
+
+    @staticmethod
+    def job_name(handler: AsyncEventHandler, event: events.Event) -> str:
+        return f"{getattr(handler, '__name__', handler)}({event})"
+
+    async def call_event_handler(
+        self, handler: AsyncEventHandler, event: events.Event, queue: MessageQueue
+    ):
+        logger.debug(f"handling event {event} with handler {handler}")
+        timeout = options_of(handler).timeout or settings.event_handler_timeout
+        return await asyncio.wait_for(
+            self.call_handler(handler, event, queue), timeout=timeout or None
+        )
 
-    async def command_handler(self, command: commands.Command):
+    async def command_handler(self, command: commands.Command, queue: MessageQueue):
         handler = self.command_handlers[type(command)]
         try:
             logger.debug(f"handling command {command}")
-            await handler(command)
-            commands_list = [
-                command async for command in self.uow.collect_new_events() if command
-            ]
-            self.queue.extend(commands_list)
+            return await self.call_handler(handler, command, queue)
         except Exception:
             logger.exception(
                 f"Exception handling command {command} with handler {handler}"
@@ -0,0 +1,55 @@
+import asyncio
+import logging
+import random
+from dataclasses import dataclass
+from typing import Awaitable, Callable, TypeVar
+
+from allocation import metrics
+from allocation.app.settings import settings
+from allocation.repositories.repository import SynchronousUpdateError
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+@dataclass
+class ConflictStats:
+    conflicts: int = 0
+    retries: int = 0
+    exhausted: int = 0
+
+
+stats = ConflictStats()
+
+conflicts = metrics.Counter(
+    "allocation_conflicts_total",
+    "Commits that lost the optimistic concurrency race, retried or given up on.",
+    ("outcome",),
+)
+
+
+def backoff(attempt: int) -> float:
+    """Full jitter: a random delay up to the capped exponential backoff."""
+    ceiling = settings.conflict_retry_base_delay * 2 ** (attempt - 1)
+    return random.uniform(0, min(settings.conflict_retry_max_delay, ceiling))
+
+
+async def on_conflict(func: Callable[[], Awaitable[T]]) -> T:
+    """Run func again while it loses the optimistic concurrency race."""
+    attempts = max(1, settings.conflict_retry_attempts)
+    for attempt in range(1, attempts + 1):
+        try:
+            return await func()
+        except SynchronousUpdateError:
+            stats.conflicts += 1
+            if attempt >= attempts:
+                stats.exhausted += 1
+                conflicts.inc("exhausted")
+                raise
+            stats.retries += 1
+            conflicts.inc("retried")
+            delay = backoff(attempt)
+            logger.debug(f"version conflict, attempt {attempt} retries in {delay:.3f}s")
+            await asyncio.sleep(delay)
+    raise AssertionError("unreachable")
@@ -0,0 +1,244 @@
+"""Commands of a SKU sent to the one worker that owns it.
+
+SKUs are spread over the workers with consistent hashing, so that a worker
+joining or leaving moves only the SKUs it takes or gives up. A worker
+applies the Allocate and CreateBatch commands of its SKUs through its
+messagebus. Those are not its SKUs' only writers: ChangeBatchQuantity
+names a batch, not a SKU, so it and the reallocations it causes run on the
+bus of whoever handles it, and a SKU that moves during a rebalance is
+written by two workers for a while. All of them are safe, as the stored
+version_number is checked on every commit and conflicts are retried.
+
+With sharding "local" the workers are tasks of the API process that share
+its messagebus: the commands go through the ring and the transport, but
+are not isolated from each other or from the API's own commands.
+"""
+from __future__ import annotations
+
+import asyncio
+import bisect
+import hashlib
+import logging
+from dataclasses import asdict
+from datetime import date
+from typing import Any
+
+from allocation.adapters.shard_transport import (
+    AbstractShardTransport,
+    Reply,
+    ShardUnavailable,
+)
+from allocation.domain import commands
+
+from . import handlers, messagebus
+
+logger = logging.getLogger(__name__)
+
+
+class ShardError(Exception):
+    pass
+
+
+def ring_hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Keys owned by nodes, each node placed at vnodes points of the ring."""
+
+    def __init__(self, nodes=(), vnodes: int = 64) -> None:
+        self.vnodes = vnodes
+        self.points: list[int] = []
+        self.owners: dict[int, str] = {}
+        self.nodes: set[str] = set()
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node: str) -> None:
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for i in range(self.vnodes):
+            point = ring_hash(f"{node}#{i}")
+            self.owners[point] = node
+            bisect.insort(self.points, point)
+
+    def remove(self, node: str) -> None:
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        self.points = [point for point in self.points if self.owners[point] != node]
+        self.owners = {point: self.owners[point] for point in self.points}
+
+    def owner(self, key: str) -> str:
+        if not self.points:
+            raise ShardError("no shard worker is up")
+        i = bisect.bisect(self.points, ring_hash(key)) % len(self.points)
+        return self.owners[self.points[i]]
+
+
+COMMANDS: dict[str, type[commands.Command]] = {
+    command.__name__: command
+    for command in (commands.Allocate, commands.AllocateMany, commands.CreateBatch)
+}
+
+
+def shard_key(message: messagebus.Message) -> str | None:
+    if isinstance(message, (commands.Allocate, commands.CreateBatch)):
+        return message.sku
+    return None
+
+
+def encode(command: commands.Command) -> dict[str, Any]:
+    data = asdict(command)
+    if isinstance(command, commands.CreateBatch) and command.eta is not None:
+        data["eta"] = command.eta.isoformat()
+    return {"command": type(command).__name__, "data": data}
+
+
+def decode(message: dict[str, Any]) -> commands.Command:
+    data = dict(message["data"])
+    command = COMMANDS[message["command"]]
+    if command is commands.AllocateMany:
+        data["lines"] = [commands.Allocate(**line) for line in data["lines"]]
+    elif command is commands.CreateBatch and data["eta"] is not None:
+        data["eta"] = date.fromisoformat(data["eta"])
+    return command(**data)
+
+
+def encode_result(result: Any) -> Any:
+    if isinstance(result, list):
+        return [asdict(item) for item in result]
+    return result
+
+
+def decode_result(command: commands.Command, result: Any) -> Any:
+    if isinstance(command, commands.AllocateMany):
+        return [handlers.AllocationResult(**item) for item in result]
+    return result
+
+
+class ShardRouter:
+    """Sends each command to the worker owning its SKU and returns its result.
+
+    The ring follows the workers the transport knows of, refreshed every
+    refresh_interval. Commands without a SKU are handled by the local bus.
+    """
+
+    def __init__(
+        self,
+        transport: AbstractShardTransport,
+        bus: messagebus.AbstractMessageBus,
+        vnodes: int = 64,
+        refresh_interval: float = 1.0,
+    ) -> None:
+        self.transport = transport
+        self.bus = bus
+        self.ring = HashRing(vnodes=vnodes)
+        self.refresh_interval = refresh_interval
+        self.refresher: asyncio.Task | None = None
+
+    async def refresh(self) -> None:
+        members = await self.transport.members()
+        for worker in self.ring.nodes - members:
+            logger.info(f"shard worker {worker} left, rebalancing")
+            self.ring.remove(worker)
+        for worker in members - self.ring.nodes:
+            logger.info(f"shard worker {worker} joined, rebalancing")
+            self.ring.add(worker)
+
+    async def refresh_forever(self) -> None:
+        while True:
+            try:
+                await self.refresh()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Refreshing the shard workers failed")
+            await asyncio.sleep(self.refresh_interval)
+
+    async def start(self) -> None:
+        await self.refresh()
+        self.refresher = asyncio.create_task(self.refresh_forever())
+
+    async def aclose(self) -> None:
+        if self.refresher is not None:
+            self.refresher.cancel()
+            await asyncio.gather(self.refresher, return_exceptions=True)
+
+    async def handle(self, message: messagebus.Message) -> Any:
+        if isinstance(message, commands.AllocateMany):
+            return await self.allocate_many(message)
+        key = shard_key(message)
+        if key is None or not isinstance(message, commands.Command):
+            return await self.bus.handle(message)
+        return await self.forward(self.ring.owner(key), message)
+
+    async def forward(self, worker: str, command: commands.Command) -> Any:
+        reply = await self.transport.request(worker, encode(command))
+        if reply.get("error") == "InvalidSku":
+            raise handlers.InvalidSku(reply["message"])
+        if "error" in reply:
+            raise ShardError(f"{worker}: {reply['error']}: {reply['message']}")
+        return decode_result(command, reply["result"])
+
+    async def allocate_many(
+        self, command: commands.AllocateMany
+    ) -> list[handlers.AllocationResult]:
+        """Split the lines by owner, one AllocateMany each, in their order.
+
+        The lines of an owner that cannot be reached are "unavailable", the
+        others are allocated all the same.
+        """
+        positions: dict[str, list[int]] = {}
+        for position, line in enumerate(command.lines):
+            positions.setdefault(self.ring.owner(line.sku), []).append(position)
+        results: list[handlers.AllocationResult | None] = [None] * len(command.lines)
+
+        async def forward_part(worker: str, part: list[int]) -> None:
+            lines = [command.lines[position] for position in part]
+            try:
+                part_results = await self.forward(worker, commands.AllocateMany(lines))
+            except (ShardError, ShardUnavailable) as e:
+                logger.error(f"Allocating {len(lines)} lines on {worker} failed: {e}")
+                part_results = [
+                    handlers.AllocationResult(line.orderid, line.sku, None, "unavailable")
+                    for line in lines
+                ]
+            for position, result in zip(part, part_results):
+                results[position] = result
+
+        await asyncio.gather(*(forward_part(w, p) for w, p in positions.items()))
+        return [result for result in results if result is not None]
+
+
+class ShardWorker:
+    """Applies the commands sent to it, several at a time."""
+
+    def __init__(
+        self,
+        name: str,
+        transport: AbstractShardTransport,
+        bus: messagebus.AbstractMessageBus,
+    ) -> None:
+        self.name = name
+        self.transport = transport
+        self.bus = bus
+        self.running: set[asyncio.Task] = set()
+
+    async def run(self) -> None:
+        await self.transport.join(self.name)
+        try:
+            async for message, reply in self.transport.requests(self.name):
+                task = asyncio.create_task(self.apply(message, reply))
+                self.running.add(task)
+                task.add_done_callback(self.running.discard)
+        finally:
+            await self.transport.leave(self.name)
+            await asyncio.gather(*self.running, return_exceptions=True)
+
+    async def apply(self, message: dict[str, Any], reply: Reply) -> None:
+        try:
+            result = await self.bus.handle(decode(message))
+        except Exception as e:  # pylint: disable=broad-except
+            await reply({"error": type(e).__name__, "message": str(e)})
+            return
+        await reply({"result": encode_result(result)})
@@ -5,7 +5,11 @@ import abc
 
 import edgedb
 
-from allocation.repositories import repository
+from allocation.app.settings import settings
+from allocation.domain import commands, events
+from allocation.repositories import cache, memory, repository
+
+NO_RETRIES = edgedb.RetryOptions(attempts=1)
 
 
 class AbstractUnitOfWork(abc.ABC):
@@ -27,33 +31,152 @@ class AbstractUnitOfWork(abc.ABC):
         for product in self.products.seen:
             while product.events:
                 yield product.events.pop(0)
+        handed_over = getattr(self, "handed_over", [])
+        while handed_over:
+            yield handed_over.pop(0)
+
+    def hand_over(self, new_events: list[events.Event | commands.Command]) -> None:
+        """Events of this unit of work's message raised in another unit of
+        work, as those of a GroupCommit."""
+        self.handed_over = [*getattr(self, "handed_over", []), *new_events]
+
+
+class AbstractUnitOfWorkFactory(abc.ABC):
+    """Hands out a unit of work for every message handled by the messagebus.
+
+    The factory owns the resources shared between units of work (a connection
+    pool), so it is the one that is connected on startup and closed on shutdown.
+    """
+
+    # its units of work write the published events to the outbox with the
+    # products that raised them, see adapters/outbox.py
+    use_outbox = False
+
+    @abc.abstractmethod
+    def __call__(self) -> AbstractUnitOfWork:
+        raise NotImplementedError
+
+    async def connect(self) -> None:
+        pass
+
+    async def aclose(self) -> None:
+        pass
+
+
+class SharedUnitOfWorkFactory(AbstractUnitOfWorkFactory):
+    """Always returns the same unit of work, e.g. a fake one in tests."""
+
+    def __init__(self, uow: AbstractUnitOfWork) -> None:
+        self.uow = uow
+
+    def __call__(self) -> AbstractUnitOfWork:
+        return self.uow
 
 
 class EdgedbUnitOfWork(AbstractUnitOfWork):
     products: repository.EdgeDBRepository
 
-    def __init__(self, async_client) -> None:
+    def __init__(
+        self,
+        async_client,
+        product_cache: cache.ProductCache | None = None,
+        use_outbox: bool = False,
+    ) -> None:
         self.async_client: edgedb.AsyncIOClient = async_client
+        self.product_cache = product_cache
+        self.use_outbox = use_outbox
+        self.products = repository.EdgeDBRepository(async_client, product_cache)
 
     async def __aenter__(self) -> None:
-        async for tx in self.async_client.transaction():
+        # conflicts are retried by the handlers with a fresh unit of work, the
+        # client must neither retry nor swallow them on its own
+        client = self.async_client.with_retry_options(NO_RETRIES)
+        async for tx in client.transaction():
             self.transaction = tx
             break
-        self.products = repository.EdgeDBRepository(self.transaction)
+        self.products = repository.EdgeDBRepository(
+            self.transaction, self.product_cache, self.use_outbox
+        )
+        self.committed = False
         await self.transaction.__aenter__()
 
     async def __aexit__(self, extype, ex, tb) -> bool | None:
+        if self.committed:
+            # commit has already released the connection back to the pool
+            return None
         try:
             await self.transaction.__aexit__(Exception, Exception(), tb)
         except (edgedb.errors.InternalClientError, edgedb.errors.InterfaceError):
-            await self.async_client.aclose()
             return True
-        # TODO: implement Optimistic parallelism with version numbers
-        # except repository.SynchronousUpdateError:
-        #     await self.async_client.aclose()
-        #     return False
-        await self.async_client.aclose()
         return None
 
     async def commit(self):
-        return await self.transaction.__aexit__(None, None, None)
+        self.committed = True
+        try:
+            return await self.transaction.__aexit__(None, None, None)
+        except edgedb.errors.TransactionConflictError as e:
+            raise repository.SynchronousUpdateError(
+                "could not serialize access due to concurrent update"
+            ) from e
+
+
+class EdgedbUnitOfWorkFactory(AbstractUnitOfWorkFactory):
+    """Gives every message its own unit of work over one long-lived pool,
+    and the product cache they share."""
+
+    def __init__(
+        self,
+        async_client,
+        product_cache: cache.ProductCache | None = None,
+        use_outbox: bool | None = None,
+    ) -> None:
+        self.async_client: edgedb.AsyncIOClient = async_client
+        self.product_cache = product_cache
+        if use_outbox is None:
+            use_outbox = settings.event_publishing == "outbox"
+        self.use_outbox = use_outbox
+
+    def __call__(self) -> EdgedbUnitOfWork:
+        return EdgedbUnitOfWork(self.async_client, self.product_cache, self.use_outbox)
+
+    async def connect(self) -> None:
+        await self.async_client.ensure_connected()
+
+    async def aclose(self) -> None:
+        await self.async_client.aclose()
+
+
+class InMemoryUnitOfWork(AbstractUnitOfWork):
+    products: memory.InMemoryRepository
+
+    def __init__(self, store: memory.ProductStore) -> None:
+        self.store = store
+        self.products = memory.InMemoryRepository(store)
+
+    async def __aenter__(self) -> None:
+        self.products = memory.InMemoryRepository(self.store)
+
+    async def __aexit__(self, extype, ex, tb) -> None:
+        # whatever was not committed is dropped, the store never saw it
+        self.products.rollback()
+
+    async def commit(self):
+        self.products.commit()
+
+
+class InMemoryUnitOfWorkFactory(AbstractUnitOfWorkFactory):
+    """Units of work over the products kept in this process, see
+    repositories/memory.py."""
+
+    def __init__(self, store: memory.ProductStore | None = None) -> None:
+        self.store = store if store is not None else memory.ProductStore()
+
+    def __call__(self) -> InMemoryUnitOfWork:
+        return InMemoryUnitOfWork(self.store)
+
+    async def connect(self) -> None:
+        self.store.load()
+        self.store.start()
+
+    async def aclose(self) -> None:
+        await self.store.aclose()
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import zlib
+from typing import Awaitable, Callable
+
+from allocation import metrics
+
+logger = logging.getLogger(__name__)
+
+Job = Callable[[], Awaitable[object]]
+
+queued_jobs = metrics.Gauge(
+    "allocation_worker_pool_jobs",
+    "Jobs queued on each partition of the worker pools, the running one included.",
+    ("partition",),
+)
+
+
+def partition_of(key: str, partitions: int) -> int:
+    """The same partition for a key in every process, unlike hash()."""
+    return zlib.crc32(key.encode()) % partitions
+
+
+class PartitionedWorkerPool:
+    """Runs jobs on a fixed number of workers, each with its own queue.
+
+    The jobs of one key always go to the same worker, so they run one after
+    the other in the order they were submitted, while jobs of keys on other
+    workers run at the same time. A queue holds at most queue_size jobs:
+    submit waits for room, so a burst is held back where it comes from.
+    """
+
+    def __init__(self, workers: int = 8, queue_size: int = 100) -> None:
+        self.queues: list[asyncio.Queue[tuple[Job, asyncio.Future]]] = [
+            asyncio.Queue(queue_size) for _ in range(max(1, workers))
+        ]
+        self.tasks: list[asyncio.Task] = []
+        self.failed = 0
+
+    def depths(self) -> list[int]:
+        return [queue.qsize() for queue in self.queues]
+
+    def start(self) -> None:
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self.work(queue)) for queue in self.queues]
+
+    async def submit(self, key: str, job: Job) -> asyncio.Future:
+        """Queue the job, return a future of whether it succeeded."""
+        self.start()
+        done = asyncio.get_running_loop().create_future()
+        partition = partition_of(key, len(self.queues))
+        await self.queues[partition].put((job, done))
+        queued_jobs.inc(str(partition))
+        return done
+
+    async def work(self, queue: asyncio.Queue[tuple[Job, asyncio.Future]]) -> None:
+        partition = str(self.queues.index(queue))
+        while True:
+            job, done = await queue.get()
+            try:
+                await job()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Exception in a partitioned job")
+                self.failed += 1
+                done.set_result(False)
+            else:
+                done.set_result(True)
+            finally:
+                queue.task_done()
+                queued_jobs.dec(partition)
+
+    async def join(self) -> None:
+        for queue in self.queues:
+            await queue.join()
+
+    async def aclose(self) -> None:
+        """Finish the queued jobs and stop the workers."""
+        await self.join()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
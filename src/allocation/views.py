@@ -1,14 +1,37 @@
+from typing import cast
+
+from allocation.adapters.allocations_cache import AbstractAllocationsCache
+from allocation.repositories import repository
 from allocation.services import unit_of_work
 
 
 async def allocations(
-    orderid: str, uow: unit_of_work.EdgedbUnitOfWork
+    orderid: str,
+    uow: unit_of_work.AbstractUnitOfWork,
+    cache: AbstractAllocationsCache | None = None,
 ) -> list[dict[str, str]]:
-    async with uow:
-        results = await uow.async_client.query(
+    if isinstance(uow, unit_of_work.InMemoryUnitOfWork):
+        # the products kept in memory are their own read model, up to date
+        # with every commit: there is nothing to cache
+        return uow.store.allocations(orderid)
+    generation = 0
+    if cache is not None:
+        cached = await cache.get(orderid)
+        if cached is not None:
+            return cached
+        generation = await cache.generation(orderid)
+    # any other unit of work reads the EdgeDB read model; a single read needs
+    # no transaction
+    client = cast(unit_of_work.EdgedbUnitOfWork, uow).async_client
+    with repository.query_seconds.time("allocations_view"):
+        results = await client.query(
             """ SELECT AllocationsView {sku, batchref}
                   FILTER .orderid = <str>$orderid
             """,
             orderid=orderid,
         )
-    return [{"sku": result.sku, "batchref": result.batchref} for result in results]
+    view = [{"sku": result.sku, "batchref": result.batchref} for result in results]
+    # an order not allocated yet is polled until it is: not cached
+    if cache is not None and view:
+        await cache.set(orderid, view, generation)
+    return view
@@ -38,12 +38,12 @@ async def async_test_client(
 ) -> AsyncGenerator[AsyncClient, str]:
     app = make_app()
     app.state.bus = bootstrap.bootstrap.messagebus
-    app.state.bus.uow.async_client = async_client_db
+    app.state.bus.uow_factory.async_client = async_client_db
 
     async with AsyncClient(app=app, base_url=settings.get_api_url()) as client:
         yield client
     bus, app.state.bus = app.state.bus, None
-    await bus.uow.async_client.aclose()
+    await bus.uow_factory.aclose()
 
 
 @pytest.fixture
@@ -25,3 +25,9 @@ async def post_to_allocate(async_test_client, orderid, sku, qty, expect_success=
 
 async def get_allocation(async_test_client, orderid):
     return await async_test_client.get(f"{API_URL}/allocations/{orderid}")
+
+
+async def post_to_allocate_bulk(async_test_client, lines):
+    r = await async_test_client.post(f"{API_URL}/allocate/bulk", json={"lines": lines})
+    assert r.status_code == HTTPStatus.OK
+    return r.json()
@@ -2,6 +2,7 @@ import json
 
 import redis.asyncio as redis
 
+from allocation.adapters import command_stream
 from allocation.app.settings import settings
 
 REDIS_URL = settings.get_redis_url()
@@ -18,4 +19,9 @@ async def subscribe_to(channel):
 
 
 async def publish_message(channel, message):
+    if settings.command_channel == "streams":
+        await command_stream.add_command(
+            r, channel, message, maxlen=settings.command_stream_maxlen
+        )
+        return
     await r.publish(channel, json.dumps(message))
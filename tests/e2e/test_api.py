@@ -2,7 +2,12 @@ from http import HTTPStatus
 
 import pytest
 
-from tests.e2e.api_client import get_allocation, post_to_add_batch, post_to_allocate
+from tests.e2e.api_client import (
+    get_allocation,
+    post_to_add_batch,
+    post_to_allocate,
+    post_to_allocate_bulk,
+)
 
 
 async def test_health_check(async_test_client):
@@ -44,3 +49,31 @@ async def test_unhappy_path_returns_400_and_error_message(
 
     r = await get_allocation(async_test_client, orderid)
     assert r.status_code == HTTPStatus.NOT_FOUND
+
+
+@pytest.mark.usefixtures("restart_api")
+async def test_bulk_allocation_returns_a_result_per_line(
+    async_test_client, random_batchref, random_orderid, random_sku
+):
+    sku, othersku = random_sku(), random_sku("other")
+    batch, otherbatch = random_batchref("_1"), random_batchref("_2")
+    orderids = [random_orderid(i) for i in range(3)]
+    await post_to_add_batch(async_test_client, batch, sku, 10, None)
+    await post_to_add_batch(async_test_client, otherbatch, othersku, 10, None)
+
+    results = await post_to_allocate_bulk(
+        async_test_client,
+        [
+            {"orderid": orderids[0], "sku": sku, "qty": 8},
+            {"orderid": orderids[1], "sku": othersku, "qty": 8},
+            {"orderid": orderids[2], "sku": sku, "qty": 8},
+        ],
+    )
+
+    assert [(r["batchref"], r["status"]) for r in results] == [
+        (batch, "allocated"),
+        (otherbatch, "allocated"),
+        (None, "out_of_stock"),
+    ]
+    r = await get_allocation(async_test_client, orderids[1])
+    assert r.json() == [{"sku": othersku, "batchref": otherbatch}]
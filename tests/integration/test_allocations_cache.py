@@ -0,0 +1,38 @@
+import uuid
+
+import pytest
+import redis.asyncio as redis
+
+from allocation.adapters.allocations_cache import RedisAllocationsCache
+from allocation.app.settings import settings
+
+VIEW = [{"sku": "LAMP", "batchref": "b1"}]
+
+
+@pytest.fixture
+async def cache():
+    client = redis.from_url(settings.get_redis_url())
+    yield RedisAllocationsCache(client, ttl=60)
+    await client.aclose()
+
+
+@pytest.fixture
+def orderid():
+    return f"test-order-{uuid.uuid4().hex[:6]}"
+
+
+async def test_views_are_cached_until_invalidated(cache, orderid):
+    await cache.set(orderid, VIEW, await cache.generation(orderid))
+    assert await cache.get(orderid) == VIEW
+
+    await cache.invalidate(orderid)
+    assert await cache.get(orderid) is None
+
+
+async def test_a_view_of_an_older_generation_is_not_cached(cache, orderid):
+    generation = await cache.generation(orderid)
+    await cache.invalidate(orderid)
+
+    await cache.set(orderid, VIEW, generation)
+
+    assert await cache.get(orderid) is None
@@ -0,0 +1,164 @@
+import asyncio
+import json
+import uuid
+
+import pytest
+import redis.asyncio as redis
+
+from allocation.adapters import command_stream
+from allocation.app.settings import settings
+from allocation.services.worker_pool import PartitionedWorkerPool
+
+
+@pytest.fixture
+async def redis_client():
+    client = redis.from_url(settings.get_redis_url())
+    yield client
+    await client.aclose()
+
+
+@pytest.fixture
+def stream():
+    return f"test-commands-{uuid.uuid4().hex[:6]}"
+
+
+def consumer(client, stream, name, handled, **kwargs):
+    async def handle(fields):
+        handled.append(json.loads(fields[b"data"])["qty"])
+
+    return command_stream.CommandStreamConsumer(
+        client, stream, "test-group", handle, consumer=name, block_ms=10, **kwargs
+    )
+
+
+async def test_consumers_of_a_group_share_the_entries(redis_client, stream):
+    handled_1, handled_2 = [], []
+    consumer_1 = consumer(redis_client, stream, "c1", handled_1, batch_size=5)
+    consumer_2 = consumer(redis_client, stream, "c2", handled_2, batch_size=5)
+    await consumer_1.ensure_group()
+    await consumer_2.ensure_group()
+    for qty in range(10):
+        await command_stream.add_command(redis_client, stream, {"qty": qty})
+
+    await consumer_1.process(await consumer_1.read_batch())
+    await consumer_2.process(await consumer_2.read_batch())
+
+    assert handled_1 == [0, 1, 2, 3, 4]
+    assert handled_2 == [5, 6, 7, 8, 9]
+    info = await command_stream.group_info(redis_client, stream, "test-group")
+    assert info == {"consumers": 2, "pending": 0, "lag": 0}
+    await redis_client.delete(stream)
+
+
+async def test_entries_of_a_dead_consumer_are_reclaimed(redis_client, stream):
+    dead = consumer(redis_client, stream, "dead", [])
+    await dead.ensure_group()
+    await command_stream.add_command(redis_client, stream, {"qty": 7})
+    await command_stream.add_command(redis_client, stream, {"qty": 8})
+    await dead.read_batch()  # and never acknowledged
+    assert (await command_stream.group_info(redis_client, stream, "test-group"))[
+        "pending"
+    ] == 2
+
+    handled = []
+    alive = consumer(redis_client, stream, "alive", handled, claim_idle_ms=0)
+    await alive.process(await alive.reclaim())
+
+    assert handled == [7, 8]
+    info = await command_stream.group_info(redis_client, stream, "test-group")
+    assert info["pending"] == 0
+    await redis_client.delete(stream)
+
+
+async def test_failing_entries_are_dead_lettered(redis_client, stream):
+    async def fail(fields):
+        raise ValueError("poison")
+
+    failing = command_stream.CommandStreamConsumer(
+        redis_client,
+        stream,
+        "test-group",
+        fail,
+        consumer="c1",
+        block_ms=10,
+        claim_idle_ms=0,
+        max_deliveries=2,
+    )
+    await failing.ensure_group()
+    await command_stream.add_command(redis_client, stream, {"qty": 1})
+
+    assert await failing.process(await failing.read_batch()) == 0
+    assert await failing.process(await failing.reclaim()) == 0  # delivered twice
+    assert await failing.reclaim() == []  # the third time is too many
+
+    assert await redis_client.xlen(f"{stream}:dead") == 1
+    info = await command_stream.group_info(redis_client, stream, "test-group")
+    assert info["pending"] == 0
+    await redis_client.delete(stream, f"{stream}:dead")
+
+
+async def test_only_the_claimed_entries_are_counted_for_dead_lettering(
+    redis_client, stream
+):
+    dead = consumer(redis_client, stream, "dead", [], batch_size=1)
+    alive = consumer(
+        redis_client,
+        stream,
+        "alive",
+        [],
+        batch_size=1,
+        claim_idle_ms=50,
+        max_deliveries=1,
+    )
+    await dead.ensure_group()
+    for qty in range(3):
+        await command_stream.add_command(redis_client, stream, {"qty": qty})
+    await dead.read_batch()
+    [(between, _)] = await alive.read_batch()
+    await dead.read_batch()
+    await asyncio.sleep(0.1)
+    # pending for alive in the range claimed next, but not idle
+    await redis_client.xclaim(stream, "test-group", "alive", 0, [between], justid=True)
+
+    assert await alive.reclaim() == []
+
+    assert await redis_client.xlen(f"{stream}:dead") == 2
+    info = await command_stream.group_info(redis_client, stream, "test-group")
+    assert info["pending"] == 1
+    await redis_client.delete(stream, f"{stream}:dead")
+
+
+async def test_malformed_entries_are_dead_lettered_without_their_batch(
+    redis_client, stream
+):
+    handled = []
+    pool = PartitionedWorkerPool(workers=2)
+    reader = consumer(
+        redis_client, stream, "c1", handled, submit=pool.submit, partition_key="qty"
+    )
+    await reader.ensure_group()
+    await redis_client.xadd(stream, {"data": "not json"})
+    await redis_client.xadd(stream, {"data": json.dumps({"other": 1})})
+    await command_stream.add_command(redis_client, stream, {"qty": 3})
+
+    assert await reader.process(await reader.read_batch()) == 1
+
+    assert handled == [3]
+    assert await redis_client.xlen(f"{stream}:dead") == 2
+    info = await command_stream.group_info(redis_client, stream, "test-group")
+    assert info["pending"] == 0
+    await pool.aclose()
+    await redis_client.delete(stream, f"{stream}:dead")
+
+
+async def test_lag_counts_the_entries_not_read_yet(redis_client, stream):
+    reader = consumer(redis_client, stream, "c1", [], batch_size=1)
+    await reader.ensure_group()
+    for qty in range(3):
+        await command_stream.add_command(redis_client, stream, {"qty": qty})
+
+    await reader.process(await reader.read_batch())
+
+    info = await command_stream.group_info(redis_client, stream, "test-group")
+    assert info["lag"] == 2
+    await redis_client.delete(stream)
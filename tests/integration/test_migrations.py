@@ -0,0 +1,57 @@
+import re
+from pathlib import Path
+
+import pytest
+
+import allocation
+
+MIGRATIONS = Path(allocation.__file__).parent / "dbschema" / "migrations"
+
+
+class Rollback(Exception):
+    pass
+
+
+def migration_body(name: str) -> str:
+    text = (MIGRATIONS / name).read_text()
+    return re.search(r"\{(.*)\};\s*$", text, re.S).group(1)
+
+
+async def test_the_order_line_constraint_keeps_one_line_of_the_duplicates(
+    async_client_db, random_orderid, random_sku
+):
+    orderid, sku = random_orderid(), random_sku()
+
+    with pytest.raises(Rollback):
+        async for tx in async_client_db.transaction():
+            async with tx:
+                # back to the schema before 00005, saved with the lines repeated
+                await tx.execute(
+                    """ ALTER TYPE default::OrderLine {
+                            DROP CONSTRAINT std::exclusive ON ((.orderid, .sku));
+                        };
+                    """
+                )
+                for _ in range(3):
+                    await tx.query(
+                        """INSERT OrderLine {
+                                orderid := <str>$orderid, sku := <str>$sku, qty := 1
+                            }""",
+                        orderid=orderid,
+                        sku=sku,
+                    )
+
+                await tx.execute(migration_body("00005.edgeql"))
+
+                assert (
+                    await tx.query_single(
+                        """SELECT count(
+                                OrderLine FILTER .orderid = <str>$orderid
+                                    AND .sku = <str>$sku
+                            )""",
+                        orderid=orderid,
+                        sku=sku,
+                    )
+                    == 1
+                )
+                raise Rollback
@@ -0,0 +1,93 @@
+from allocation.adapters import outbox
+from allocation.domain.model import Batch, OrderLine, Product
+from allocation.services import unit_of_work
+
+
+class FakePipeline:
+    def __init__(self, published):
+        self.published = published
+        self.buffered = []
+
+    def publish(self, channel, payload):
+        self.buffered.append((channel, payload))
+
+    async def execute(self):
+        self.published.extend(self.buffered)
+
+
+class FakeRedis:
+    def __init__(self):
+        self.published = []
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self.published)
+
+
+async def unsent(async_client_db, sku):
+    return await async_client_db.query(
+        """SELECT OutboxMessage { channel, payload }
+            FILTER NOT EXISTS .sent_at AND .payload LIKE '%' ++ <str>$sku ++ '%'""",
+        sku=sku,
+    )
+
+
+async def messages_of(async_client_db, sku):
+    return await async_client_db.query(
+        """SELECT OutboxMessage FILTER .payload LIKE '%' ++ <str>$sku ++ '%'""",
+        sku=sku,
+    )
+
+
+async def test_events_are_written_with_the_product_and_relayed(
+    async_client_db, random_batchref, random_sku, random_orderid
+):
+    sku = random_sku("outbox")
+    uow = unit_of_work.EdgedbUnitOfWork(async_client_db, use_outbox=True)
+    async with uow:
+        product = Product(sku, [Batch(random_batchref(), sku, 100, eta=None)])
+        product.allocate(OrderLine(random_orderid(), sku, 10))
+        await uow.products.add(product)
+        await uow.commit()
+    [message] = await unsent(async_client_db, sku)
+    assert message.channel == "line_allocated"
+
+    redis_client = FakeRedis()
+    relay = outbox.OutboxRelay(async_client_db, redis_client, batch_size=10_000)
+    while await relay.relay_batch():
+        pass
+
+    assert ("line_allocated", message.payload) in redis_client.published
+    assert await unsent(async_client_db, sku) == []
+
+
+async def test_sent_messages_are_purged_after_the_retention(
+    async_client_db, random_batchref, random_sku, random_orderid
+):
+    sku = random_sku("outbox_purge")
+    uow = unit_of_work.EdgedbUnitOfWork(async_client_db, use_outbox=True)
+    async with uow:
+        product = Product(sku, [Batch(random_batchref(), sku, 100, eta=None)])
+        product.allocate(OrderLine(random_orderid(), sku, 10))
+        await uow.products.add(product)
+        await uow.commit()
+    relay = outbox.OutboxRelay(async_client_db, FakeRedis(), batch_size=10_000)
+    while await relay.relay_batch():
+        pass
+
+    await outbox.OutboxRelay(async_client_db, FakeRedis(), retention=3600).purge_sent()
+    assert await messages_of(async_client_db, sku)
+    await outbox.OutboxRelay(async_client_db, FakeRedis(), retention=0).purge_sent()
+    assert await messages_of(async_client_db, sku) == []
+
+
+async def test_rolled_back_events_are_not_relayed(
+    async_client_db, random_batchref, random_sku, random_orderid
+):
+    sku = random_sku("outbox_rollback")
+    uow = unit_of_work.EdgedbUnitOfWork(async_client_db, use_outbox=True)
+    async with uow:
+        product = Product(sku, [Batch(random_batchref(), sku, 100, eta=None)])
+        product.allocate(OrderLine(random_orderid(), sku, 10))
+        await uow.products.add(product)
+
+    assert await unsent(async_client_db, sku) == []
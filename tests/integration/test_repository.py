@@ -1,8 +1,11 @@
 # pylint: disable=protected-access
 import datetime
 
+import pytest
+
 import allocation.repositories.repository as repository
-from allocation.adapters.pyd_model import Batch, OrderLine, Product
+from allocation.domain.model import Batch, OrderLine, Product
+from allocation.repositories import cache, mapper
 
 from .utils import (
     add_allocateion_to_batch_by_ids,
@@ -16,13 +19,11 @@ async def test_repository_can_save_a_batch(async_client_db, random_batchref, ran
     repo = repository.EdgeDBRepository(async_client_db)
     bath_ref = f"repository_can_save_{random_batchref()}"
     sku = f"repository_can_save_{random_sku()}"
-    batch = Batch(
-        reference=bath_ref, sku=sku, purchased_quantity=100, eta=datetime.date(2011, 1, 2)
-    )
+    batch = Batch(bath_ref, sku, 100, eta=datetime.date(2011, 1, 2))
     product = Product(sku=sku, batches=[batch], version_number=1)
 
     await repo.add(product)
-    json_ = await async_client_db.query_required_single_json(
+    obj = await async_client_db.query_required_single(
         """SELECT Batch {*}
             FILTER .reference = <str>$reference and .sku = <str>$sku
             LIMIT 1;
@@ -30,7 +31,7 @@ async def test_repository_can_save_a_batch(async_client_db, random_batchref, ran
         reference=bath_ref,
         sku=sku,
     )
-    batch_db = Batch.model_validate_json(json_)
+    batch_db = mapper.batch(obj)
     assert batch_db == batch
 
 
@@ -50,12 +51,7 @@ async def test_repository_can_retrieve_a_batch_with_allocations(
     product = await repo.get(sku=sku)  # , allocations=True
     [retrieved] = [batch for batch in product.batches if batch.reference == bath_ref]
 
-    expected = Batch(
-        reference=bath_ref,
-        sku=sku,
-        eta=datetime.date(2011, 1, 2),
-        purchased_quantity=100,
-    )
+    expected = Batch(bath_ref, sku, 100, eta=datetime.date(2011, 1, 2))
 
     assert retrieved == expected  # Batch.__eq__ only compares reference
     assert retrieved.allocations == {
@@ -73,12 +69,7 @@ async def test_repository_updating_a_batch(
 
     order1 = OrderLine(orderid=orderid, sku=sku, qty=10)
     order2 = OrderLine(orderid=orderid + "_2", sku=sku, qty=20)
-    batch = Batch(
-        reference=batch_ref,
-        sku=sku,
-        eta=datetime.date(2011, 1, 2),
-        purchased_quantity=100,
-    )
+    batch = Batch(batch_ref, sku, 100, eta=datetime.date(2011, 1, 2))
 
     batch.allocate(order1)
     product = Product(sku=sku, batches=[batch], version_number=0)
@@ -104,12 +95,122 @@ async def test_get_by_batchref(
         random_batchref("b3"),
     )
     sku_1, sku_2 = random_sku("sku1"), random_sku("sku2")
-    b1 = Batch(reference=batchref_1, sku=sku_1, purchased_quantity=100, eta=None)
-    b2 = Batch(reference=batchref_2, sku=sku_1, purchased_quantity=100, eta=None)
-    b3 = Batch(reference=batchref_3, sku=sku_2, purchased_quantity=100, eta=None)
+    b1 = Batch(batchref_1, sku_1, 100, eta=None)
+    b2 = Batch(batchref_2, sku_1, 100, eta=None)
+    b3 = Batch(batchref_3, sku_2, 100, eta=None)
     p1 = Product(sku=sku_1, batches=[b1, b2], version_number=1)
     p2 = Product(sku=sku_2, batches=[b3], version_number=1)
     await repo.add(p1)
     await repo.add(p2)
     assert await repo.get_by_batchref(batchref_2) == p1
     assert await repo.get_by_batchref(batchref_3) == p2
+
+
+async def test_stale_version_number_is_rejected(
+    async_client_db, random_batchref, random_sku
+):
+    sku = random_sku("stale_version")
+    await insert_batch(async_client_db, random_batchref(), sku, version_number=1)
+    repo_1 = repository.EdgeDBRepository(async_client_db)
+    repo_2 = repository.EdgeDBRepository(async_client_db)
+    product_1 = await repo_1.get(sku=sku)
+    product_2 = await repo_2.get(sku=sku)
+
+    product_1.version_number += 1
+    await repo_1.add(product_1)
+
+    product_2.version_number += 1
+    with pytest.raises(repository.SynchronousUpdateError):
+        await repo_2.add(product_2)
+
+
+async def test_saving_again_writes_only_new_allocations(
+    async_client_db, random_orderid, random_batchref, random_sku
+):
+    repo = repository.EdgeDBRepository(async_client_db)
+    sku, batch_ref = random_sku("only_new"), random_batchref("only_new")
+    batch = Batch(batch_ref, sku, 100, eta=None)
+    product = Product(sku=sku, batches=[batch], version_number=0)
+    batch.allocate(OrderLine(orderid=random_orderid(), sku=sku, qty=10))
+    await repo.add(product)
+
+    product.allocate(OrderLine(orderid=random_orderid(), sku=sku, qty=10))
+    await repo.add(product)
+    product.change_batch_quantity(batch_ref, 15)
+    await repo.add(product)
+
+    stored = await async_client_db.query_required_single(
+        """SELECT Batch { purchased_quantity, lines := count(.allocations) }
+            FILTER .reference = <str>$reference""",
+        reference=batch_ref,
+    )
+    assert stored.purchased_quantity == 15
+    assert stored.lines == 1
+
+
+async def test_product_can_be_loaded_without_its_order_lines(
+    async_client_db, random_orderid, random_batchref, random_sku
+):
+    sku, batch_ref = random_sku("capacity"), random_batchref("capacity")
+    batch = Batch(batch_ref, sku, 100, eta=None)
+    batch.allocate(OrderLine(random_orderid(), sku, 30))
+    await repository.EdgeDBRepository(async_client_db).add(Product(sku, [batch], 1))
+
+    repo = repository.EdgeDBRepository(async_client_db)
+    product = await repo.get(sku=sku, allocations=False)
+    [retrieved] = product.batches
+    assert retrieved.allocations == set()
+    assert retrieved.available_quantity == 70
+
+    product.allocate(OrderLine(random_orderid(), sku, 20))
+    await repo.add(product)
+    [reloaded] = (await repository.EdgeDBRepository(async_client_db).get(sku)).batches
+    assert len(reloaded.allocations) == 2
+    assert reloaded.available_quantity == 50
+
+
+async def test_an_order_line_is_stored_once(
+    async_client_db, random_orderid, random_batchref, random_sku
+):
+    sku, batch_ref = random_sku("once"), random_batchref("once")
+    orderid = random_orderid()
+    batch = Batch(batch_ref, sku, 100, eta=None)
+    batch.allocate(OrderLine(orderid, sku, 30))
+    await repository.EdgeDBRepository(async_client_db).add(Product(sku, [batch], 1))
+
+    repo = repository.EdgeDBRepository(async_client_db)
+    allocated = await repo.allocated_batches(sku, [orderid, random_orderid()])
+    assert allocated == {orderid: batch_ref}
+
+    # a repeated allocation that got past the check is not inserted again
+    product = await repo.get(sku=sku, allocations=False)
+    product.allocate(OrderLine(orderid, sku, 30))
+    await repo.add(product)
+
+    product = await repository.EdgeDBRepository(async_client_db).get_by_batchref(
+        batch_ref, allocations=False, batch_lines=True
+    )
+    [reloaded] = product.batches
+    assert reloaded.allocations == {OrderLine(orderid, sku, 30)}
+    assert reloaded.available_quantity == 70
+
+
+async def test_cached_product_is_used_until_it_is_saved(
+    async_client_db, random_orderid, random_batchref, random_sku
+):
+    product_cache = cache.ProductCache(max_entries=10, max_bytes=2**20)
+    sku = random_sku("cached")
+    await insert_batch(async_client_db, random_batchref(), sku, version_number=1)
+
+    repo = repository.EdgeDBRepository(async_client_db, product_cache)
+    product = await repo.get(sku=sku, allocations=False)
+    hits = cache.stats.hits
+    cached = await repository.EdgeDBRepository(async_client_db, product_cache).get(
+        sku=sku, allocations=False
+    )
+    assert cache.stats.hits - hits == 1
+    assert cached == product
+
+    product.allocate(OrderLine(random_orderid(), sku, 10))
+    await repo.add(product)
+    assert sku not in product_cache.entries
@@ -0,0 +1,46 @@
+import asyncio
+import uuid
+
+import pytest
+import redis.asyncio as redis
+
+from allocation.adapters.shard_transport import RedisShardTransport
+from allocation.app.settings import settings
+
+
+@pytest.fixture
+async def transport():
+    client = redis.from_url(settings.get_redis_url())
+    yield RedisShardTransport(client, heartbeat_ttl=1, request_timeout=2)
+    await client.aclose()
+
+
+async def serve(transport, worker):
+    async for message, reply in transport.requests(worker):
+        await reply({"result": message["n"] * 2})
+
+
+async def test_requests_are_answered_by_the_worker(transport):
+    worker = f"test-worker-{uuid.uuid4().hex[:6]}"
+    await transport.join(worker)
+    serving = asyncio.create_task(serve(transport, worker))
+
+    replies = await asyncio.gather(
+        *(transport.request(worker, {"n": n}) for n in range(10))
+    )
+
+    assert replies == [{"result": n * 2} for n in range(10)]
+    serving.cancel()
+    await transport.leave(worker)
+
+
+async def test_workers_are_members_while_their_heartbeat_lasts(transport):
+    worker = f"test-worker-{uuid.uuid4().hex[:6]}"
+    await transport.join(worker)
+    assert worker in await transport.members()
+
+    transport.heartbeats[worker].cancel()  # the worker dies
+    await asyncio.sleep(1.5)
+    assert worker not in await transport.members()
+
+    await transport.leave(worker)
@@ -5,7 +5,7 @@ import edgedb
 
 import pytest
 
-from allocation.adapters import pyd_model as model
+from allocation.domain import model
 from allocation.services import unit_of_work
 
 from .utils import get_allocated_batch_ref, insert_batch
@@ -75,8 +75,6 @@ async def test_rolls_back_on_error(async_client_db, random_sku):
     assert rows == []
 
 
-# TODO: implement testing of Optimistic parallelism with version numbers
-
 async def try_to_allocate(orderid, sku, exceptions, async_client_db):
     line = model.OrderLine(orderid=orderid, sku=sku, qty=10)
     uow = unit_of_work.EdgedbUnitOfWork(async_client_db)
@@ -4,6 +4,7 @@ from unittest import mock
 import pytest
 
 from allocation import bootstrap, views
+from allocation.adapters.allocations_cache import InMemoryAllocationsCache
 from allocation.domain import commands
 from allocation.services import unit_of_work
 
@@ -11,11 +12,17 @@ today = date.today()
 
 
 @pytest.fixture
-def messagebus(async_client_db):
+def allocations_cache():
+    return InMemoryAllocationsCache()
+
+
+@pytest.fixture
+def messagebus(async_client_db, allocations_cache):
     yield bootstrap.Bootstrap(
-        uow=unit_of_work.EdgedbUnitOfWork(async_client_db),
+        uow_factory=unit_of_work.EdgedbUnitOfWorkFactory(async_client_db),
         notifications=mock.Mock(),
         publish=lambda *args: None,
+        allocations_cache=allocations_cache,
     ).messagebus
 
 
@@ -38,7 +45,7 @@ async def test_allocations_view(messagebus, random_batchref, random_sku, random_
     await messagebus.handle(commands.CreateBatch(batchref_1_later, sku_1, 50, today))
     await messagebus.handle(commands.Allocate(orderid_other, sku_1, 30))
     await messagebus.handle(commands.Allocate(orderid_other, sku_2, 10))
-    assert await views.allocations(orderid, messagebus.uow) == [
+    assert await views.allocations(orderid, messagebus.uow_factory()) == [
         {"sku": sku_1, "batchref": batchref_1},
         {"sku": sku_2, "batchref": batchref_2},
     ]
@@ -56,6 +63,26 @@ async def test_deallocation(messagebus, random_batchref, random_sku, random_orde
     await messagebus.handle(commands.Allocate(orderid, sku, 40))
     await messagebus.handle(commands.ChangeBatchQuantity(batchref_1, 10))
 
-    assert await views.allocations(orderid, messagebus.uow) == [
+    assert await views.allocations(orderid, messagebus.uow_factory()) == [
         {"sku": sku, "batchref": batchref_2},
     ]
+
+
+async def test_cached_view_follows_reallocation(
+    messagebus, allocations_cache, random_batchref, random_sku, random_orderid
+):
+    sku, orderid = random_sku(), random_orderid()
+    batchref_1, batchref_2 = random_batchref("sku1"), random_batchref("sku2")
+    await messagebus.handle(commands.CreateBatch(batchref_1, sku, 50, None))
+    await messagebus.handle(commands.CreateBatch(batchref_2, sku, 50, today))
+    await messagebus.handle(commands.Allocate(orderid, sku, 40))
+    view = await views.allocations(orderid, messagebus.uow_factory(), allocations_cache)
+    assert view == [{"sku": sku, "batchref": batchref_1}]
+    assert await allocations_cache.get(orderid) == view
+
+    await messagebus.handle(commands.ChangeBatchQuantity(batchref_1, 10))
+
+    assert await allocations_cache.get(orderid) is None
+    assert await views.allocations(
+        orderid, messagebus.uow_factory(), allocations_cache
+    ) == [{"sku": sku, "batchref": batchref_2}]
@@ -0,0 +1,68 @@
+"""A local stand-in for an SMTP server, enough for aiosmtplib to send mail.
+
+Keeps the messages it received and counts the connections, and can drop
+every connection to test reconnects::
+
+    async with SMTPStandIn() as server:
+        notifications = EmailNotifications(server.host, server.port)
+"""
+import asyncio
+
+
+class SMTPStandIn:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        self.host = host
+        self.port = port
+        self.messages: list[tuple[list[str], str]] = []
+        self.connections = 0
+        self.writers: set[asyncio.StreamWriter] = set()
+        self.server: asyncio.Server | None = None
+
+    async def __aenter__(self) -> "SMTPStandIn":
+        self.server = await asyncio.start_server(self.serve, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        assert self.server is not None
+        self.drop_connections()
+        self.server.close()
+        await self.server.wait_closed()
+
+    def drop_connections(self) -> None:
+        for writer in self.writers:
+            writer.close()
+        self.writers.clear()
+
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        self.writers.add(writer)
+        recipients: list[str] = []
+        writer.write(b"220 stand-in ESMTP\r\n")
+        try:
+            while line := await reader.readline():
+                verb = line[:4].upper()
+                if verb == b"EHLO":
+                    writer.write(b"250-stand-in\r\n250 8BITMIME\r\n")
+                elif verb == b"RCPT":
+                    recipients.append(line.decode().split(":", 1)[1].strip(" <>\r\n"))
+                    writer.write(b"250 OK\r\n")
+                elif verb == b"DATA":
+                    writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                    await writer.drain()
+                    data = await reader.readuntil(b"\r\n.\r\n")
+                    self.messages.append((recipients, data[:-5].decode()))
+                    recipients = []
+                    writer.write(b"250 OK\r\n")
+                elif verb == b"QUIT":
+                    writer.write(b"221 Bye\r\n")
+                    await writer.drain()
+                    break
+                else:  # HELO, MAIL, RSET, NOOP
+                    writer.write(b"250 OK\r\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
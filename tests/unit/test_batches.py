@@ -2,7 +2,7 @@ from datetime import date
 
 import pytest
 
-from allocation.domain.model import Batch, OrderLine
+from allocation.domain.model import AllocationsNotLoaded, Batch, OrderLine
 
 
 def test_allocating_to_a_batch_reduces_the_available_quantity():
@@ -61,3 +61,43 @@ def test_can_only_deallocate_allocated_lines():
     with pytest.raises(KeyError):
         batch.deallocate_one(unallocated_line)
     assert batch.available_quantity == 20
+
+
+def test_deallocating_any_line_frees_its_quantity():
+    batch, line = make_batch_and_line("DECORATIVE-TRINKET", 20, 2)
+    batch.allocate(line)
+    assert batch.deallocate_one() == line
+    assert batch.available_quantity == 20
+
+
+def test_batch_loaded_with_allocations_counts_them():
+    batch = Batch(
+        "batch-001",
+        "BLUE-VASE",
+        20,
+        eta=None,
+        allocations=[
+            OrderLine("order-1", "BLUE-VASE", 2),
+            OrderLine("order-2", "BLUE-VASE", 5),
+        ],
+    )
+    assert batch.available_quantity == 13
+
+    batch.allocate(OrderLine("order-3", "BLUE-VASE", 3))
+    batch.deallocate_one(OrderLine("order-1", "BLUE-VASE", 2))
+    assert batch.available_quantity == 12
+
+
+def test_batch_loaded_with_only_its_allocated_quantity_can_allocate():
+    batch = Batch("batch-001", "BLUE-VASE", 20, eta=None, allocated_quantity=15)
+    line = OrderLine("order-1", "BLUE-VASE", 5)
+    assert batch.can_allocate(line)
+    batch.allocate(line)
+    assert batch.allocations == {line}
+    assert batch.available_quantity == 0
+
+
+def test_batch_loaded_with_only_its_allocated_quantity_cannot_deallocate():
+    batch = Batch("batch-001", "BLUE-VASE", 20, eta=None, allocated_quantity=15)
+    with pytest.raises(AllocationsNotLoaded):
+        batch.deallocate_one()
@@ -0,0 +1,76 @@
+import json
+
+from allocation.domain.model import Batch, OrderLine, Product
+from benchmarks import histogram, pyd_model, suite
+
+
+def results(**values):
+    return {"results": {name: {"value": v, "unit": "us"} for name, v in values.items()}}
+
+
+def test_slower_than_the_tolerance_is_a_regression():
+    found = suite.regressions(results(a=13.0, b=12.0), results(a=10.0, b=10.0), 0.25)
+
+    assert len(found) == 1
+    assert found[0].startswith("a: 13.0 us, baseline 10.0")
+
+
+def test_faster_and_new_cases_are_not_regressions():
+    assert suite.regressions(results(a=5.0, new=99.0), results(a=10.0), 0.25) == []
+
+
+def test_each_case_tolerates_its_own_slowdown():
+    current = results(a=13.0, b=13.0)
+    current["results"]["a"]["tolerance"] = 0.5
+    current["results"]["b"]["tolerance"] = 0.2
+
+    found = suite.regressions(current, results(a=10.0, b=10.0))
+
+    assert [regression.split(":")[0] for regression in found] == ["b"]
+
+
+def test_a_baseline_of_another_machine_is_not_compared(tmp_path, capsys):
+    baseline = tmp_path / "baseline.json"
+    baseline.write_text(json.dumps({"machine": {"cpu": "other"}, **results(a=1.0)}))
+
+    argv = ["--baseline", str(baseline), "--cases", "allocate/batches=10"]
+
+    exit_status = suite.main(argv)
+
+    assert exit_status == 2
+    assert "not on this machine" in capsys.readouterr().err
+
+
+def test_domain_objects_read_into_the_pydantic_models():
+    batch = Batch("b1", "RED-CHAIR", 20, eta=None)
+    batch.allocate(OrderLine("o1", "RED-CHAIR", 5))
+
+    schema = pyd_model.Product.model_validate(Product("RED-CHAIR", [batch]))
+
+    assert schema.batches[0].available_quantity == 15
+    assert schema.batches[0].allocations == [
+        pyd_model.OrderLine(orderid="o1", sku="RED-CHAIR", qty=5)
+    ]
+
+
+def test_histogram_percentiles_are_within_the_bucket_precision():
+    h = histogram.Histogram()
+    for ms in range(1, 1001):
+        h.record(ms / 1000)
+
+    assert h.count == 1000
+    for percentile, expected in ((50, 500_000), (99, 990_000), (99.9, 999_000)):
+        assert expected <= h.value_at(percentile) <= expected * (1 + 2**-7)
+    assert h.value_at(100) == h.max == 1_000_000
+
+
+def test_hgrm_ends_with_every_value_counted():
+    h = histogram.Histogram()
+    for us in (100, 200, 300, 50_000):
+        h.record(us / 1e6)
+
+    lines = h.hgrm().splitlines()
+
+    assert lines[0].split()[:3] == ["Value", "Percentile", "TotalCount"]
+    assert lines[-4].split()[:3] == ["50.000", "1.000000000000", "4"]
+    assert lines[-2].split() == ["#[Max", "=", "50.000,", "Total", "count", "=", "4]"]
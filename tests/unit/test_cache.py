@@ -0,0 +1,77 @@
+from dataclasses import asdict
+
+from allocation.domain.model import Batch, OrderLine, Product
+from allocation.repositories import cache
+
+
+def make_product(sku: str, batches: int = 1, version_number: int = 1) -> Product:
+    return Product(
+        sku,
+        [Batch(f"{sku}-{i}", sku, 100, eta=None) for i in range(batches)],
+        version_number=version_number,
+    )
+
+
+def stored_version(version_number):
+    async def version():
+        return version_number
+
+    return version
+
+
+async def test_returns_a_copy_of_a_cached_product_of_the_same_version():
+    product_cache = cache.ProductCache(max_entries=10, max_bytes=2**20)
+    product = make_product("GREEN-SOFA", version_number=3)
+    product.allocate(OrderLine("o1", "GREEN-SOFA", 10))
+    product_cache.put(product)
+
+    cached = await product_cache.get("GREEN-SOFA", stored_version(4))
+
+    assert cached is not product and cached == product
+    assert cached.batches[0].available_quantity == 90
+    cached.allocate(OrderLine("o2", "GREEN-SOFA", 10))
+    again = await product_cache.get("GREEN-SOFA", stored_version(4))
+    assert again.batches[0].available_quantity == 90
+
+
+async def test_a_moved_on_version_invalidates_the_cached_product():
+    product_cache = cache.ProductCache(max_entries=10, max_bytes=2**20)
+    product_cache.put(make_product("GREEN-SOFA", version_number=1))
+    before = asdict(cache.stats)
+
+    assert await product_cache.get("GREEN-SOFA", stored_version(2)) is None
+    assert await product_cache.get("GREEN-SOFA", stored_version(2)) is None
+
+    assert cache.stats.stale - before["stale"] == 1
+    assert cache.stats.misses - before["misses"] == 1
+
+
+async def test_evicts_the_least_recently_used_products():
+    product_cache = cache.ProductCache(max_entries=2, max_bytes=2**20)
+    evictions = cache.stats.evictions
+    for sku in ("A", "B"):
+        product_cache.put(make_product(sku))
+    await product_cache.get("A", stored_version(1))
+    product_cache.put(make_product("C"))
+
+    assert await product_cache.get("B", stored_version(1)) is None
+    assert await product_cache.get("A", stored_version(1)) is not None
+    assert cache.stats.evictions - evictions == 1
+
+
+def test_evicts_products_beyond_the_memory_limit():
+    size = cache.estimate_size(make_product("A", batches=10))
+    product_cache = cache.ProductCache(max_entries=10, max_bytes=2 * size)
+    for sku in ("A", "B", "C"):
+        product_cache.put(make_product(sku, batches=10))
+    product_cache.put(make_product("TOO-BIG", batches=100))
+
+    assert list(product_cache.entries) == ["B", "C"]
+    assert product_cache.size == 2 * size
+
+
+def test_invalidate():
+    product_cache = cache.ProductCache(max_entries=10, max_bytes=2**20)
+    product_cache.put(make_product("A"))
+    product_cache.invalidate("A")
+    assert len(product_cache) == 0 and product_cache.size == 0
@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+
+from allocation.domain import commands
+from allocation.services.group_commit import GroupCommit, LineFailed
+
+
+class FakeAllocations:
+    def __init__(self, fail=False, failing=()):
+        self.groups = []
+        self.fail = fail
+        self.failing = failing
+
+    async def __call__(self, sku, lines, uow):
+        self.groups.append([line.orderid for line in lines])
+        await asyncio.sleep(0.001)  # the transaction
+        if self.fail:
+            raise ValueError("boom")
+        for position, line in enumerate(lines):
+            if line.orderid in self.failing:
+                raise LineFailed(position) from ValueError("boom")
+        return [f"batch-for-{line.orderid}" for line in lines]
+
+
+def allocate(group_commit, orderid, sku="LAMP"):
+    return group_commit.allocate(commands.Allocate(orderid, sku, 1), uow=None)
+
+
+async def test_commands_arriving_during_a_transaction_are_committed_together():
+    allocations = FakeAllocations()
+    group_commit = GroupCommit(allocations)
+
+    first = asyncio.create_task(allocate(group_commit, "o0"))
+    await asyncio.sleep(0)  # the first transaction is running
+    results = await asyncio.gather(*(allocate(group_commit, f"o{i}") for i in (1, 2, 3)))
+
+    assert await first == "batch-for-o0"
+    assert results == ["batch-for-o1", "batch-for-o2", "batch-for-o3"]
+    assert allocations.groups == [["o0"], ["o1", "o2", "o3"]]
+    assert not group_commit.flights
+
+
+async def test_skus_do_not_wait_for_each_other():
+    allocations = FakeAllocations()
+    group_commit = GroupCommit(allocations)
+
+    await asyncio.gather(
+        allocate(group_commit, "o1", "LAMP"), allocate(group_commit, "o2", "RUG")
+    )
+
+    assert allocations.groups == [["o1"], ["o2"]]
+
+
+async def test_groups_are_at_most_max_group():
+    allocations = FakeAllocations()
+    group_commit = GroupCommit(allocations, max_group=2)
+
+    await asyncio.gather(*(allocate(group_commit, f"o{i}") for i in range(5)))
+
+    assert allocations.groups == [["o0", "o1"], ["o2", "o3"], ["o4"]]
+
+
+async def test_every_caller_of_a_failed_group_gets_the_exception():
+    group_commit = GroupCommit(FakeAllocations(fail=True))
+
+    results = await asyncio.gather(
+        *(allocate(group_commit, f"o{i}") for i in range(3)), return_exceptions=True
+    )
+
+    assert all(isinstance(result, ValueError) for result in results)
+    with pytest.raises(ValueError):
+        await allocate(group_commit, "o4")
+
+
+async def test_a_group_fails_at_once_on_an_error_of_every_line():
+    allocations = FakeAllocations(fail=True)
+    group_commit = GroupCommit(allocations)
+
+    first = asyncio.create_task(allocate(group_commit, "o0"))
+    await asyncio.sleep(0)  # the first transaction is running
+    results = await asyncio.gather(
+        *(allocate(group_commit, f"o{i}") for i in (1, 2, 3)), return_exceptions=True
+    )
+
+    with pytest.raises(ValueError):
+        await first
+    assert all(isinstance(result, ValueError) for result in results)
+    assert allocations.groups == [["o0"], ["o1", "o2", "o3"]]
+
+
+async def test_a_group_failed_by_a_line_is_committed_again_without_it():
+    allocations = FakeAllocations(failing=("o2",))
+    group_commit = GroupCommit(allocations)
+
+    first = asyncio.create_task(allocate(group_commit, "o0"))
+    await asyncio.sleep(0)  # the first transaction is running
+    results = await asyncio.gather(
+        *(allocate(group_commit, f"o{i}") for i in (1, 2, 3)), return_exceptions=True
+    )
+
+    assert await first == "batch-for-o0"
+    assert results[0] == "batch-for-o1"
+    assert isinstance(results[1], ValueError)
+    assert results[2] == "batch-for-o3"
+    assert allocations.groups == [["o0"], ["o1", "o2", "o3"], ["o1", "o3"]]
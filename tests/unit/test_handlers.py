@@ -1,4 +1,7 @@
+import asyncio
+from dataclasses import asdict
 from datetime import date
+from unittest import mock
 
 import pytest
 
@@ -6,7 +9,8 @@ import allocation.repositories.repository as repository
 from allocation.adapters import notifications
 from allocation.bootstrap import Bootstrap
 from allocation.domain import commands, events, model
-from allocation.services import handlers, unit_of_work
+from allocation.services import handlers, retry, unit_of_work
+from allocation.services.messagebus import options_of
 
 
 class FakeRepository(repository.AbstractRepository):
@@ -18,11 +22,13 @@ class FakeRepository(repository.AbstractRepository):
         self.seen.add(product)
         self._products.add(product)
 
-    async def _get(self, sku) -> model.Product | None:
+    async def _get(self, sku, allocations=True) -> model.Product | None:
         product = next((p for p in self._products if p.sku == sku), None)
         return product
 
-    async def _get_by_batchref(self, batchref) -> model.Product | None:
+    async def _get_by_batchref(
+        self, batchref, allocations=True, batch_lines=False
+    ) -> model.Product | None:
         product = next(
             (p for p in self._products if batchref in (b.reference for b in p.batches)),
             None,
@@ -30,6 +36,18 @@ class FakeRepository(repository.AbstractRepository):
         return product
 
 
+class ConflictingFakeRepository(FakeRepository):
+    def __init__(self, products, conflicts):
+        super().__init__(products)
+        self.conflicts = conflicts
+
+    async def _add(self, product: model.Product) -> None:
+        if self.conflicts:
+            self.conflicts -= 1
+            raise repository.SynchronousUpdateError("concurrent update")
+        await super()._add(product)
+
+
 class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
     def __init__(self):
         self.products = FakeRepository([])
@@ -59,6 +77,19 @@ class FakeUnitOfWorkWithFakeMessageBus(FakeUnitOfWork):
                 yield self.events_published.append(product.events.pop(0))
 
 
+class FakeUnitOfWorkFactory(unit_of_work.AbstractUnitOfWorkFactory):
+    def __init__(self):
+        self.issued: list[FakeUnitOfWork] = []
+        self.products: FakeRepository | None = None
+
+    def __call__(self):
+        uow = FakeUnitOfWork()
+        if self.products is not None:
+            uow.products = self.products
+        self.issued.append(uow)
+        return uow
+
+
 class FakeNotifications(notifications.AbstractNotifications):
     def __init__(self):
         self.sent: dict[str, list[str]] = {}
@@ -81,8 +112,9 @@ class TestAddBatch:
         await messagebus.handle(
             commands.CreateBatch("b1", "CRUNCHY-ARMCHAIR", 100, None),
         )
-        assert await messagebus.uow.products.get(sku="CRUNCHY-ARMCHAIR") is not None
-        assert messagebus.uow.committed
+        uow = messagebus.uow_factory()
+        assert await uow.products.get(sku="CRUNCHY-ARMCHAIR") is not None
+        assert uow.committed
 
     async def test_add_batch_for_existing_product(self):
         messagebus = await bootstrap_test_app()
@@ -92,10 +124,41 @@ class TestAddBatch:
         await messagebus.handle(
             commands.CreateBatch("b2", "GARISH-RUG", 99, None),
         )
-        product = await messagebus.uow.products.get("GARISH-RUG")
+        product = await messagebus.uow_factory().products.get("GARISH-RUG")
         assert "b2" in [b.reference for b in product.batches]
 
 
+class TestUnitOfWorkFactory:
+    async def test_every_message_gets_its_own_unit_of_work(self):
+        uow_factory = FakeUnitOfWorkFactory()
+        messagebus = Bootstrap(
+            uow_factory=uow_factory,
+            notifications=FakeNotifications(),
+            publish=lambda *args: None,
+        ).messagebus
+        await messagebus.handle(commands.CreateBatch("b1", "TINY-STOOL", 100, None))
+        await messagebus.handle(commands.CreateBatch("b2", "HUGE-STOOL", 100, None))
+
+        first, second = uow_factory.issued
+        assert first is not second
+        assert first.committed and second.committed
+
+
+async def test_leaving_the_bootstrap_closes_the_notifications_and_the_connections():
+    uow_factory = FakeUnitOfWorkFactory()
+    uow_factory.aclose = mock.AsyncMock()
+    notifier = mock.AsyncMock()
+    bootstrap = Bootstrap(
+        uow_factory=uow_factory, notifications=notifier, publish=lambda *args: None
+    )
+
+    async with bootstrap:
+        pass
+
+    notifier.aclose.assert_awaited_once()
+    uow_factory.aclose.assert_awaited_once()
+
+
 class TestAllocate:
     async def test_allocates(self):
         messagebus = await bootstrap_test_app()
@@ -105,7 +168,7 @@ class TestAllocate:
         await messagebus.handle(
             commands.Allocate("o1", "COMPLICATED-LAMP", 10),
         )
-        product = await messagebus.uow.products.get("COMPLICATED-LAMP")
+        product = await messagebus.uow_factory().products.get("COMPLICATED-LAMP")
         assert product.batches[0].available_quantity == 90
 
     async def test_errors_for_invalid_sku(self):
@@ -138,6 +201,138 @@ class TestAllocate:
             "Out of stock for POPULAR-CURTAINS",
         ]
 
+    async def test_concurrent_allocations_of_a_sku_are_committed_together(self):
+        uow_factory = FakeUnitOfWorkFactory()
+        uow_factory.products = FakeRepository([])
+        messagebus = Bootstrap(
+            uow_factory=uow_factory,
+            notifications=FakeNotifications(),
+            publish=lambda *args: None,
+        ).messagebus
+        await messagebus.handle(commands.CreateBatch("b1", "HOT-LAMP", 3, None))
+        await messagebus.handle(commands.CreateBatch("b2", "HOT-LAMP", 1, date.today()))
+        uow_factory.issued.clear()
+
+        batchrefs = await asyncio.gather(
+            *(
+                messagebus.handle(commands.Allocate(f"o{i}", "HOT-LAMP", 1))
+                for i in range(5)
+            )
+        )
+
+        assert batchrefs == ["b1", "b1", "b1", "b2", None]
+        assert len([uow for uow in uow_factory.issued if uow.committed]) == 1
+
+
+class TestAllocateMany:
+    async def test_allocates_every_line_in_order(self):
+        messagebus = await bootstrap_test_app()
+        await messagebus.handle(commands.CreateBatch("b1", "FLAT-LAMP", 10, None))
+        await messagebus.handle(commands.CreateBatch("b2", "ROUND-LAMP", 10, None))
+
+        results = await messagebus.handle(
+            commands.AllocateMany(
+                [
+                    commands.Allocate("o1", "FLAT-LAMP", 6),
+                    commands.Allocate("o2", "ROUND-LAMP", 3),
+                    commands.Allocate("o3", "FLAT-LAMP", 6),
+                    commands.Allocate("o4", "FLAT-LAMP", 4),
+                    commands.Allocate("o5", "MISSING-LAMP", 1),
+                ]
+            )
+        )
+
+        assert results == [
+            handlers.AllocationResult("o1", "FLAT-LAMP", "b1", "allocated"),
+            handlers.AllocationResult("o2", "ROUND-LAMP", "b2", "allocated"),
+            handlers.AllocationResult("o3", "FLAT-LAMP", None, "out_of_stock"),
+            handlers.AllocationResult("o4", "FLAT-LAMP", "b1", "allocated"),
+            handlers.AllocationResult("o5", "MISSING-LAMP", None, "invalid_sku"),
+        ]
+        product = await messagebus.uow_factory().products.get("FLAT-LAMP")
+        assert product.batches[0].available_quantity == 0
+
+    async def test_commits_once_per_sku(self):
+        uow_factory = FakeUnitOfWorkFactory()
+        products = FakeRepository([])
+        uow_factory.products = products
+        messagebus = Bootstrap(
+            uow_factory=uow_factory,
+            notifications=FakeNotifications(),
+            publish=lambda *args: None,
+        ).messagebus
+        await messagebus.handle(commands.CreateBatch("b1", "TALL-VASE", 100, None))
+        await messagebus.handle(commands.CreateBatch("b2", "WIDE-VASE", 100, None))
+        uow_factory.issued.clear()
+
+        await messagebus.handle(
+            commands.AllocateMany(
+                [commands.Allocate(f"o{i}", "TALL-VASE", 1) for i in range(10)]
+                + [commands.Allocate(f"o{i}", "WIDE-VASE", 1) for i in range(10)]
+            )
+        )
+
+        allocating = [uow for uow in uow_factory.issued if uow.committed]
+        assert len(allocating) == 2
+
+    async def test_a_sku_losing_every_retry_fails_only_its_lines(self, monkeypatch):
+        monkeypatch.setattr(retry.settings, "conflict_retry_attempts", 1)
+        messagebus = await bootstrap_test_app()
+        uow = messagebus.uow_factory()
+        await messagebus.handle(commands.CreateBatch("b1", "CALM-RUG", 10, None))
+        await messagebus.handle(commands.CreateBatch("b2", "BUSY-RUG", 10, None))
+        products = uow.products._products
+
+        class BusyRugConflicts(FakeRepository):
+            async def _add(self, product):
+                if product.sku == "BUSY-RUG":
+                    raise repository.SynchronousUpdateError("concurrent update")
+                await super()._add(product)
+
+        uow.products = BusyRugConflicts(products)
+
+        results = await messagebus.handle(
+            commands.AllocateMany(
+                [
+                    commands.Allocate("o1", "BUSY-RUG", 1),
+                    commands.Allocate("o2", "CALM-RUG", 1),
+                ]
+            )
+        )
+
+        assert results == [
+            handlers.AllocationResult("o1", "BUSY-RUG", None, "conflict"),
+            handlers.AllocationResult("o2", "CALM-RUG", "b1", "allocated"),
+        ]
+
+
+class TestOptimisticConcurrency:
+    async def test_allocate_retries_after_a_version_conflict(self):
+        messagebus = await bootstrap_test_app()
+        uow = messagebus.uow_factory()
+        await messagebus.handle(commands.CreateBatch("b1", "BUSY-SOFA", 100, None))
+        uow.products = ConflictingFakeRepository(uow.products._products, conflicts=2)
+        stats_before = asdict(retry.stats)
+
+        await messagebus.handle(commands.Allocate("o1", "BUSY-SOFA", 10))
+
+        [batch] = (await uow.products.get("BUSY-SOFA")).batches
+        assert batch.available_quantity == 90
+        assert retry.stats.conflicts - stats_before["conflicts"] == 2
+        assert retry.stats.retries - stats_before["retries"] == 2
+
+    async def test_allocate_gives_up_after_the_last_attempt(self, monkeypatch):
+        monkeypatch.setattr(retry.settings, "conflict_retry_attempts", 3)
+        messagebus = await bootstrap_test_app()
+        uow = messagebus.uow_factory()
+        await messagebus.handle(commands.CreateBatch("b1", "BUSY-CHAIR", 100, None))
+        uow.products = ConflictingFakeRepository(uow.products._products, conflicts=3)
+        exhausted_before = retry.stats.exhausted
+
+        with pytest.raises(repository.SynchronousUpdateError):
+            await messagebus.handle(commands.Allocate("o1", "BUSY-CHAIR", 10))
+        assert retry.stats.exhausted - exhausted_before == 1
+
 
 class TestChangeBatchQuantity:
     async def test_changes_available_quantity(self):
@@ -145,7 +340,7 @@ class TestChangeBatchQuantity:
         await messagebus.handle(
             commands.CreateBatch("batch1", "ADORABLE-SETTEE", 100, None),
         )
-        product = await messagebus.uow.products.get(sku="ADORABLE-SETTEE")
+        product = await messagebus.uow_factory().products.get(sku="ADORABLE-SETTEE")
         [batch] = product.batches
         assert batch.available_quantity == 100
 
@@ -167,7 +362,7 @@ class TestChangeBatchQuantity:
             await messagebus.handle(
                 e,
             )
-        product = await messagebus.uow.products.get(sku="INDIFFERENT-TABLE")
+        product = await messagebus.uow_factory().products.get(sku="INDIFFERENT-TABLE")
         [batch1, batch2] = product.batches
         assert batch1.available_quantity == 10
         assert batch2.available_quantity == 50
@@ -196,14 +391,23 @@ class TestChangeBatchQuantity:
         ]
         for e in event_history:
             await messagebus.handle(e)
-        product = await messagebus.uow.products.get(sku="INDIFFERENT-TABLE")
+        product = await messagebus.uow_factory().products.get(sku="INDIFFERENT-TABLE")
         [batch1, batch2] = product.batches
         assert batch1.available_quantity == 10
         assert batch2.available_quantity == 50
 
         await messagebus.handle(commands.ChangeBatchQuantity("batch1", 25))
 
-        *_, reallocation_event = messagebus.uow.events_published
+        *_, reallocation_event = messagebus.uow_factory().events_published
         assert isinstance(reallocation_event, events.Deallocated)
         assert reallocation_event.orderid in {"order1", "order2"}
         assert reallocation_event.sku == "INDIFFERENT-TABLE"
+
+
+def test_the_view_of_a_deallocated_line_is_removed_before_it_is_reallocated():
+    remove, reallocate = handlers.EVENT_HANDLERS[events.Deallocated]
+
+    assert remove is handlers.remove_allocation_from_read_model
+    assert reallocate is handlers.reallocate
+    assert not options_of(remove).deferred
+    assert not options_of(remove).independent
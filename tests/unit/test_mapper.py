@@ -0,0 +1,76 @@
+from datetime import date
+from types import SimpleNamespace
+
+from allocation.domain.model import Batch, OrderLine, Product
+from allocation.repositories import mapper
+
+
+def test_maps_a_product_with_its_allocations():
+    # the mapper only reads attributes, as of the edgedb.Object of a query result
+    obj = SimpleNamespace(
+        sku="RED-CHAIR",
+        version_number=3,
+        batches=[
+            SimpleNamespace(
+                reference="b1",
+                sku="RED-CHAIR",
+                eta=date(2011, 1, 2),
+                purchased_quantity=20,
+                allocations=[SimpleNamespace(orderid="o1", sku="RED-CHAIR", qty=5)],
+            ),
+            SimpleNamespace(
+                reference="b2", sku="RED-CHAIR", eta=None, purchased_quantity=7
+            ),
+        ],
+    )
+
+    product = mapper.product(obj)
+
+    assert isinstance(product, Product)
+    assert product.version_number == 3
+    [b1, b2] = product.batches
+    assert isinstance(b1, Batch) and b1.eta == date(2011, 1, 2)
+    assert b1.allocations == {OrderLine("o1", "RED-CHAIR", 5)}
+    assert b1.available_quantity == 15
+    assert b2.allocations == set() and b2.available_quantity == 7
+
+
+def test_maps_a_batch_loaded_with_its_allocated_quantity():
+    obj = SimpleNamespace(
+        reference="b1",
+        sku="RED-CHAIR",
+        eta=None,
+        purchased_quantity=20,
+        allocated_quantity=12,
+    )
+
+    batch = mapper.batch(obj)
+
+    assert batch.available_quantity == 8
+    assert not batch.allocations_loaded
+
+
+def test_maps_the_lines_of_one_batch_of_a_product_loaded_with_its_totals():
+    obj = SimpleNamespace(
+        sku="RED-CHAIR",
+        version_number=3,
+        batches=[
+            SimpleNamespace(
+                reference=ref,
+                sku="RED-CHAIR",
+                eta=None,
+                purchased_quantity=20,
+                allocated_quantity=5,
+                # the query only loads the lines of the batch asked for
+                allocations=[SimpleNamespace(orderid="o1", sku="RED-CHAIR", qty=5)]
+                if ref == "b1"
+                else [],
+            )
+            for ref in ("b1", "b2")
+        ],
+    )
+
+    b1, b2 = mapper.product(obj, lines_of="b1").batches
+
+    assert b1.allocations_loaded and b1.allocations == {OrderLine("o1", "RED-CHAIR", 5)}
+    assert not b2.allocations_loaded and b2.available_quantity == 15
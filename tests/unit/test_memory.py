@@ -0,0 +1,242 @@
+import asyncio
+from datetime import date
+from unittest import mock
+
+import pytest
+
+from allocation import views
+from allocation.bootstrap import Bootstrap
+from allocation.domain import commands, model
+from allocation.repositories import memory, repository
+from allocation.services import handlers, unit_of_work
+from allocation.services.group_commit import GroupCommit
+
+
+async def add_batch(uow_factory, ref, sku, qty, eta=None):
+    uow = uow_factory()
+    async with uow:
+        product = await uow.products.get(sku)
+        if product is None:
+            product = model.Product(sku, batches=[])
+        product.add_batch(model.Batch(ref, sku, qty, eta))
+        await uow.products.add(product)
+        await uow.commit()
+
+
+async def allocate(uow, orderid, sku, qty=1):
+    product = await uow.products.get(sku, allocations=False)
+    batchref = product.allocate(model.OrderLine(orderid, sku, qty))
+    await uow.products.add(product)
+    return batchref
+
+
+async def test_committed_products_are_seen_by_the_next_unit_of_work():
+    uow_factory = unit_of_work.InMemoryUnitOfWorkFactory()
+    await add_batch(uow_factory, "b1", "LAMP", 10)
+
+    uow = uow_factory()
+    async with uow:
+        assert await allocate(uow, "o1", "LAMP", 3) == "b1"
+        await uow.commit()
+
+    uow = uow_factory()
+    async with uow:
+        product = await uow.products.get_by_batchref("b1")
+    assert product.batches[0].allocations == {model.OrderLine("o1", "LAMP", 3)}
+    assert product.version_number == 2
+
+
+async def test_a_line_allocated_again_is_counted_once():
+    uow_factory = unit_of_work.InMemoryUnitOfWorkFactory()
+    await add_batch(uow_factory, "b1", "LAMP", 10)
+
+    for _ in range(2):  # loaded without its lines, the product cannot tell
+        uow = uow_factory()
+        async with uow:
+            await allocate(uow, "o1", "LAMP", 3)
+            await uow.commit()
+
+    [batch] = uow_factory.store.get("LAMP").batches
+    assert batch.allocations == {model.OrderLine("o1", "LAMP", 3)}
+    assert batch.allocated_quantity == 3
+
+
+async def test_each_caller_of_a_group_commit_gets_the_events_of_its_line():
+    uow_factory = unit_of_work.InMemoryUnitOfWorkFactory()
+    await add_batch(uow_factory, "b1", "LAMP", 10)
+    group_commit = GroupCommit(handlers.allocate_group)
+    uows = [uow_factory() for _ in range(3)]
+
+    await asyncio.gather(
+        *(
+            handlers.allocate(commands.Allocate(f"o{i}", "LAMP", 1), uow, group_commit)
+            for i, uow in enumerate(uows)
+        )
+    )
+
+    for i, uow in enumerate(uows):
+        assert [event.orderid async for event in uow.collect_new_events()] == [f"o{i}"]
+
+
+async def test_uncommitted_changes_are_rolled_back():
+    uow_factory = unit_of_work.InMemoryUnitOfWorkFactory()
+    await add_batch(uow_factory, "b1", "LAMP", 10)
+
+    with pytest.raises(ValueError):
+        uow = uow_factory()
+        async with uow:
+            await allocate(uow, "o1", "LAMP")
+            raise ValueError("boom")
+
+    uow = uow_factory()
+    async with uow:
+        await allocate(uow, "o2", "LAMP")
+    assert uow_factory.store.get("LAMP").batches[0].allocated_quantity == 0
+
+
+async def test_the_second_of_two_concurrent_commits_conflicts():
+    uow_factory = unit_of_work.InMemoryUnitOfWorkFactory()
+    await add_batch(uow_factory, "b1", "LAMP", 10)
+    uow1, uow2 = uow_factory(), uow_factory()
+
+    async with uow1:
+        async with uow2:
+            await allocate(uow1, "o1", "LAMP")
+            await allocate(uow2, "o2", "LAMP")
+            await uow1.commit()
+            with pytest.raises(repository.SynchronousUpdateError):
+                await uow2.commit()
+
+    stored = uow_factory.store.get("LAMP")
+    assert stored.batches[0].allocations == {model.OrderLine("o1", "LAMP", 1)}
+    assert uow_factory.store.stats.conflicts == 1
+
+
+async def test_commits_replace_only_the_changed_batches():
+    uow_factory = unit_of_work.InMemoryUnitOfWorkFactory()
+    await add_batch(uow_factory, "in-stock", "LAMP", 10)
+    await add_batch(uow_factory, "shipment", "LAMP", 10, eta=date(2030, 1, 1))
+    before = uow_factory.store.get("LAMP")
+    in_stock, shipment = before.batches
+
+    uow = uow_factory()
+    async with uow:
+        await allocate(uow, "o1", "LAMP", 4)
+        await uow.commit()
+
+    after = uow_factory.store.get("LAMP")
+    assert after is not before
+    assert after.batches[1] is shipment
+    assert after.batches[0] is not in_stock
+    assert in_stock.allocated_quantity == 0  # what readers of before see
+    assert after.batches[0].allocated_quantity == 4
+
+
+async def test_lines_deallocated_from_a_fully_loaded_product_are_removed():
+    uow_factory = unit_of_work.InMemoryUnitOfWorkFactory()
+    await add_batch(uow_factory, "b1", "LAMP", 10)
+    uow = uow_factory()
+    async with uow:
+        await allocate(uow, "o1", "LAMP", 4)
+        await allocate(uow, "o2", "LAMP", 4)
+        await uow.commit()
+
+    uow = uow_factory()
+    async with uow:
+        product = await uow.products.get_by_batchref("b1")
+        product.change_batch_quantity("b1", 5)
+        await uow.products.add(product)
+        await uow.commit()
+
+    batch = uow_factory.store.get("LAMP").batches[0]
+    assert batch.allocated_quantity == 4
+    store = uow_factory.store
+    assert len(store.allocations("o1") + store.allocations("o2")) == 1
+
+
+async def test_snapshots_are_loaded_on_startup(tmp_path):
+    path = str(tmp_path / "products.json")
+    uow_factory = unit_of_work.InMemoryUnitOfWorkFactory(memory.ProductStore(path, 0))
+    await uow_factory.connect()
+    await add_batch(uow_factory, "b1", "LAMP", 10, eta=date(2030, 1, 1))
+    uow = uow_factory()
+    async with uow:
+        await allocate(uow, "o1", "LAMP", 2)
+        await uow.commit()
+    await uow_factory.aclose()
+    assert uow_factory.store.stats.snapshots == 1
+
+    restarted = unit_of_work.InMemoryUnitOfWorkFactory(memory.ProductStore(path, 0))
+    await restarted.connect()
+
+    product = restarted.store.get("LAMP")
+    assert product.version_number == 2
+    assert product.batches[0].eta == date(2030, 1, 1)
+    assert product.batches[0].allocations == {model.OrderLine("o1", "LAMP", 2)}
+    assert restarted.store.allocations("o1") == [{"sku": "LAMP", "batchref": "b1"}]
+
+
+async def test_bootstrap_selects_the_memory_backend(monkeypatch):
+    monkeypatch.setattr("allocation.bootstrap.settings.repository_backend", "memory")
+    publish = mock.AsyncMock()
+    bus = Bootstrap(
+        notifications=mock.AsyncMock(),
+        publish=publish,
+        allocations_cache=mock.AsyncMock(),
+    ).messagebus
+    assert isinstance(bus.uow_factory, unit_of_work.InMemoryUnitOfWorkFactory)
+
+    await bus.handle(commands.CreateBatch("b1", "LAMP", 10, None))
+    await bus.handle(commands.Allocate("o1", "LAMP", 1))
+
+    assert await views.allocations("o1", bus.uow_factory()) == [
+        {"sku": "LAMP", "batchref": "b1"}
+    ]
+    publish.assert_awaited_once()
+
+
+def memory_bus(publish=None):
+    return Bootstrap(
+        uow_factory=unit_of_work.InMemoryUnitOfWorkFactory(),
+        notifications=mock.AsyncMock(),
+        publish=publish or mock.AsyncMock(),
+        allocations_cache=mock.AsyncMock(),
+    ).messagebus
+
+
+async def test_a_repeated_allocation_allocates_the_line_once():
+    publish = mock.AsyncMock()
+    bus = memory_bus(publish)
+    await bus.handle(commands.CreateBatch("b1", "LAMP", 10, None))
+
+    assert await bus.handle(commands.Allocate("o1", "LAMP", 3)) == "b1"
+    assert await bus.handle(commands.Allocate("o1", "LAMP", 3)) == "b1"
+
+    [batch] = bus.uow_factory.store.get("LAMP").batches
+    assert batch.allocated_quantity == 3
+    assert batch.allocations == {model.OrderLine("o1", "LAMP", 3)}
+    publish.assert_awaited_once()
+
+
+async def test_a_quantity_change_loads_the_lines_of_its_batch_only():
+    bus = memory_bus()
+    await bus.handle(commands.CreateBatch("b1", "LAMP", 10, None))
+    await bus.handle(commands.CreateBatch("b2", "LAMP", 10, date(2030, 1, 1)))
+    await bus.handle(commands.Allocate("o1", "LAMP", 4))
+    await bus.handle(commands.Allocate("o2", "LAMP", 4))
+
+    uow = bus.uow_factory()
+    async with uow:
+        product = await uow.products.get_by_batchref(
+            "b1", allocations=False, batch_lines=True
+        )
+    b1, b2 = product.batches
+    assert b1.allocations_loaded and len(b1.allocations) == 2
+    assert not b2.allocations_loaded
+
+    await bus.handle(commands.ChangeBatchQuantity("b1", 5))
+
+    b1, b2 = bus.uow_factory.store.get("LAMP").batches
+    assert (b1.allocated_quantity, b2.allocated_quantity) == (4, 4)
+    with pytest.raises(handlers.InvalidSku):
+        await bus.handle(commands.ChangeBatchQuantity("no-such-batch", 5))
@@ -0,0 +1,227 @@
+import asyncio
+import logging
+
+from allocation.domain import commands, events
+from allocation.services import background, messagebus, unit_of_work
+
+
+class EventsUnitOfWork:
+    """Hands the events put into it to the messagebus."""
+
+    def __init__(self):
+        self.new_events = []
+
+    async def collect_new_events(self):
+        while self.new_events:
+            yield self.new_events.pop(0)
+
+
+class EventsUnitOfWorkFactory(unit_of_work.AbstractUnitOfWorkFactory):
+    def __call__(self):
+        return EventsUnitOfWork()
+
+
+def make_bus(event_handlers, command_handler=None, background_queue=None):
+    return messagebus.MessageBus(
+        uow_factory=EventsUnitOfWorkFactory(),
+        event_handlers=event_handlers,
+        command_handlers={commands.Allocate: command_handler},
+        background=background_queue,
+    )
+
+
+async def test_independent_handlers_run_at_the_same_time():
+    started = []
+    both_started = asyncio.Event()
+
+    def handler(name):
+        @messagebus.handler_options(independent=True, timeout=1)
+        async def wait_for_the_other(event, uow_factory):
+            started.append(name)
+            if len(started) == 2:
+                both_started.set()
+            await both_started.wait()
+
+        return wait_for_the_other
+
+    bus = make_bus({events.OutOfStock: [handler("a"), handler("b")]})
+    await bus.handle(events.OutOfStock("LAMP"))
+
+    assert sorted(started) == ["a", "b"]
+
+
+async def test_other_handlers_run_in_order():
+    called = []
+
+    async def first(event, uow_factory):
+        await asyncio.sleep(0.01)
+        called.append("first")
+
+    async def second(event, uow_factory):
+        called.append("second")
+
+    bus = make_bus({events.OutOfStock: [first, second]})
+    await bus.handle(events.OutOfStock("LAMP"))
+
+    assert called == ["first", "second"]
+
+
+async def test_a_failing_or_slow_handler_does_not_stop_the_others(caplog):
+    called = []
+
+    @messagebus.handler_options(independent=True)
+    async def failing(event, uow_factory):
+        raise ValueError("boom")
+
+    @messagebus.handler_options(independent=True, timeout=0.01)
+    async def slow(event, uow_factory):
+        await asyncio.sleep(1)
+        called.append("slow")
+
+    @messagebus.handler_options(independent=True)
+    async def fine(event, uow_factory):
+        called.append("fine")
+
+    bus = make_bus({events.OutOfStock: [failing, slow, fine]})
+    with caplog.at_level(logging.ERROR):
+        await bus.handle(events.OutOfStock("LAMP"))
+
+    assert called == ["fine"]
+    errors = [record.getMessage() for record in caplog.records]
+    assert any("Exception" in e and "failing" in e for e in errors)
+    assert any("Timeout" in e and "slow" in e for e in errors)
+
+
+async def test_concurrent_calls_do_not_lose_each_others_events():
+    handled = []
+
+    async def allocate(cmd, uow_factory):
+        uow_factory().new_events.extend(
+            [events.OutOfStock(cmd.sku), events.OutOfStock(f"{cmd.sku}-again")]
+        )
+
+    async def out_of_stock(event, uow_factory):
+        handled.append(event.sku)
+        await asyncio.sleep(0.01)
+
+    bus = make_bus({events.OutOfStock: [out_of_stock]}, allocate)
+    first = asyncio.create_task(bus.handle(commands.Allocate("o1", "A", 1)))
+    await asyncio.sleep(0.005)  # the first call is handling its first event
+    await bus.handle(commands.Allocate("o2", "B", 1))
+    await first
+
+    assert sorted(handled) == ["A", "A-again", "B", "B-again"]
+
+
+async def test_deferred_handlers_run_after_the_command_returns():
+    handled = []
+    release = asyncio.Event()
+
+    async def allocate(cmd, uow_factory):
+        uow_factory().new_events.append(events.OutOfStock(cmd.sku))
+        return "allocated"
+
+    @messagebus.handler_options(deferred=True)
+    async def notify(event, uow_factory):
+        await release.wait()
+        handled.append(event.sku)
+        uow_factory().new_events.append(events.Deallocated("o1", event.sku, 1))
+
+    async def deallocated(event, uow_factory):
+        handled.append("deallocated")
+
+    queue = background.BackgroundQueue(workers=2)
+    bus = make_bus(
+        {events.OutOfStock: [notify], events.Deallocated: [deallocated]},
+        allocate,
+        queue,
+    )
+
+    assert await bus.handle(commands.Allocate("o1", "LAMP", 1)) == "allocated"
+    assert handled == []
+
+    release.set()
+    await queue.aclose()
+    assert handled == ["LAMP", "deallocated"]
+
+
+async def test_failing_idempotent_deferred_handlers_are_retried():
+    attempts = []
+
+    @messagebus.handler_options(deferred=True, idempotent=True)
+    async def flaky(event, uow_factory):
+        attempts.append(event.sku)
+        if len(attempts) < 3:
+            raise ConnectionError("try again")
+
+    queue = background.BackgroundQueue(attempts=3, retry_delay=0.001)
+    bus = make_bus({events.OutOfStock: [flaky]}, background_queue=queue)
+    await bus.handle(events.OutOfStock("LAMP"))
+    await queue.aclose()
+
+    assert attempts == ["LAMP", "LAMP", "LAMP"]
+
+
+async def test_only_the_failing_idempotent_handler_is_retried():
+    handled = []
+
+    @messagebus.handler_options(deferred=True)
+    async def once(event, uow_factory):
+        handled.append("once")
+        raise ConnectionError("not again")
+
+    @messagebus.handler_options(deferred=True, idempotent=True)
+    async def notify(event, uow_factory):
+        handled.append("notify")
+        uow_factory().new_events.append(events.Deallocated("o1", event.sku, 1))
+
+    async def deallocated(event, uow_factory):
+        handled.append("deallocated")
+        raise ConnectionError("not with notify")
+
+    queue = background.BackgroundQueue(attempts=3, retry_delay=0.001)
+    bus = make_bus(
+        {events.OutOfStock: [once, notify], events.Deallocated: [deallocated]},
+        background_queue=queue,
+    )
+    await bus.handle(events.OutOfStock("LAMP"))
+    await queue.aclose()
+
+    assert sorted(handled) == ["deallocated", "notify", "once"]
+
+
+async def test_jobs_queue_their_deferred_handlers_without_waiting_for_room():
+    handled = []
+
+    @messagebus.handler_options(deferred=True)
+    async def notify(event, uow_factory):
+        uow_factory().new_events.extend(
+            events.Deallocated(f"o{i}", event.sku, 1) for i in range(3)
+        )
+
+    @messagebus.handler_options(deferred=True)
+    async def deallocated(event, uow_factory):
+        handled.append(event.orderid)
+
+    queue = background.BackgroundQueue(workers=1, max_queued=1)
+    bus = make_bus(
+        {events.OutOfStock: [notify], events.Deallocated: [deallocated]},
+        background_queue=queue,
+    )
+    await bus.handle(events.OutOfStock("LAMP"))
+    await asyncio.wait_for(queue.aclose(), timeout=1)
+
+    assert handled == ["o0", "o1", "o2"]
+
+
+async def test_without_a_background_queue_deferred_handlers_run_inline():
+    handled = []
+
+    @messagebus.handler_options(deferred=True)
+    async def notify(event, uow_factory):
+        handled.append(event.sku)
+
+    bus = make_bus({events.OutOfStock: [notify]})
+    await bus.handle(events.OutOfStock("LAMP"))
+
+    assert handled == ["LAMP"]
@@ -0,0 +1,124 @@
+import asyncio
+from unittest import mock
+
+import httpx
+import pytest
+
+from allocation import metrics
+from allocation.app import main
+from allocation.bootstrap import Bootstrap
+from allocation.domain import commands
+from allocation.services import background, handlers, messagebus, unit_of_work
+
+
+def test_histograms_render_cumulative_buckets():
+    registry = metrics.Registry()
+    histogram = metrics.Histogram(
+        "seconds", "Time.", ("query",), buckets=(0.1, 1.0), registry=registry
+    )
+    for value in (0.05, 0.5, 0.5, 5.0):
+        histogram.observe(value, "get")
+
+    lines = registry.render().splitlines()
+
+    assert lines[:2] == ["# HELP seconds Time.", "# TYPE seconds histogram"]
+    assert lines[2:] == [
+        'seconds_bucket{query="get",le="0.1"} 1',
+        'seconds_bucket{query="get",le="1.0"} 3',
+        'seconds_bucket{query="get",le="+Inf"} 4',
+        'seconds_sum{query="get"} 6.05',
+        'seconds_count{query="get"} 4',
+    ]
+
+
+def test_gauges_are_collected_when_scraped_and_labels_escaped():
+    registry = metrics.Registry()
+    depths = [3]
+    metrics.Gauge("depth", "Depth.", collect=lambda: [((), depths[0])], registry=registry)
+    counter = metrics.Counter("total", "Total.", ("name",), registry=registry)
+    counter.inc('say "hi"\n')
+    depths[0] = 5
+
+    rendered = registry.render()
+
+    assert "\ndepth 5\n" in rendered
+    assert 'total{name="say \\"hi\\"\\n"} 1' in rendered
+    with pytest.raises(ValueError):
+        metrics.Counter("total", "Again.", registry=registry)
+
+
+def test_stats_are_exported_as_counters_and_gauges_added_up_over_instances():
+    registry = metrics.Registry()
+    stats = [
+        background.BackgroundStats(queued=1, done=2),
+        background.BackgroundStats(queued=2, done=3),
+    ]
+    metrics.export_stats(
+        "jobs",
+        lambda: stats,
+        counters={"done": "Jobs done."},
+        gauges={"queued": "Jobs queued."},
+        registry=registry,
+    )
+
+    lines = registry.render().splitlines()
+
+    assert lines == [
+        "# HELP jobs_done_total Jobs done.",
+        "# TYPE jobs_done_total counter",
+        "jobs_done_total 5",
+        "# HELP jobs_queued Jobs queued.",
+        "# TYPE jobs_queued gauge",
+        "jobs_queued 3",
+    ]
+
+
+async def test_the_bus_times_its_handlers_and_counts_their_failures():
+    bus = Bootstrap(
+        uow_factory=unit_of_work.InMemoryUnitOfWorkFactory(),
+        notifications=mock.AsyncMock(),
+        publish=mock.AsyncMock(),
+        allocations_cache=mock.AsyncMock(),
+    ).messagebus
+    labels = ("command", "Allocate", "allocate")
+    calls = sum(messagebus.handler_seconds.values.get(labels, [0])[:-1])
+    failures = messagebus.handler_failures.values.get(labels, 0)
+
+    await bus.handle(commands.CreateBatch("b1", "LAMP", 10, None))
+    await bus.handle(commands.Allocate("o1", "LAMP", 1))
+    with pytest.raises(handlers.InvalidSku):
+        await bus.handle(commands.Allocate("o2", "NOSUCHSKU", 1))
+
+    assert sum(messagebus.handler_seconds.values[labels][:-1]) == calls + 2
+    assert messagebus.handler_failures.values[labels] == failures + 1
+    assert messagebus.bus_messages.values[("handling",)] == 0
+
+
+async def test_metrics_endpoint():
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=main.make_app()), base_url="http://test"
+    ) as client:
+        response = await client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "# TYPE allocation_handler_seconds histogram" in response.text
+    assert "# TYPE allocation_edgeql_query_seconds histogram" in response.text
+    assert "\nallocation_product_cache_hits_total " in response.text
+
+
+async def test_metrics_are_served_without_an_api():
+    registry = metrics.Registry()
+    metrics.Counter("total", "Total.", registry=registry).inc()
+    server = await metrics.serve("127.0.0.1", 0, registry)
+    port = server.sockets[0].getsockname()[1]
+
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    response = await reader.read()
+    writer.close()
+    server.close()
+    await server.wait_closed()
+
+    assert response.startswith(b"HTTP/1.1 200 OK\r\n")
+    assert response.endswith(b"# TYPE total counter\ntotal 1\n")
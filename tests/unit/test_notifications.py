@@ -0,0 +1,53 @@
+import asyncio
+
+from allocation.adapters.notifications import DigestEmailNotifications, EmailNotifications
+from tests.smtp_standin import SMTPStandIn
+
+
+async def test_messages_are_sent_over_one_connection():
+    async with SMTPStandIn() as server:
+        notifications = EmailNotifications(server.host, server.port)
+        for sku in ("LAMP", "TABLE", "CHAIR"):
+            await notifications.send("stock@made.com", f"Out of stock for {sku}")
+        await notifications.aclose()
+
+    assert len(server.messages) == 3
+    assert server.connections == 1
+    assert server.messages[0][0] == ["stock@made.com"]
+    assert "Out of stock for LAMP" in server.messages[0][1]
+
+
+async def test_a_dropped_connection_is_reopened():
+    async with SMTPStandIn() as server:
+        notifications = EmailNotifications(server.host, server.port)
+        await notifications.send("stock@made.com", "Out of stock for LAMP")
+        server.drop_connections()
+        await asyncio.sleep(0.01)
+        await notifications.send("stock@made.com", "Out of stock for TABLE")
+        await notifications.aclose()
+
+    assert len(server.messages) == 2
+    assert server.connections == 2
+
+
+async def test_notifications_of_a_window_are_sent_as_one_digest():
+    async with SMTPStandIn() as server:
+        notifications = DigestEmailNotifications(server.host, server.port, window=0.05)
+        for _ in range(1000):
+            await notifications.send("stock@made.com", "Out of stock for LAMP")
+        await notifications.send("stock@made.com", "Out of stock for TABLE")
+        await asyncio.sleep(0.1)
+
+        [(recipients, digest)] = server.messages
+        assert recipients == ["stock@made.com"]
+        assert digest.splitlines()[1:] == [
+            "Out of stock for LAMP (1000 times)",
+            "Out of stock for TABLE",
+        ]
+
+        await notifications.send("stock@made.com", "Out of stock for LAMP")
+        await notifications.aclose()  # sends the rest without waiting
+
+    assert len(server.messages) == 2
+    assert server.messages[1][1].splitlines()[1:] == ["Out of stock for LAMP"]
+    assert server.connections == 1
@@ -0,0 +1,41 @@
+import json
+from unittest import mock
+
+from allocation.adapters import outbox
+from allocation.app.settings import settings
+from allocation.bootstrap import Bootstrap
+from allocation.domain import events
+from allocation.services import handlers, unit_of_work
+
+
+def test_only_published_events_go_to_the_outbox():
+    messages = outbox.messages(
+        [events.Allocated("o1", "LAMP", 10, "b1"), events.OutOfStock("LAMP")]
+    )
+
+    assert messages == [
+        {
+            "channel": "line_allocated",
+            "payload": json.dumps(
+                {"orderid": "o1", "sku": "LAMP", "qty": 10, "batchref": "b1"}
+            ),
+        }
+    ]
+
+
+def test_handlers_publish_unless_the_units_of_work_write_the_outbox(monkeypatch):
+    monkeypatch.setattr(settings, "event_publishing", "outbox")
+
+    def allocated_handlers(uow_factory):
+        bus = Bootstrap(
+            uow_factory=uow_factory,
+            notifications=mock.AsyncMock(),
+            publish=mock.AsyncMock(),
+            allocations_cache=mock.AsyncMock(),
+        ).messagebus
+        return [handler.__wrapped__ for handler in bus.event_handlers[events.Allocated]]
+
+    without_outbox = unit_of_work.EdgedbUnitOfWorkFactory(mock.Mock(), use_outbox=False)
+    assert handlers.publish_allocated_event in allocated_handlers(without_outbox)
+    with_outbox = unit_of_work.EdgedbUnitOfWorkFactory(mock.Mock())
+    assert handlers.publish_allocated_event not in allocated_handlers(with_outbox)
@@ -1,7 +1,9 @@
 from datetime import date, timedelta
 
+import pytest
+
 from allocation.domain import events
-from allocation.domain.model import Batch, OrderLine, Product
+from allocation.domain.model import Batch, OrderLine, Product, UnknownBatch
 
 today = date.today()
 tomorrow = today + timedelta(days=1)
@@ -70,3 +72,43 @@ def test_increments_version_number():
     product.version_number = 7
     product.allocate(line)
     assert product.version_number == 8
+
+
+def test_batches_added_later_are_allocated_in_eta_order():
+    product = Product("RETRO-LAMP", [Batch("slow", "RETRO-LAMP", 10, eta=later)])
+    product.add_batch(Batch("speedy", "RETRO-LAMP", 10, eta=tomorrow))
+    product.add_batch(Batch("slower", "RETRO-LAMP", 10, eta=later))
+    product.add_batch(Batch("in-stock", "RETRO-LAMP", 10, eta=None))
+
+    refs = [product.allocate(OrderLine(f"o{i}", "RETRO-LAMP", 10)) for i in range(4)]
+
+    assert refs == ["in-stock", "speedy", "slow", "slower"]
+
+
+def test_skips_batches_without_room_for_the_line():
+    small = Batch("small", "RETRO-LAMP", 5, eta=None)
+    big = Batch("big", "RETRO-LAMP", 50, eta=later)
+    product = Product("RETRO-LAMP", [big, small])
+
+    assert product.allocate(OrderLine("o1", "RETRO-LAMP", 10)) == "big"
+    assert product.allocate(OrderLine("o2", "RETRO-LAMP", 5)) == "small"
+    assert product.allocate(OrderLine("o3", "RETRO-LAMP", 41)) is None
+
+
+def test_changed_batch_quantity_is_taken_into_account():
+    batch = Batch("b1", "RETRO-LAMP", 10, eta=None)
+    shipment = Batch("b2", "RETRO-LAMP", 10, eta=tomorrow)
+    product = Product("RETRO-LAMP", [batch, shipment])
+    product.change_batch_quantity("b1", 2)
+    assert product.allocate(OrderLine("o1", "RETRO-LAMP", 5)) == "b2"
+
+    product.change_batch_quantity("b1", 20)
+    assert product.allocate(OrderLine("o2", "RETRO-LAMP", 5)) == "b1"
+
+
+def test_changing_the_quantity_of_an_unknown_batch_is_a_domain_error():
+    product = Product("RETRO-LAMP", [Batch("b1", "RETRO-LAMP", 10, eta=None)])
+
+    with pytest.raises(UnknownBatch, match="Unknown batch b2 of RETRO-LAMP"):
+        product.change_batch_quantity("b2", 5)
+    assert product.version_number == 0
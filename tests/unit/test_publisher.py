@@ -0,0 +1,106 @@
+import asyncio
+import json
+
+from allocation.adapters import redis_eventpublisher
+from allocation.domain import events
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.buffered = []
+
+    def publish(self, channel, payload):
+        self.buffered.append((channel, payload))
+
+    async def execute(self):
+        await self.redis.available.wait()
+        self.redis.batches.append(self.buffered)
+
+
+class FakeRedis:
+    def __init__(self):
+        self.batches = []
+        self.available = asyncio.Event()
+        self.available.set()
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+def allocated(i):
+    return events.Allocated(f"o{i}", "LAMP", 1, "b1")
+
+
+async def test_events_are_published_in_batches_of_batch_size():
+    redis = FakeRedis()
+    publisher = redis_eventpublisher.BufferedPublisher(redis, batch_size=10, linger=1)
+
+    for i in range(25):
+        await publisher.publish("line_allocated", allocated(i))
+    await publisher.aclose()
+
+    assert [len(batch) for batch in redis.batches] == [10, 10, 5]
+    assert redis.batches[0][0] == (
+        "line_allocated",
+        json.dumps({"orderid": "o0", "sku": "LAMP", "qty": 1, "batchref": "b1"}),
+    )
+    assert publisher.stats.published == 25
+    assert publisher.stats.max_flush_size == 10
+
+
+async def test_a_partial_batch_is_sent_after_linger():
+    redis = FakeRedis()
+    publisher = redis_eventpublisher.BufferedPublisher(
+        redis, batch_size=10, linger=0.01
+    )
+
+    await publisher.publish("line_allocated", allocated(1))
+    await asyncio.sleep(0.05)
+
+    assert [len(batch) for batch in redis.batches] == [1]
+    await publisher.aclose()
+
+
+async def test_publishers_wait_while_the_buffer_is_full():
+    redis = FakeRedis()
+    redis.available.clear()
+    publisher = redis_eventpublisher.BufferedPublisher(
+        redis, batch_size=2, linger=0, max_buffered=2
+    )
+    for i in range(4):  # one batch is being sent, the next one is buffered
+        await publisher.publish("line_allocated", allocated(i))
+
+    blocked = asyncio.create_task(publisher.publish("line_allocated", allocated(4)))
+    await asyncio.sleep(0.01)
+    assert not blocked.done()
+
+    redis.available.set()
+    await asyncio.wait_for(blocked, timeout=1)
+    await publisher.aclose()
+    assert publisher.stats.published == 5
+
+
+async def test_a_batch_that_cannot_be_sent_does_not_stop_the_flusher():
+    redis = FakeRedis()
+    publisher = redis_eventpublisher.BufferedPublisher(redis, batch_size=1, linger=0)
+    unserializable = events.Allocated("o1", "LAMP", object(), "b1")
+
+    await publisher.publish("line_allocated", unserializable)
+    await publisher.publish("line_allocated", allocated(2))
+    await asyncio.wait_for(publisher.aclose(), timeout=1)
+
+    assert publisher.stats.failed == 1
+    assert publisher.stats.published == 1
+
+
+async def test_closing_gives_up_on_events_redis_does_not_take():
+    redis = FakeRedis()
+    redis.available.clear()
+    publisher = redis_eventpublisher.BufferedPublisher(redis, batch_size=1, linger=0)
+    await publisher.publish("line_allocated", allocated(1))
+
+    await asyncio.wait_for(publisher.aclose(timeout=0.05), timeout=1)
+
+    assert publisher.flusher is None
+    assert redis.batches == []
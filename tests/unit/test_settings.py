@@ -0,0 +1,10 @@
+import pytest
+from pydantic import ValidationError
+
+from allocation.app.settings import Settings
+
+
+def test_the_modes_are_checked_on_startup():
+    assert Settings(sharding="local", command_channel="streams").sharding == "local"
+    with pytest.raises(ValidationError, match="sharding"):
+        Settings(sharding="sideways")
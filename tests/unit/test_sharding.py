@@ -0,0 +1,133 @@
+import asyncio
+from datetime import date
+
+import pytest
+
+from allocation.adapters.shard_transport import LocalShardTransport
+from allocation.domain import commands
+from allocation.services import handlers, sharding
+
+
+class RecordingBus:
+    """Stands in for the messagebus of a worker."""
+
+    def __init__(self, name, handled):
+        self.name = name
+        self.handled = handled
+
+    async def handle(self, message):
+        self.handled.append((self.name, message))
+        if isinstance(message, commands.AllocateMany):
+            return [
+                handlers.AllocationResult(line.orderid, line.sku, self.name, "allocated")
+                for line in message.lines
+            ]
+        if message.sku == "MISSING":
+            raise handlers.InvalidSku("Invalid sku MISSING")
+        return self.name
+
+
+async def start(names, handled):
+    transport = LocalShardTransport()
+    tasks = {
+        name: asyncio.create_task(
+            sharding.ShardWorker(name, transport, RecordingBus(name, handled)).run()
+        )
+        for name in names
+    }
+    await asyncio.sleep(0)
+    router = sharding.ShardRouter(transport, RecordingBus("local", handled))
+    await router.refresh()
+    return router, tasks
+
+
+async def stop(tasks):
+    for task in tasks.values():
+        task.cancel()
+    await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+
+def test_a_node_joining_takes_over_only_a_share_of_the_keys():
+    keys = [f"sku-{i}" for i in range(10_000)]
+    ring = sharding.HashRing(["w1", "w2", "w3"])
+    before = {key: ring.owner(key) for key in keys}
+
+    ring.add("w4")
+    moved = [key for key in keys if ring.owner(key) != before[key]]
+
+    assert all(ring.owner(key) == "w4" for key in moved)
+    assert 0.15 < len(moved) / len(keys) < 0.35
+
+    ring.remove("w4")
+    assert {key: ring.owner(key) for key in keys} == before
+
+
+async def test_commands_of_a_sku_go_to_its_owner():
+    handled = []
+    router, tasks = await start(["w1", "w2", "w3"], handled)
+
+    owners = {sku: router.ring.owner(sku) for sku in ("LAMP", "RUG", "SOFA")}
+    for sku in owners:
+        await router.handle(commands.CreateBatch(f"b-{sku}", sku, 10, date.today()))
+        assert await router.handle(commands.Allocate("o1", sku, 1)) == owners[sku]
+
+    assert [(worker, type(cmd)) for worker, cmd in handled] == [
+        (owners[sku], command)
+        for sku in owners
+        for command in (commands.CreateBatch, commands.Allocate)
+    ]
+    assert handled[0][1].eta == date.today()
+    await stop(tasks)
+
+
+async def test_bulk_allocations_are_split_by_owner_and_merged_in_order():
+    handled = []
+    router, tasks = await start(["w1", "w2", "w3"], handled)
+    lines = [commands.Allocate(f"o{i}", f"sku-{i % 7}", 1) for i in range(20)]
+
+    results = await router.handle(commands.AllocateMany(lines))
+
+    assert [result.orderid for result in results] == [line.orderid for line in lines]
+    assert [result.batchref for result in results] == [
+        router.ring.owner(line.sku) for line in lines
+    ]
+    assert len(handled) == len({router.ring.owner(line.sku) for line in lines})
+    await stop(tasks)
+
+
+async def test_bulk_lines_of_an_unreachable_owner_fail_alone():
+    handled = []
+    router, tasks = await start(["w1", "w2"], handled)
+    lines = [commands.Allocate(f"o{i}", f"sku-{i}", 1) for i in range(20)]
+
+    tasks.pop("w1").cancel()
+    await asyncio.sleep(0)  # w1 left, but the ring does not know yet
+    results = await router.handle(commands.AllocateMany(lines))
+
+    assert [result.orderid for result in results] == [line.orderid for line in lines]
+    assert [result.status for result in results] == [
+        "unavailable" if router.ring.owner(line.sku) == "w1" else "allocated"
+        for line in lines
+    ]
+    await stop(tasks)
+
+
+async def test_errors_of_the_owner_reach_the_caller():
+    router, tasks = await start(["w1"], [])
+
+    with pytest.raises(handlers.InvalidSku, match="Invalid sku MISSING"):
+        await router.handle(commands.Allocate("o1", "MISSING", 1))
+    await stop(tasks)
+
+
+async def test_skus_of_a_worker_that_left_move_to_the_others():
+    handled = []
+    router, tasks = await start(["w1", "w2"], handled)
+    sku = next(f"sku-{i}" for i in range(100) if router.ring.owner(f"sku-{i}") == "w1")
+
+    tasks.pop("w1").cancel()
+    await asyncio.sleep(0)
+    await router.refresh()
+
+    assert await router.handle(commands.Allocate("o1", sku, 1)) == "w2"
+    await stop(tasks)
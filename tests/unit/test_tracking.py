@@ -0,0 +1,75 @@
+from datetime import date
+
+from allocation.domain.model import Batch, OrderLine, Product
+from allocation.repositories import tracking
+
+
+def make_product(*batches: Batch) -> Product:
+    return Product(sku="SHINY-KETTLE", batches=list(batches), version_number=1)
+
+
+def make_batch(ref: str, qty: int = 100, eta: date | None = None) -> Batch:
+    return Batch(ref, "SHINY-KETTLE", qty, eta)
+
+
+def test_new_product_is_written_completely():
+    batch = make_batch("b1")
+    line = OrderLine(orderid="o1", sku="SHINY-KETTLE", qty=10)
+    batch.allocate(line)
+
+    changes = tracking.diff(None, make_product(batch))
+
+    assert changes.batches == [batch]
+    assert changes.added == [("b1", line)]
+    assert changes.removed == []
+
+
+def test_unchanged_product_has_no_changes():
+    batch = make_batch("b1")
+    batch.allocate(OrderLine(orderid="o1", sku="SHINY-KETTLE", qty=10))
+    product = make_product(batch)
+
+    changes = tracking.diff(tracking.ProductSnapshot.of(product), product)
+
+    assert changes == tracking.ProductChanges()
+
+
+def test_only_new_allocations_are_added():
+    batch = make_batch("b1")
+    for i in range(50):
+        batch.allocate(OrderLine(orderid=f"o{i}", sku="SHINY-KETTLE", qty=1))
+    product = make_product(batch, make_batch("b2"))
+    snapshot = tracking.ProductSnapshot.of(product)
+
+    new_line = OrderLine(orderid="new", sku="SHINY-KETTLE", qty=1)
+    product.allocate(new_line)
+
+    changes = tracking.diff(snapshot, product)
+    assert changes.batches == []
+    assert changes.added == [("b1", new_line)]
+    assert changes.removed == []
+
+
+def test_changed_quantity_and_deallocations():
+    batch = make_batch("b1", qty=20)
+    line = OrderLine(orderid="o1", sku="SHINY-KETTLE", qty=20)
+    batch.allocate(line)
+    product = make_product(batch)
+    snapshot = tracking.ProductSnapshot.of(product)
+
+    product.change_batch_quantity("b1", 10)
+
+    changes = tracking.diff(snapshot, product)
+    assert changes.batches == [batch]
+    assert changes.added == []
+    assert changes.removed == [("b1", line)]
+
+
+def test_new_batch_of_a_stored_product():
+    product = make_product(make_batch("b1"))
+    snapshot = tracking.ProductSnapshot.of(product)
+    new_batch = make_batch("b2")
+
+    product.add_batch(new_batch)
+
+    assert tracking.diff(snapshot, product).batches == [new_batch]
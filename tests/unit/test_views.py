@@ -0,0 +1,114 @@
+from types import SimpleNamespace
+from unittest import mock
+
+from allocation import views
+from allocation.adapters.allocations_cache import InMemoryAllocationsCache
+from allocation.domain import events
+from allocation.services import handlers
+
+
+class FakeReadModelClient:
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = 0
+
+    async def query(self, query, **kwargs):
+        self.queries += 1
+        return self.rows
+
+
+class FakeReadModelUnitOfWork:
+    def __init__(self, rows=()):
+        self.async_client = FakeReadModelClient(list(rows))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def commit(self):
+        pass
+
+
+async def test_cold_cache_is_read_through():
+    cache = InMemoryAllocationsCache()
+    uow = FakeReadModelUnitOfWork([SimpleNamespace(sku="LAMP", batchref="b1")])
+
+    view = await views.allocations("o1", uow, cache)
+
+    assert view == [{"sku": "LAMP", "batchref": "b1"}]
+    assert await cache.get("o1") == view
+
+
+async def test_warm_cache_does_not_query_edgedb():
+    cache = InMemoryAllocationsCache()
+    await cache.set("o1", [{"sku": "LAMP", "batchref": "b1"}], 0)
+    uow = FakeReadModelUnitOfWork()
+
+    view = await views.allocations("o1", uow, cache)
+
+    assert view == [{"sku": "LAMP", "batchref": "b1"}]
+    assert uow.async_client.queries == 0
+
+
+async def test_read_model_handlers_invalidate_the_cache():
+    cache = InMemoryAllocationsCache()
+    await cache.set("o1", [{"sku": "LAMP", "batchref": "b0"}], 0)
+    await handlers.add_allocation_to_read_model(
+        events.Allocated("o1", "LAMP", 10, "b1"), FakeReadModelUnitOfWork(), cache
+    )
+    assert await cache.get("o1") is None
+
+    await cache.set(
+        "o1", [{"sku": "LAMP", "batchref": "b1"}], await cache.generation("o1")
+    )
+    assert await cache.get("o1") is not None
+    await handlers.remove_allocation_from_read_model(
+        events.Deallocated("o1", "LAMP", 10), FakeReadModelUnitOfWork(), cache
+    )
+    assert await cache.get("o1") is None
+
+
+async def test_orders_not_allocated_yet_are_not_cached():
+    cache = InMemoryAllocationsCache()
+
+    assert await views.allocations("o1", FakeReadModelUnitOfWork(), cache) == []
+    assert await cache.get("o1") is None
+
+
+async def test_a_view_read_before_an_invalidation_is_not_cached_after_it():
+    cache = InMemoryAllocationsCache()
+    uow = FakeReadModelUnitOfWork([SimpleNamespace(sku="LAMP", batchref="b1")])
+    query = uow.async_client.query
+
+    async def query_while_the_allocation_changes(*args, **kwargs):
+        rows = await query(*args, **kwargs)
+        await cache.invalidate("o1")  # the read model handler of the change
+        return rows
+
+    uow.async_client.query = query_while_the_allocation_changes
+    await views.allocations("o1", uow, cache)
+
+    assert await cache.get("o1") is None
+
+
+async def test_memory_cache_entries_expire_and_are_bounded():
+    cache = InMemoryAllocationsCache(ttl=60, max_entries=2)
+    view = [{"sku": "LAMP", "batchref": "b1"}]
+    for orderid in ("o1", "o2", "o3"):
+        await cache.set(orderid, view, await cache.generation(orderid))
+
+    assert await cache.get("o1") is None
+    assert await cache.get("o3") == view
+    with mock.patch("time.monotonic", return_value=10**9):
+        assert await cache.get("o3") is None
+
+
+async def test_forgotten_generations_do_not_repeat():
+    cache = InMemoryAllocationsCache(max_entries=1)
+    generation = await cache.generation("o1")
+    await cache.invalidate("o1")
+    await cache.invalidate("o2")  # forgets o1
+
+    assert await cache.generation("o1") != generation
@@ -0,0 +1,77 @@
+import asyncio
+
+from allocation.services.worker_pool import PartitionedWorkerPool, partition_of
+
+
+async def noop():
+    pass
+
+
+def keys_on_different_partitions(partitions):
+    first = "b0"
+    other = next(
+        f"b{i}"
+        for i in range(1, 100)
+        if partition_of(f"b{i}", partitions) != partition_of(first, partitions)
+    )
+    return first, other
+
+
+async def test_jobs_of_one_key_run_in_order():
+    pool = PartitionedWorkerPool(workers=4)
+    done = []
+
+    async def job(i):
+        await asyncio.sleep(0.001 * (5 - i))  # the first ones are the slowest
+        done.append(i)
+
+    for i in range(5):
+        await pool.submit("b1", lambda i=i: job(i))
+    await pool.aclose()
+
+    assert done == [0, 1, 2, 3, 4]
+
+
+async def test_jobs_of_other_keys_do_not_wait():
+    pool = PartitionedWorkerPool(workers=4)
+    slow_key, fast_key = keys_on_different_partitions(4)
+    blocked = asyncio.Event()
+
+    await pool.submit(slow_key, blocked.wait)
+    fast = await pool.submit(fast_key, noop)
+
+    assert await asyncio.wait_for(fast, timeout=1) is True
+    blocked.set()
+    await pool.aclose()
+
+
+async def test_submit_waits_while_the_partition_queue_is_full():
+    pool = PartitionedWorkerPool(workers=2, queue_size=1)
+    blocked = asyncio.Event()
+    await pool.submit("b1", blocked.wait)  # taken by the worker
+    await asyncio.sleep(0)
+    await pool.submit("b1", blocked.wait)  # queued
+
+    third = asyncio.create_task(pool.submit("b1", blocked.wait))
+    await asyncio.sleep(0.01)
+    assert not third.done()
+    assert max(pool.depths()) == 1
+
+    blocked.set()
+    await asyncio.wait_for(third, timeout=1)
+    await pool.aclose()
+
+
+async def test_a_failed_job_is_reported_and_the_worker_goes_on():
+    pool = PartitionedWorkerPool(workers=1)
+
+    async def fail():
+        raise ValueError("boom")
+
+    failed = await pool.submit("b1", fail)
+    succeeded = await pool.submit("b1", noop)
+
+    assert await failed is False
+    assert await succeeded is True
+    assert pool.failed == 1
+    await pool.aclose()